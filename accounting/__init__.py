@@ -1,9 +1,48 @@
-# You will need to pip install flask and the sqlalchemy extension for flask.
-from flask import Flask
+"""
+#######################################################
+The accounting package.
 
-# Initialize the application.
-app = Flask(__name__)
-app.config.from_pyfile("config.py")
+Importing it (or any of its modules) is free of side effects: Flask is
+only imported by create_app(), the engine is created on first use (see
+accounting.sql_base.get_engine) and the schema only by the explicit
+command:
 
-# Import the views file for routing.
-import accounting.views
+    python -m accounting.migrations
+
+`from accounting import app` still gives the default application, built
+by create_app() the first time it is asked for.
+#######################################################
+"""
+
+__all__ = ["app", "create_app"]
+
+
+def create_app(config_overrides=None):
+    """
+    A new Flask application serving the accounting API
+    :param config_overrides: dict of settings on top of config.py
+    :return: flask.Flask
+    """
+    # You will need to pip install flask and the sqlalchemy extension for flask.
+    from flask import Flask
+
+    from accounting import metrics
+    from accounting.views import blueprint
+
+    app = Flask(__name__)
+    app.config.from_pyfile("config.py")
+    if config_overrides:
+        app.config.update(config_overrides)
+    app.register_blueprint(blueprint)
+
+    if app.config["METRICS_ENABLED"]:
+        metrics.enable()
+    return app
+
+
+def __getattr__(name):
+    # The default application, created the first time it is imported.
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
@@ -0,0 +1,269 @@
+import argparse
+import csv
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import case, false, func, literal, select
+
+from accounting.balances import as_date
+from accounting.models import Contact, Invoice, Payment, Policy
+from accounting.money import cents, from_cents
+from accounting.sql_base import DBSession
+
+"""
+#######################################################
+Accounts receivable aging.
+
+Buckets what is still owed on every live invoice billed by the report
+date by how many days it is past its due date. Payments made by then
+are applied to the oldest invoices of their policy first (by due date),
+and payments beyond what was billed are left out, a credit is not a
+receivable.
+
+The whole book is worked out in one statement: a running total of the
+invoices of each policy (a window function) against the policy's paid
+total gives the open amount of every invoice, which CASE expressions
+sum into the buckets, by agent or billing schedule if asked:
+
+    python -m accounting.aging --date 2016-01-01 --group-by agent
+#######################################################
+"""
+
+# (field, heading, most days past due) of the buckets, oldest last.
+BUCKETS = (
+    ("current", "current", 0),
+    ("days_1_30", "1-30", 30),
+    ("days_31_60", "31-60", 60),
+    ("days_61_90", "61-90", 90),
+    ("over_90", "90+", None),
+)
+
+GROUPS = {
+    "agent": Policy.agent,
+    "billing_schedule": Policy.billing_schedule,
+}
+
+AgingRow = namedtuple(
+    "AgingRow", ("group",) + tuple(field for field, _, _ in BUCKETS) + ("total",)
+)
+
+
+def _bucket(due_date, date_cursor):
+    """
+    CASE expression with the index in BUCKETS of an invoice. Compares
+    the due date with the first due date of each bucket instead of
+    counting days on every row.
+    """
+    return case(
+        [
+            (due_date >= date_cursor - timedelta(days=high), index)
+            for index, (_, _, high) in enumerate(BUCKETS[:-1])
+        ],
+        else_=len(BUCKETS) - 1,
+    )
+
+
+def _aging_query(date_cursor, group_by):
+    """
+    (group, bucket index, open cents) rows
+    """
+    paid = (
+        select(
+            [
+                Payment.policy_id.label("policy_id"),
+                func.sum(cents(Payment.amount_paid)).label("paid"),
+            ]
+        )
+        .where(Payment.transaction_date <= date_cursor)
+        .group_by(Payment.policy_id)
+        .alias("paid")
+    )
+    # Everything billed to the policy up to and including each invoice.
+    # Invoices fall due a fixed time after their bill date, so bill date
+    # order is oldest first, and it is the order of the live invoices
+    # index.
+    billed = (
+        select(
+            [
+                Invoice.policy_id.label("policy_id"),
+                Invoice.due_date.label("due_date"),
+                cents(Invoice.amount_due).label("amount"),
+                func.sum(cents(Invoice.amount_due))
+                .over(
+                    partition_by=Invoice.policy_id,
+                    order_by=(Invoice.bill_date, Invoice.id),
+                )
+                .label("billed"),
+            ]
+        )
+        .where(Invoice.deleted == false())
+        .where(Invoice.bill_date <= date_cursor)
+        .alias("billed")
+    )
+    # The part of each invoice the paid total does not cover, between 0
+    # and the invoice amount (SQLite's scalar min / max).
+    aged = (
+        select(
+            [
+                billed.c.policy_id,
+                _bucket(billed.c.due_date, date_cursor).label("bucket"),
+                func.max(
+                    0,
+                    func.min(
+                        billed.c.amount,
+                        billed.c.billed - func.coalesce(paid.c.paid, 0),
+                    ),
+                ).label("open"),
+            ]
+        )
+        .select_from(billed.outerjoin(paid, paid.c.policy_id == billed.c.policy_id))
+        .alias("aged")
+    )
+    if group_by:
+        group = GROUPS[group_by]
+        tables = aged.join(Policy, Policy.id == aged.c.policy_id)
+    else:
+        group = literal(None)
+        tables = aged
+    return (
+        select([group.label("group"), aged.c.bucket, func.sum(aged.c.open)])
+        .select_from(tables)
+        .group_by(group, aged.c.bucket)
+        .order_by(group)
+    )
+
+
+def aging_report(date_cursor=None, group_by=None, session=DBSession):
+    """
+    AR aging of the whole book
+    :param date_cursor: report date (default today)
+    :param group_by: None for one row, or a key of GROUPS
+    :param session:
+    :return: list of AgingRow in group order, amounts in dollars
+    """
+    if group_by is not None and group_by not in GROUPS:
+        raise UserWarning(
+            "Cannot group the aging report by {0}, choose one of: {1}".format(
+                group_by, ", ".join(sorted(GROUPS))
+            )
+        )
+    date_cursor = as_date(date_cursor) if date_cursor else datetime.now().date()
+    rows = session.execute(_aging_query(date_cursor, group_by)).fetchall()
+    session.rollback()
+    report = []
+    for group, buckets in groupby(rows, key=itemgetter(0)):
+        amounts = [0] * len(BUCKETS)
+        for _, bucket, amount in buckets:
+            amounts[bucket] = amount
+        report.append(
+            AgingRow(
+                group, *(from_cents(amount) for amount in amounts + [sum(amounts)])
+            )
+        )
+    if not group_by and not report:
+        report.append(total_row([]))
+    return report
+
+
+def total_row(rows):
+    """
+    AgingRow adding up the rows, with no group
+    """
+    return AgingRow(
+        None,
+        *(
+            sum((row[index] for row in rows), Decimal(0))
+            for index in range(1, len(AgingRow._fields))
+        )
+    )
+
+
+def _labels(rows, group_by, session):
+    """
+    What to print for the group of each row: the agent's name for agents
+    """
+    if group_by != "agent":
+        return [str(row.group) for row in rows]
+    names = dict(
+        session.query(Contact.id, Contact.name)
+        .filter(Contact.id.in_([row.group for row in rows if row.group]))
+        .all()
+    )
+    session.rollback()
+    return [
+        "{0} ({1})".format(names.get(row.group), row.group) if row.group else "no agent"
+        for row in rows
+    ]
+
+
+def write_table(rows, out, labels=None):
+    """
+    The rows as a text table, plus a total line when there are several
+    """
+    headings = ["group"] + [heading for _, heading, _ in BUCKETS] + ["total"]
+    lines = [
+        [label] + ["{0:,.2f}".format(amount) for amount in row[1:]]
+        for label, row in zip(labels or ["all"] * len(rows), rows)
+    ]
+    if len(rows) > 1:
+        lines.append(
+            ["total"] + ["{0:,.2f}".format(amount) for amount in total_row(rows)[1:]]
+        )
+    width = max([len(line[0]) for line in lines] + [len(headings[0])])
+    out.write(
+        "{0:<{1}}".format(headings[0], width)
+        + "".join("{0:>15}".format(heading) for heading in headings[1:])
+        + "\n"
+    )
+    for line in lines:
+        out.write(
+            "{0:<{1}}".format(line[0], width)
+            + "".join("{0:>15}".format(amount) for amount in line[1:])
+            + "\n"
+        )
+
+
+def write_csv(rows, out, labels=None):
+    writer = csv.writer(out)
+    writer.writerow(AgingRow._fields)
+    for label, row in zip(labels or [""] * len(rows), rows):
+        writer.writerow([label] + [str(amount) for amount in row[1:]])
+
+
+WRITERS = {"table": write_table, "csv": write_csv}
+
+
+def print_aging_report(
+    date_cursor=None, group_by=None, output_format="table", out=None, session=DBSession
+):
+    """
+    Run the report and write it out
+    :param date_cursor: report date (default today)
+    :param group_by: None or a key of GROUPS
+    :param output_format: a key of WRITERS
+    :param out: file to write to (default stdout)
+    :param session:
+    :return: the AgingRows
+    """
+    rows = aging_report(date_cursor, group_by, session=session)
+    labels = _labels(rows, group_by, session) if group_by else None
+    WRITERS[output_format](rows, out or sys.stdout, labels)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accounts receivable aging")
+    parser.add_argument("--date", help="report date, YYYY-MM-DD (default today)")
+    parser.add_argument("--group-by", choices=sorted(GROUPS))
+    parser.add_argument("--format", choices=sorted(WRITERS), default="table")
+    args = parser.parse_args()
+
+    print_aging_report(args.date, args.group_by, args.format)
+
+
+if __name__ == "__main__":
+    main()
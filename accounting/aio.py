@@ -0,0 +1,304 @@
+import asyncio
+from collections import namedtuple
+from datetime import date, datetime
+
+import aiosqlite
+from aiohttp import web
+from sqlalchemy import false, select
+from sqlalchemy.orm.exc import NoResultFound
+
+from accounting import config
+from accounting.balances import as_date
+from accounting.ledger import PolicyLedger
+from accounting.models import Invoice, LedgerEntry, Policy
+from accounting.money import from_cents, json_amount
+from accounting.sql_base import DBSession, get_engine
+
+"""
+#######################################################
+Asyncio serving mode.
+
+AsyncPolicyAccounting has async versions of the PolicyAccounting read
+paths (balance, invoice listing, cancellation checks) and
+create_async_app serves the same /policy/api/invoices contract as the
+Flask app on aiohttp:
+
+    python runserver_async.py
+
+The project is pinned to SQLAlchemy 1.2, which has no asyncio extension,
+so statements are still built with SQLAlchemy Core, compiled for SQLite
+and run on a small pool of aiosqlite connections.
+#######################################################
+"""
+
+PolicyRow = namedtuple("PolicyRow", "id policy_number status cancel_date cancel_reason")
+
+
+class InvoiceRow(
+    namedtuple("InvoiceRow", "id policy_id bill_date due_date cancel_date amount_due")
+):
+    """
+    An invoice read straight from SQLite, amount_due in integer cents
+    """
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "bill_date": self.bill_date.strftime("%Y-%m-%d"),
+            "due_date": self.due_date.strftime("%Y-%m-%d"),
+            "amount_due": json_amount(from_cents(self.amount_due)),
+        }
+
+
+def _to_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+
+def _compile(statement):
+    """
+    SQL string and positional parameters of a Core statement, with
+    dates bound the way the SQLite dialect stores them
+    """
+    compiled = statement.compile(dialect=get_engine().dialect)
+    params = compiled.construct_params()
+    args = []
+    for name in compiled.positiontup:
+        value = params[name]
+        args.append(value.isoformat() if isinstance(value, date) else value)
+    return compiled.string, args
+
+
+class AsyncDatabase(object):
+    """
+    Fixed size pool of aiosqlite connections
+    """
+
+    def __init__(self, path=None, size=None):
+        url = get_engine().url
+        if url.get_backend_name() != "sqlite":
+            raise UserWarning("The async mode only supports SQLite databases")
+        self.path = path or url.database
+        self.size = size or config.ASYNC_POOL_SIZE
+        self._pool = None
+
+    async def open(self):
+        self._pool = asyncio.Queue()
+        for _ in range(self.size):
+            self._pool.put_nowait(await aiosqlite.connect(self.path))
+
+    async def close(self):
+        while not self._pool.empty():
+            await self._pool.get_nowait().close()
+
+    async def fetchall(self, statement):
+        sql, args = _compile(statement)
+        connection = await self._pool.get()
+        try:
+            async with connection.execute(sql, args) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._pool.put_nowait(connection)
+
+
+class AsyncPolicyAccounting(object):
+    """
+    Read only asyncio counterpart of PolicyAccounting
+    """
+
+    def __init__(self, db, policy):
+        self.db = db
+        self.policy = policy
+
+    @classmethod
+    async def load(cls, db, policy_id=None, policy_number=None):
+        """
+        :param db: AsyncDatabase
+        :param policy_id:
+        :param policy_number: used when policy_id is not given
+        :return:
+        """
+        query = select(
+            [
+                Policy.id,
+                Policy.policy_number,
+                Policy.status,
+                Policy.cancel_date,
+                Policy.cancel_reason,
+            ]
+        )
+        if policy_id is not None:
+            query = query.where(Policy.id == policy_id)
+        else:
+            query = query.where(Policy.policy_number == policy_number)
+        rows = await db.fetchall(query)
+        if not rows:
+            raise NoResultFound("We couldn't find this policy")
+        policy = PolicyRow(*rows[0])
+        if policy.status == "Canceled":
+            raise UserWarning(
+                "This policy canceled \nCancel date: {0} \nReason: {1}".format(
+                    policy.cancel_date, policy.cancel_reason
+                )
+            )
+        return cls(db, policy)
+
+    async def return_account_balance(self, date_cursor=None):
+        """
+        Returns the balance of the policy in a given point in time
+        :param date_cursor:
+        :return:
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        rows = await self.db.fetchall(
+            select([LedgerEntry.balance])
+            .where(LedgerEntry.policy_id == self.policy.id)
+            .where(LedgerEntry.entry_date <= as_date(date_cursor))
+            .order_by(LedgerEntry.entry_date.desc())
+            .limit(1)
+        )
+        return from_cents(rows[0][0] if rows else 0)
+
+    async def invoices(self):
+        """
+        The live invoices of the policy, like Policy.invoices
+        :return:
+        """
+        return await self._invoices(Invoice.deleted == false())
+
+    async def find_cancellation_pending_invoice(self, date_cursor=None):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        date_cursor = as_date(date_cursor)
+        invoices = await self._invoices(
+            Invoice.deleted == false(),
+            Invoice.due_date <= date_cursor,
+            Invoice.cancel_date >= date_cursor,
+        )
+        return await self._first_unpaid(invoices, "due_date", date_cursor)
+
+    async def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
+        invoice = await self.find_cancellation_pending_invoice(date_cursor)
+        return invoice is not None
+
+    async def find_cancel_invoice(self, date_cursor=None):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        date_cursor = as_date(date_cursor)
+        invoices = await self._invoices(
+            Invoice.deleted == false(), Invoice.cancel_date <= date_cursor
+        )
+        return await self._first_unpaid(invoices, "cancel_date", date_cursor)
+
+    async def evaluate_cancel(self, date_cursor=None):
+        return await self.find_cancel_invoice(date_cursor) is not None
+
+    async def _invoices(self, *criteria):
+        query = select(
+            [
+                Invoice.id,
+                Invoice.policy_id,
+                Invoice.bill_date,
+                Invoice.due_date,
+                Invoice.cancel_date,
+                Invoice.amount_due,
+            ]
+        ).where(Invoice.policy_id == self.policy.id)
+        for criterion in criteria:
+            query = query.where(criterion)
+        rows = await self.db.fetchall(query.order_by(Invoice.bill_date, Invoice.id))
+        return [
+            InvoiceRow(
+                row[0],
+                row[1],
+                _to_date(row[2]),
+                _to_date(row[3]),
+                _to_date(row[4]),
+                row[5],
+            )
+            for row in rows
+        ]
+
+    async def _first_unpaid(self, invoices, check_date, date_cursor):
+        if not invoices:
+            return None
+        rows = await self.db.fetchall(
+            select([LedgerEntry.entry_date, LedgerEntry.balance])
+            .where(LedgerEntry.policy_id == self.policy.id)
+            .where(LedgerEntry.entry_date <= date_cursor)
+            .order_by(LedgerEntry.entry_date)
+        )
+        ledger = PolicyLedger([(_to_date(day), balance) for day, balance in rows])
+        for invoice in invoices:
+            if ledger.balance_on(getattr(invoice, check_date)):
+                return invoice
+        return None
+
+
+DB_KEY = web.AppKey("db", AsyncDatabase)
+
+
+def _bill_policy(policy_id):
+    """
+    Worker thread: bill a policy without invoices through the sync
+    PolicyAccounting, like the Flask endpoint does
+    """
+    from accounting.utils import PolicyAccounting
+
+    try:
+        PolicyAccounting(policy_id)
+    finally:
+        DBSession.remove()
+
+
+def _invalid_usage(message, status_code=400):
+    return web.json_response({"message": message}, status=status_code)
+
+
+async def get_tasks(request):
+    db = request.app[DB_KEY]
+    try:
+        date_cursor = datetime.strptime(
+            request.query.get("date_cursor", ""), "%Y-%m-%d"
+        )
+    except ValueError:
+        return _invalid_usage("Bad date format", status_code=400)
+    try:
+        pa = await AsyncPolicyAccounting.load(
+            db, policy_number=request.query.get("policy_number")
+        )
+    except NoResultFound:
+        return _invalid_usage("Policy Not Found", status_code=404)
+
+    invoices, balance = await asyncio.gather(
+        pa.invoices(), pa.return_account_balance(date_cursor)
+    )
+    if not invoices:
+        await asyncio.get_event_loop().run_in_executor(None, _bill_policy, pa.policy.id)
+        invoices, balance = await asyncio.gather(
+            pa.invoices(), pa.return_account_balance(date_cursor)
+        )
+    return web.json_response(
+        {"balance": str(balance), "invoices": [i.serialize() for i in invoices]}
+    )
+
+
+def create_async_app(pool_size=None):
+    """
+    aiohttp application serving /policy/api/invoices
+    :param pool_size: aiosqlite connections, defaults to ASYNC_POOL_SIZE
+    :return:
+    """
+    app = web.Application()
+    app.router.add_get("/policy/api/invoices", get_tasks)
+
+    async def open_db(app):
+        app[DB_KEY] = AsyncDatabase(size=pool_size)
+        await app[DB_KEY].open()
+
+    async def close_db(app):
+        await app[DB_KEY].close()
+
+    app.on_startup.append(open_db)
+    app.on_cleanup.append(close_db)
+    return app
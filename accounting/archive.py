@@ -0,0 +1,106 @@
+import argparse
+from datetime import datetime
+
+from sqlalchemy import DATETIME, literal, select, true
+
+from accounting.models import Invoice, InvoiceArchive
+from accounting.sql_base import DBSession, get_engine
+
+"""
+#######################################################
+Archival of soft-deleted invoices.
+
+Soft-deleted invoices no longer count towards any balance, but they
+still sit in the invoices table and its indexes. archive_deleted_invoices
+moves them to invoices_archive in bounded batches, one transaction per
+batch, and compact() gives the freed pages back and refreshes the query
+planner statistics afterwards:
+
+    python -m accounting.archive --batch-size 1000 --compact
+#######################################################
+"""
+
+_ARCHIVED_COLUMNS = (
+    "policy_id",
+    "bill_date",
+    "due_date",
+    "cancel_date",
+    "amount_due",
+)
+
+
+def archive_deleted_invoices(batch_size=1000, session=DBSession):
+    """
+    Move every soft-deleted invoice to invoices_archive
+    :param batch_size: invoices moved per transaction
+    :param session:
+    :return: number of invoices archived
+    """
+    invoices = Invoice.__table__
+    archive = InvoiceArchive.__table__
+    archived_at = literal(datetime.now(), DATETIME())
+    archived = 0
+    cursor_id = 0
+    while True:
+        # Keyset paging on the primary key: one pass over the table no
+        # matter how many batches it takes.
+        ids = [
+            invoice_id
+            for invoice_id, in session.execute(
+                select([invoices.c.id])
+                .where(invoices.c.id > cursor_id)
+                .where(invoices.c.deleted == true())
+                .order_by(invoices.c.id)
+                .limit(batch_size)
+            )
+        ]
+        if not ids:
+            break
+        session.execute(
+            archive.insert().from_select(
+                ("invoice_id",) + _ARCHIVED_COLUMNS + ("archived_at",),
+                select(
+                    [invoices.c.id]
+                    + [invoices.c[name] for name in _ARCHIVED_COLUMNS]
+                    + [archived_at]
+                ).where(invoices.c.id.in_(ids)),
+            )
+        )
+        # Deleted rows are not on the ledger, so neither the ledger
+        # triggers nor the balance cache have anything to do here.
+        session.execute(invoices.delete().where(invoices.c.id.in_(ids)))
+        session.commit()
+        archived += len(ids)
+        cursor_id = ids[-1]
+    return archived
+
+
+def compact(bind=None):
+    """
+    VACUUM the database to release the pages archived rows used and
+    ANALYZE it so the planner sees the new table sizes
+    :param bind:
+    :return:
+    """
+    bind = bind or get_engine()
+    bind.execute("VACUUM")
+    bind.execute("ANALYZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive soft-deleted invoices")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--compact", action="store_true", help="VACUUM and ANALYZE afterwards"
+    )
+    args = parser.parse_args()
+
+    print("{0} invoices archived".format(archive_deleted_invoices(args.batch_size)))
+    if args.compact:
+        DBSession.remove()
+        compact()
+        print("Database compacted")
+
+
+if __name__ == "__main__":
+    main()
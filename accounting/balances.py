@@ -0,0 +1,95 @@
+from datetime import datetime
+
+"""
+#######################################################
+Single pass balance walks.
+
+The helpers below answer "what was the balance on each of these dates"
+from invoices and payments that were fetched once and sorted by date,
+instead of asking the database once per date.
+#######################################################
+"""
+
+
+def as_date(date_cursor):
+    """
+    Normalize a date cursor (date, datetime or "YYYY-MM-DD") to a date
+    :param date_cursor:
+    :return:
+    """
+    if isinstance(date_cursor, datetime):
+        return date_cursor.date()
+    if isinstance(date_cursor, str):
+        return datetime.strptime(date_cursor, "%Y-%m-%d").date()
+    return date_cursor
+
+
+def first_unpaid_invoice(invoices, payments, candidates):
+    """
+    Walk a running balance once and return the first candidate invoice
+    with a balance left on its check date.
+    :param invoices: every invoice on the policy, sorted by bill_date
+    :param payments: the policy payments, sorted by transaction_date
+    :param candidates: (check_date, invoice) pairs in bill_date order
+    :return: the first offending invoice in bill_date order, or None
+    """
+    # Check dates usually follow bill_date order, but nothing guarantees
+    # it, so visit them in date order and keep the lowest offending index.
+    order = sorted(range(len(candidates)), key=lambda i: candidates[i][0])
+    balance = 0
+    next_invoice = next_payment = 0
+    found = None
+    for index in order:
+        if found is not None and index > found:
+            continue
+        check_date = candidates[index][0]
+        while (
+            next_invoice < len(invoices)
+            and invoices[next_invoice].bill_date <= check_date
+        ):
+            balance += invoices[next_invoice].amount_due
+            next_invoice += 1
+        while (
+            next_payment < len(payments)
+            and payments[next_payment].transaction_date <= check_date
+        ):
+            balance -= payments[next_payment].amount_paid
+            next_payment += 1
+        if balance:
+            found = index
+    return candidates[found][1] if found is not None else None
+
+
+def cancellation_pending_invoice(invoices, payments, date_cursor):
+    """
+    First invoice that is past its due date, but not yet past its cancel
+    date, without being paid in full by the due date
+    :param invoices: sorted by bill_date
+    :param payments: sorted by transaction_date
+    :param date_cursor:
+    :return:
+    """
+    date_cursor = as_date(date_cursor)
+    candidates = [
+        (invoice.due_date, invoice)
+        for invoice in invoices
+        if invoice.due_date <= date_cursor <= invoice.cancel_date
+    ]
+    return first_unpaid_invoice(invoices, payments, candidates)
+
+
+def cancel_invoice(invoices, payments, date_cursor):
+    """
+    First invoice that still had a balance on its cancel date
+    :param invoices: sorted by bill_date
+    :param payments: sorted by transaction_date
+    :param date_cursor:
+    :return:
+    """
+    date_cursor = as_date(date_cursor)
+    candidates = [
+        (invoice.cancel_date, invoice)
+        for invoice in invoices
+        if invoice.cancel_date <= date_cursor
+    ]
+    return first_unpaid_invoice(invoices, payments, candidates)
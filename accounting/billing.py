@@ -0,0 +1,196 @@
+from collections import namedtuple
+from datetime import date, timedelta
+from fractions import Fraction
+from functools import lru_cache
+
+from accounting.cache import balance_cache
+from accounting.models import Invoice
+from accounting.money import from_cents, to_cents
+from accounting.sql_base import DBSession
+
+"""
+#######################################################
+Billing schedules and bulk invoice generation.
+
+Every billing schedule is a BillingSchedule with its installment offsets
+and amount fractions worked out once, at import. The invoice dates of an
+(effective_date, schedule) pair are memoized, since whole books of
+policies share an effective date, so laying out a policy's invoices is a
+table lookup plus integer month arithmetic (with the same month end
+clamping relativedelta does).
+
+make_invoices_bulk generates the same invoices as
+PolicyAccounting.make_invoices for many policies at once and sends the
+rows to the database through a Core executemany.
+#######################################################
+"""
+
+# Days between the due date and the cancel date of an invoice.
+CANCEL_GRACE_DAYS = 14
+
+# Memoized (effective_date, billing_schedule) pairs. A year of daily
+# effective dates over every schedule fits.
+INVOICE_DATES_CACHE_SIZE = 4096
+
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+class BillingSchedule(
+    namedtuple("BillingSchedule", "name installments offsets fractions")
+):
+    """
+    A billing schedule. offsets holds one (bill, due, cancel) triple per
+    installment: months from the effective date to the bill date, months
+    from the bill date to the due date and days from the due date to the
+    cancel date. fractions is the share of the premium of each one.
+    """
+
+    @classmethod
+    def every(cls, name, installments, months):
+        """
+        A schedule billing `installments` equal shares `months` apart
+        :param name:
+        :param installments:
+        :param months:
+        :return:
+        """
+        return cls(
+            name,
+            installments,
+            tuple((i * months, 1, CANCEL_GRACE_DAYS) for i in range(installments)),
+            (Fraction(1, installments),) * installments,
+        )
+
+    def amounts(self, annual_premium):
+        """
+        Decimal dollar amounts of the installments of a premium. Each one
+        is its fraction of the premium rounded down to the cent and the
+        cents left over go on the first installment.
+        :param annual_premium: dollars
+        :return:
+        """
+        total = to_cents(annual_premium)
+        shares = [
+            total * fraction.numerator // fraction.denominator
+            for fraction in self.fractions
+        ]
+        shares[0] += total - sum(shares)
+        return [from_cents(share) for share in shares]
+
+
+BILLING_SCHEDULES = {
+    schedule.name: schedule
+    for schedule in (
+        BillingSchedule.every("Annual", 1, 12),
+        BillingSchedule.every("Semi-Annual", 2, 6),
+        BillingSchedule.every("Quarterly", 4, 3),
+        BillingSchedule.every("Monthly", 12, 1),
+        BillingSchedule.every("Two-Pay", 2, 6),
+    )
+}
+
+
+def billing_schedule(name):
+    """
+    The BillingSchedule called `name`
+    :param name:
+    :return:
+    :raise KeyError: for a name that is not in BILLING_SCHEDULES
+    """
+    try:
+        return BILLING_SCHEDULES[name]
+    except KeyError:
+        raise KeyError("Invalid billing schedule")
+
+
+def _days_in_month(year, month):
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return 29
+    return _DAYS_IN_MONTH[month - 1]
+
+
+def add_months(day, months):
+    """
+    Same result as day + relativedelta(months=months): the day of month
+    is clamped to the end of shorter months (Jan 31 + 1 month = Feb 28)
+    :param day:
+    :param months:
+    :return:
+    """
+    year, month = divmod(day.year * 12 + day.month - 1 + months, 12)
+    month += 1
+    return date(year, month, min(day.day, _days_in_month(year, month)))
+
+
+@lru_cache(maxsize=INVOICE_DATES_CACHE_SIZE)
+def invoice_dates(effective_date, billing_schedule_name):
+    """
+    (bill_date, due_date, cancel_date) of every installment of a
+    schedule, as make_invoices lays them out. Memoized, treat the
+    result as read only.
+    :param effective_date:
+    :param billing_schedule_name:
+    :return: tuple of date triples
+    """
+    dates = []
+    for bill_months, due_months, cancel_days in billing_schedule(
+        billing_schedule_name
+    ).offsets:
+        bill_date = add_months(effective_date, bill_months)
+        due_date = add_months(bill_date, due_months)
+        dates.append((bill_date, due_date, due_date + timedelta(days=cancel_days)))
+    return tuple(dates)
+
+
+def invoice_rows(policies):
+    """
+    Yields the invoice rows make_invoices would create, as dicts ready
+    for an executemany, for policies exposing id, effective_date,
+    billing_schedule and annual_premium
+    :param policies:
+    :return:
+    """
+    for policy in policies:
+        dates = invoice_dates(policy.effective_date, policy.billing_schedule)
+        amounts = billing_schedule(policy.billing_schedule).amounts(
+            policy.annual_premium
+        )
+        for (bill_date, due_date, cancel_date), amount_due in zip(dates, amounts):
+            yield {
+                "policy_id": policy.id,
+                "bill_date": bill_date,
+                "due_date": due_date,
+                "cancel_date": cancel_date,
+                "amount_due": amount_due,
+                "deleted": False,
+            }
+
+
+def make_invoices_bulk(policies, chunk_size=500):
+    """
+    Bulk version of PolicyAccounting.make_invoices: drops the live
+    invoices of the given policies and inserts their new schedules,
+    all in one transaction
+    :param policies: Policy objects or rows (see invoice_rows)
+    :param chunk_size: policies per executemany call
+    :return: number of invoices created
+    """
+    policies = list(policies)
+    invoices = Invoice.__table__
+    created = 0
+    for start in range(0, len(policies), chunk_size):
+        chunk = policies[start : start + chunk_size]
+        DBSession.execute(
+            invoices.delete().where(
+                invoices.c.policy_id.in_([policy.id for policy in chunk])
+                & (invoices.c.deleted == 0)
+            )
+        )
+        rows = list(invoice_rows(chunk))
+        if rows:
+            DBSession.execute(invoices.insert(), rows)
+        created += len(rows)
+    DBSession.commit()
+    # Core statements skip the ORM events that normally do this.
+    balance_cache.invalidate(policy.id for policy in policies)
+    return created
@@ -0,0 +1,209 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from accounting import config
+from accounting.balances import as_date
+from accounting.models import Invoice, Payment, Policy
+
+"""
+#######################################################
+Read-through cache for account balances.
+
+Entries are keyed by (policy_id, date_cursor), bounded in size (least
+recently used entries go first) and expire after a TTL. Every ORM flush
+touching an Invoice, Payment or Policy invalidates the policies
+involved, no matter which code made the change; bulk Query.update /
+Query.delete on those tables drop the whole cache. Core statements do
+not go through the ORM, so code writing that way has to call
+balance_cache.invalidate itself.
+
+A balance read before another thread commits can reach set() after
+that commit invalidated the policy. So every policy has a generation
+that invalidation bumps. A reader takes the generation before it reads,
+and set() drops the balance if the generation moved on since:
+
+    generation = balance_cache.generation(policy_id)
+    balance = ...  # read from the database
+    balance_cache.set(policy_id, date_cursor, balance, generation)
+#######################################################
+"""
+
+_TRACKED_TABLES = frozenset(
+    model.__table__.name for model in (Invoice, Payment, Policy)
+)
+
+
+class BalanceCache(object):
+    """
+    LRU + TTL cache with hit/miss/eviction counters
+    """
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._keys_by_policy = defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_sets = 0
+        # Policies invalidated since the epoch began, and how many times.
+        # Forgetting them all starts a new epoch, so the generations
+        # handed out before are out of date.
+        self._epoch = 0
+        self._generations = {}
+
+    def get(self, policy_id, date_cursor):
+        """
+        Cached balance or None
+        :param policy_id:
+        :param date_cursor:
+        :return:
+        """
+        key = (policy_id, as_date(date_cursor))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self, policy_id):
+        """
+        The generation of a policy, to take before reading a balance
+        that goes to set()
+        :param policy_id:
+        :return:
+        """
+        with self._lock:
+            return self._epoch, self._generations.get(policy_id, 0)
+
+    def set(self, policy_id, date_cursor, value, generation=None):
+        """
+        Cache a balance
+        :param policy_id:
+        :param date_cursor:
+        :param value:
+        :param generation: generation(policy_id) from before the balance
+            was read. The balance is dropped if the policy was
+            invalidated since.
+        :return:
+        """
+        if self.max_size <= 0:
+            return
+        key = (policy_id, as_date(date_cursor))
+        with self._lock:
+            if generation is not None and generation != (
+                self._epoch,
+                self._generations.get(policy_id, 0),
+            ):
+                self.stale_sets += 1
+                return
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._keys_by_policy[policy_id].add(key)
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, policy_ids):
+        """
+        Forget every cached balance of the given policies
+        :param policy_ids:
+        :return:
+        """
+        with self._lock:
+            for policy_id in policy_ids:
+                self._generations[policy_id] = self._generations.get(policy_id, 0) + 1
+                keys = self._keys_by_policy.pop(policy_id, ())
+                for key in keys:
+                    del self._entries[key]
+                self.invalidations += len(keys)
+            if len(self._generations) > self.max_size:
+                self._new_epoch()
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._keys_by_policy.clear()
+            self._new_epoch()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "stale_sets": self.stale_sets,
+            }
+
+    def _new_epoch(self):
+        self._epoch += 1
+        self._generations.clear()
+
+    def _drop(self, key):
+        del self._entries[key]
+        keys = self._keys_by_policy[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_policy[key[0]]
+
+
+balance_cache = BalanceCache(config.BALANCE_CACHE_SIZE, config.BALANCE_CACHE_TTL)
+
+
+def _changed_policy_ids(session):
+    policy_ids = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, (Invoice, Payment)):
+            policy_ids.add(instance.policy_id)
+        elif isinstance(instance, Policy):
+            policy_ids.add(instance.id)
+    return policy_ids
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_changes(session, flush_context, instances):
+    session.info.setdefault("balance_cache_policy_ids", set()).update(
+        _changed_policy_ids(session)
+    )
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_flush(session, flush_context):
+    balance_cache.invalidate(session.info.get("balance_cache_policy_ids", ()))
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _invalidate_on_transaction_end(session):
+    # Balances read between the flush and the end of the transaction may
+    # have been cached from uncommitted rows, drop them again.
+    balance_cache.invalidate(session.info.pop("balance_cache_policy_ids", ()))
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _invalidate_on_bulk(update_context):
+    if update_context.primary_table.name in _TRACKED_TABLES:
+        balance_cache.clear()
@@ -0,0 +1,377 @@
+import argparse
+from bisect import bisect_right
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import bindparam, false, func, select, union_all
+
+from accounting.balances import as_date
+from accounting.money import cents
+from accounting.models import (
+    LEDGER_TRIGGERS,
+    VERSION_TRIGGERS,
+    Invoice,
+    LedgerEntry,
+    Payment,
+    Policy,
+)
+from accounting.sql_base import DBSession
+
+"""
+#######################################################
+Running balance ledger.
+
+ledger_entries holds the balance of a policy at every date an invoice
+is billed or a payment is made, so a point in time balance is the
+latest entry at or before the date. The table is maintained by the
+triggers declared next to LedgerEntry in accounting.models; this module
+reads it, rebuilds it from the raw invoices and payments tables and
+checks the two agree:
+
+    python -m accounting.ledger rebuild
+    python -m accounting.ledger check
+#######################################################
+"""
+
+
+class PolicyLedger(object):
+    """
+    The ledger entries of one policy, for repeated balance lookups
+    """
+
+    def __init__(self, entries):
+        self.dates = [entry_date for entry_date, _ in entries]
+        self.balances = [balance for _, balance in entries]
+
+    def balance_on(self, date_cursor):
+        index = bisect_right(self.dates, as_date(date_cursor))
+        return self.balances[index - 1] if index else 0
+
+
+def ledger_balance(policy_id, date_cursor, session=DBSession):
+    """
+    Balance of the policy at date_cursor, one indexed lookup
+    :param policy_id:
+    :param date_cursor:
+    :param session:
+    :return: integer cents
+    """
+    balance = (
+        session.query(LedgerEntry.balance)
+        .filter(LedgerEntry.policy_id == policy_id)
+        .filter(LedgerEntry.entry_date <= as_date(date_cursor))
+        .order_by(LedgerEntry.entry_date.desc())
+        .limit(1)
+        .scalar()
+    )
+    return balance or 0
+
+
+def ledger_balance_column(policy_id, date_cursor):
+    """
+    Correlated scalar subquery with the ledger balance of `policy_id`
+    (usually Policy.id) at date_cursor, to fetch the balance in the same
+    statement as the policy itself
+    :param policy_id:
+    :param date_cursor:
+    :return:
+    """
+    latest = (
+        select([LedgerEntry.balance])
+        .where(LedgerEntry.policy_id == policy_id)
+        .where(LedgerEntry.entry_date <= as_date(date_cursor))
+        .order_by(LedgerEntry.entry_date.desc())
+        .limit(1)
+        .as_scalar()
+    )
+    return func.coalesce(latest, 0)
+
+
+def load_ledger(policy_id, date_cursor, session=DBSession):
+    """
+    PolicyLedger with every entry of the policy up to date_cursor
+    :param policy_id:
+    :param date_cursor:
+    :param session:
+    :return:
+    """
+    return PolicyLedger(
+        session.query(LedgerEntry.entry_date, LedgerEntry.balance)
+        .filter(LedgerEntry.policy_id == policy_id)
+        .filter(LedgerEntry.entry_date <= as_date(date_cursor))
+        .order_by(LedgerEntry.entry_date)
+        .all()
+    )
+
+
+def _raw_entries(session, policies):
+    """
+    (policy_id, entry_date, balance) rows computed from the raw tables,
+    in policy and date order
+    :param policies: makes the condition on a policy_id column that
+        picks the policies, like lambda column: column.between(1, 100)
+    """
+    movements = union_all(
+        session.query(
+            Invoice.policy_id.label("policy_id"),
+            Invoice.bill_date.label("entry_date"),
+            func.sum(cents(Invoice.amount_due)).label("amount"),
+        )
+        .filter(policies(Invoice.policy_id))
+        .filter(Invoice.deleted == false())
+        .group_by(Invoice.policy_id, Invoice.bill_date),
+        session.query(
+            Payment.policy_id,
+            Payment.transaction_date,
+            -func.sum(cents(Payment.amount_paid)),
+        )
+        .filter(policies(Payment.policy_id))
+        .group_by(Payment.policy_id, Payment.transaction_date),
+    ).alias("movements")
+    rows = (
+        session.query(
+            movements.c.policy_id,
+            movements.c.entry_date,
+            func.sum(movements.c.amount),
+        )
+        .group_by(movements.c.policy_id, movements.c.entry_date)
+        .order_by(movements.c.policy_id, movements.c.entry_date)
+    )
+    for policy_id, group in groupby(rows, key=itemgetter(0)):
+        balance = 0
+        for _, entry_date, amount in group:
+            balance += amount
+            yield policy_id, entry_date, balance
+
+
+def _id_ranges(session, chunk_size):
+    low, high = session.query(func.min(Policy.id), func.max(Policy.id)).one()
+    if low is None:
+        return []
+    return [
+        (start, min(start + chunk_size - 1, high))
+        for start in range(low, high + 1, chunk_size)
+    ]
+
+
+def rebuild_ledger(chunk_size=1000, session=DBSession):
+    """
+    Recompute ledger_entries from the invoices and payments tables,
+    chunk_size policy ids at a time, in one transaction
+    :param chunk_size:
+    :param session:
+    :return: number of entries written
+    """
+    table = LedgerEntry.__table__
+    session.execute(table.delete())
+    written = 0
+    for first_id, last_id in _id_ranges(session, chunk_size):
+        rows = [
+            {"policy_id": policy_id, "entry_date": entry_date, "balance": balance}
+            for policy_id, entry_date, balance in _raw_entries(
+                session, lambda column: column.between(first_id, last_id)
+            )
+        ]
+        if rows:
+            session.execute(table.insert(), rows)
+        written += len(rows)
+    session.commit()
+    return written
+
+
+# The ledger entries of the policies in policy_ids, recomputed from the
+# raw tables by SQLite: the movements of each day, and their running sum
+# per policy.
+_movements = union_all(
+    select(
+        [
+            Invoice.policy_id.label("policy_id"),
+            Invoice.bill_date.label("entry_date"),
+            cents(Invoice.amount_due).label("amount"),
+        ]
+    )
+    .where(Invoice.deleted == false())
+    .where(Invoice.policy_id.in_(bindparam("invoice_policy_ids", expanding=True))),
+    select(
+        [Payment.policy_id, Payment.transaction_date, -cents(Payment.amount_paid)]
+    ).where(Payment.policy_id.in_(bindparam("payment_policy_ids", expanding=True))),
+).alias("movements")
+
+_daily = (
+    select(
+        [
+            _movements.c.policy_id,
+            _movements.c.entry_date,
+            func.sum(_movements.c.amount).label("amount"),
+        ]
+    )
+    .group_by(_movements.c.policy_id, _movements.c.entry_date)
+    .alias("daily")
+)
+
+_REBUILD_ENTRIES = LedgerEntry.__table__.insert().from_select(
+    ["policy_id", "entry_date", "balance"],
+    select(
+        [
+            _daily.c.policy_id,
+            _daily.c.entry_date,
+            func.sum(_daily.c.amount).over(
+                partition_by=_daily.c.policy_id, order_by=_daily.c.entry_date
+            ),
+        ]
+    ),
+)
+
+_DELETE_ENTRIES = LedgerEntry.__table__.delete().where(
+    LedgerEntry.policy_id.in_(bindparam("policy_ids", expanding=True))
+)
+
+_BUMP_VERSIONS = (
+    Policy.__table__.update()
+    .where(Policy.id.in_(bindparam("policy_ids", expanding=True)))
+    .values(
+        version=Policy.__table__.c.version + 1, modified_at=func.current_timestamp()
+    )
+)
+
+
+def _trigger(name):
+    """
+    The CREATE statement of one of the ledger or version triggers
+    """
+    (statement,) = [
+        statement
+        for statement in LEDGER_TRIGGERS + VERSION_TRIGGERS
+        if " {0} ".format(name) in statement
+    ]
+    return statement
+
+
+@contextmanager
+def insert_triggers_deferred(table, chunk_size=500, session=DBSession):
+    """
+    For bulk inserts into `table` (invoices or payments) in one
+    transaction: the ledger and version triggers firing on its inserts
+    are dropped for the length of the block and put back at its end. The
+    block gets a set to add the ids of the policies it wrote to; their
+    ledger entries are rebuilt from the raw tables and their versions
+    bumped once, chunk_size policies at a time. Nothing is committed;
+    SQLite DDL is transactional, rolling back puts the triggers back.
+    :param table: table name
+    :param chunk_size:
+    :param session:
+    :return:
+    """
+    connection = session.connection()
+    # pysqlite only opens a transaction by itself before DML, the DDL
+    # below must not run outside one.
+    if not connection.connection.in_transaction:
+        connection.execute("BEGIN IMMEDIATE")
+    names = ["ledger_{0}_insert".format(table), "version_{0}_insert".format(table)]
+    for name in names:
+        session.execute("DROP TRIGGER IF EXISTS {0}".format(name))
+    policy_ids = set()
+    yield policy_ids
+    for name in names:
+        session.execute(_trigger(name))
+
+    policy_ids = sorted(policy_ids)
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start : start + chunk_size]
+        session.execute(_DELETE_ENTRIES, {"policy_ids": chunk})
+        session.execute(
+            _REBUILD_ENTRIES,
+            {"invoice_policy_ids": chunk, "payment_policy_ids": chunk},
+        )
+        session.execute(_BUMP_VERSIONS, {"policy_ids": chunk})
+
+
+@contextmanager
+def ledger_suspended(session=DBSession):
+    """
+    For bulk loads: the ledger and policy version triggers are dropped for
+    the length of the block, then put back, every policy's version is
+    bumped (the block may have written to any) and the ledger is rebuilt
+    once from the raw tables, which commits
+    :param session:
+    :return:
+    """
+    for (name,) in session.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' "
+        "AND (name LIKE 'ledger_%' OR name LIKE 'version_%')"
+    ).fetchall():
+        session.execute("DROP TRIGGER {0}".format(name))
+    session.commit()
+    try:
+        yield
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        for statement in LEDGER_TRIGGERS + VERSION_TRIGGERS:
+            session.execute(statement)
+        session.execute(
+            "UPDATE policies SET version = version + 1, "
+            "modified_at = CURRENT_TIMESTAMP"
+        )
+        rebuild_ledger(session=session)
+
+
+def check_ledger(chunk_size=1000, session=DBSession):
+    """
+    Compare the ledger with the raw tables at every date either of them
+    knows about
+    :param chunk_size:
+    :param session:
+    :return: sorted ids of the policies whose ledger is wrong
+    """
+    mismatched = set()
+    for first_id, last_id in _id_ranges(session, chunk_size):
+        expected = {}
+        for policy_id, entry_date, balance in _raw_entries(
+            session, lambda column: column.between(first_id, last_id)
+        ):
+            expected.setdefault(policy_id, []).append((entry_date, balance))
+        actual = {}
+        for policy_id, entry_date, balance in (
+            session.query(
+                LedgerEntry.policy_id, LedgerEntry.entry_date, LedgerEntry.balance
+            )
+            .filter(LedgerEntry.policy_id.between(first_id, last_id))
+            .order_by(LedgerEntry.policy_id, LedgerEntry.entry_date)
+        ):
+            actual.setdefault(policy_id, []).append((entry_date, balance))
+
+        for policy_id in set(expected) | set(actual):
+            raw = PolicyLedger(expected.get(policy_id, []))
+            ledger = PolicyLedger(actual.get(policy_id, []))
+            # The ledger may keep entries whose rows were deleted since,
+            # so compare balances on every known date, not the rows.
+            for entry_date in set(raw.dates) | set(ledger.dates):
+                if raw.balance_on(entry_date) != ledger.balance_on(entry_date):
+                    mismatched.add(policy_id)
+                    break
+    session.rollback()
+    return sorted(mismatched)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Running balance ledger")
+    parser.add_argument("command", choices=["rebuild", "check"])
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print("{0} ledger entries written".format(rebuild_ledger(args.chunk_size)))
+    else:
+        mismatched = check_ledger(args.chunk_size)
+        for policy_id in mismatched:
+            print("ledger out of date for policy {0}".format(policy_id))
+        print("{0} policies out of date".format(len(mismatched)))
+        if mismatched:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
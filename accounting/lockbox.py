@@ -0,0 +1,368 @@
+import argparse
+import csv
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from itertools import groupby, islice
+from operator import attrgetter, itemgetter
+
+from sqlalchemy import INTEGER, bindparam, false, select, type_coerce
+
+from accounting.balances import cancellation_pending_invoice
+from accounting.cache import balance_cache
+from accounting.ledger import insert_triggers_deferred
+from accounting.models import Contact, Invoice, Payment, Policy
+from accounting.money import cents, from_cents, to_cents
+from accounting.sql_base import DBSession
+
+"""
+#######################################################
+Bulk payment ingestion from lockbox files.
+
+A lockbox file is a CSV with a policy_number, amount and
+transaction_date (YYYY-MM-DD) column per payment, plus an optional
+contact_id column (blank means the named insured, like make_payment).
+
+Rows are read in chunks. Each chunk resolves its policies and contacts
+with one IN query each, loads the invoices and payments of policies it
+has not seen yet, and applies make_payment's rules in memory, in file
+order: the policy must exist and not be canceled, the contact must
+exist, and only an agent can pay a policy that is cancellation pending
+due to non-pay. Accepted payments count towards the later rows of the
+same policy. Every accepted row is inserted with a Core executemany and
+the whole file is committed in one transaction; rejected rows come back
+in the report with their line number and the reason.
+
+The ledger and version triggers on payment inserts are dropped for the
+length of that transaction (see ledger.insert_triggers_deferred), the
+ledger entries and versions of the policies paid are brought up to
+date once at the end instead of once per row.
+#######################################################
+"""
+
+REQUIRED_COLUMNS = ("policy_number", "amount", "transaction_date")
+
+Rejection = namedtuple("Rejection", "line policy_number reason")
+
+# Invoices and payments as the non-pay walk in accounting.balances reads
+# them, amounts in cents.
+_Paid = namedtuple("_Paid", "transaction_date amount_paid")
+
+_Invoice = namedtuple(
+    "_Invoice", "id policy_id bill_date due_date cancel_date amount_due"
+)
+
+_ParsedRow = namedtuple(
+    "_ParsedRow", "line policy_number amount transaction_date contact_id"
+)
+
+# The lookups of a chunk. Expanding IN parameters compile the statements
+# once instead of once per chunk and id, amounts come back in cents.
+_POLICIES = select(
+    [Policy.id, Policy.policy_number, Policy.status, Policy.named_insured]
+).where(Policy.policy_number.in_(bindparam("policy_numbers", expanding=True)))
+
+_CONTACTS = select([Contact.id, Contact.role]).where(
+    Contact.id.in_(bindparam("contact_ids", expanding=True))
+)
+
+_INVOICES = (
+    select(
+        [
+            Invoice.id,
+            Invoice.policy_id,
+            Invoice.bill_date,
+            Invoice.due_date,
+            Invoice.cancel_date,
+            cents(Invoice.amount_due).label("amount_due"),
+        ]
+    )
+    .where(Invoice.policy_id.in_(bindparam("policy_ids", expanding=True)))
+    .where(Invoice.deleted == false())
+    .order_by(Invoice.policy_id, Invoice.bill_date, Invoice.id)
+)
+
+_PAYMENTS = (
+    select(
+        [
+            Payment.policy_id,
+            Payment.transaction_date,
+            cents(Payment.amount_paid).label("amount_paid"),
+        ]
+    )
+    .where(Payment.policy_id.in_(bindparam("policy_ids", expanding=True)))
+    .order_by(Payment.policy_id, Payment.transaction_date)
+)
+
+
+# Binds amount_paid as the integer cents the rows already hold.
+_INSERT_PAYMENT = Payment.__table__.insert().values(
+    amount_paid=type_coerce(bindparam("amount_cents"), INTEGER())
+)
+
+
+class IngestReport(object):
+    """
+    What an ingestion run did. `amount` is the accepted total in cents,
+    `rejected` holds a Rejection per refused row, in file order.
+    """
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.accepted = 0
+        self.amount = 0
+        self.rejected = []
+
+    def summary(self):
+        return "{0} payments {1} for {2}, {3} rejected".format(
+            self.accepted,
+            "accepted (dry run)" if self.dry_run else "posted",
+            from_cents(self.amount),
+            len(self.rejected),
+        )
+
+
+def read_lockbox(lines):
+    """
+    Yields (line number, row dict) for every payment of a lockbox file
+    :param lines: an open file or any iterable of CSV lines
+    :return:
+    """
+    reader = csv.DictReader(lines)
+    missing = [
+        column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or ())
+    ]
+    if missing:
+        raise UserWarning(
+            "Lockbox file is missing columns: {0}".format(", ".join(missing))
+        )
+    for row in reader:
+        yield reader.line_num, row
+
+
+def ingest_payments(lines, chunk_size=500, dry_run=False, session=DBSession):
+    """
+    Post the payments of a lockbox file
+    :param lines: an open file or any iterable of CSV lines
+    :param chunk_size: rows resolved per round of IN queries
+    :param dry_run: only report, do not write anything
+    :param session:
+    :return: IngestReport
+    """
+    report = IngestReport(dry_run)
+    rows = read_lockbox(lines)
+    # policy_id -> live invoices / payments, loaded the first time a
+    # chunk mentions the policy and kept up to date with accepted rows.
+    invoices = {}
+    payments = {}
+    try:
+        if dry_run:
+            _ingest_rows(session, rows, chunk_size, report, invoices, payments, None)
+            session.rollback()
+        else:
+            with insert_triggers_deferred("payments", session=session) as paid:
+                _ingest_rows(
+                    session, rows, chunk_size, report, invoices, payments, paid
+                )
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    if not dry_run:
+        # Core statements skip the ORM events that normally do this.
+        balance_cache.invalidate(paid)
+    return report
+
+
+def _ingest_rows(session, rows, chunk_size, report, invoices, payments, paid):
+    """
+    Check the rows chunk by chunk and insert the accepted ones
+    :param paid: set to add the ids of the policies paid to, None to
+        insert nothing
+    """
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        accepted = _ingest_chunk(session, chunk, report, invoices, payments)
+        if accepted and paid is not None:
+            session.execute(_INSERT_PAYMENT, accepted)
+            paid.update(row["policy_id"] for row in accepted)
+
+
+def _parse(line, row):
+    """
+    :return: _ParsedRow
+    :raise ValueError: with the rejection reason
+    """
+    policy_number = (row.get("policy_number") or "").strip()
+    if not policy_number:
+        raise ValueError("missing policy number")
+    try:
+        amount = Decimal((row.get("amount") or "").strip())
+    except InvalidOperation:
+        raise ValueError("bad amount {0!r}".format(row.get("amount")))
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError("amount must be positive")
+    try:
+        transaction_date = date.fromisoformat(
+            (row.get("transaction_date") or "").strip()
+        )
+    except ValueError:
+        raise ValueError(
+            "bad transaction date {0!r}".format(row.get("transaction_date"))
+        )
+    contact_id = (row.get("contact_id") or "").strip()
+    try:
+        contact_id = int(contact_id) if contact_id else None
+    except ValueError:
+        raise ValueError("bad contact id {0!r}".format(contact_id))
+    return _ParsedRow(line, policy_number, amount, transaction_date, contact_id)
+
+
+def _ingest_chunk(session, chunk, report, invoices, payments):
+    """
+    Check one chunk of rows and record the rejections
+    :return: Payment rows to insert, ready for an executemany
+    """
+    parsed = []
+    rejected = []
+    for line, row in chunk:
+        try:
+            parsed.append(_parse(line, row))
+        except ValueError as error:
+            rejected.append(Rejection(line, row.get("policy_number"), str(error)))
+    if not parsed:
+        report.rejected.extend(rejected)
+        return []
+
+    policies = {
+        policy.policy_number: policy
+        for policy in session.execute(
+            _POLICIES,
+            {"policy_numbers": sorted({row.policy_number for row in parsed})},
+        ).fetchall()
+    }
+    contact_ids = {row.contact_id for row in parsed if row.contact_id}
+    contact_ids.update(
+        policy.named_insured for policy in policies.values() if policy.named_insured
+    )
+    roles = {}
+    if contact_ids:
+        roles = dict(
+            session.execute(_CONTACTS, {"contact_ids": sorted(contact_ids)}).fetchall()
+        )
+    load_payment_history(
+        session,
+        [policy.id for policy in policies.values() if policy.id not in invoices],
+        invoices,
+        payments,
+    )
+
+    accepted = []
+    for row in parsed:
+        policy = policies.get(row.policy_number)
+        reason = None
+        if policy is None:
+            reason = "unknown policy number"
+        elif policy.status == "Canceled":
+            reason = "policy is canceled"
+        else:
+            contact_id = row.contact_id or policy.named_insured
+            if contact_id not in roles:
+                reason = "unknown contact {0}".format(contact_id)
+            elif roles[contact_id] != "Agent" and _past_due(
+                invoices[policy.id], payments[policy.id], row.transaction_date
+            ):
+                reason = "policy is past due, only an agent can make a payment"
+        if reason:
+            rejected.append(Rejection(row.line, row.policy_number, reason))
+            continue
+
+        amount_paid = to_cents(row.amount)
+        record_payment(payments[policy.id], row.transaction_date, amount_paid)
+        accepted.append(
+            {
+                "policy_id": policy.id,
+                "contact_id": contact_id,
+                "amount_cents": amount_paid,
+                "transaction_date": row.transaction_date,
+            }
+        )
+        report.accepted += 1
+        report.amount += amount_paid
+    report.rejected.extend(sorted(rejected))
+    return accepted
+
+
+def _past_due(invoices, payments, date_cursor):
+    """
+    evaluate_cancellation_pending_due_to_non_pay on loaded rows
+    """
+    return cancellation_pending_invoice(invoices, payments, date_cursor) is not None
+
+
+def record_payment(payments, transaction_date, amount_paid):
+    """
+    Add an accepted payment to the loaded payments of its policy, which
+    stay in transaction date order
+    :param payments: list filled by load_payment_history
+    :param transaction_date:
+    :param amount_paid: cents
+    """
+    payments.append(_Paid(transaction_date, amount_paid))
+    if len(payments) > 1 and payments[-2].transaction_date > transaction_date:
+        payments.sort(key=attrgetter("transaction_date"))
+
+
+def load_payment_history(session, policy_ids, invoices, payments):
+    """
+    Fetch the live invoices and the payments of policies with one IN
+    query each, amounts in integer cents, for the non-pay walks in
+    accounting.balances
+    :param session:
+    :param policy_ids:
+    :param invoices: dict filled with policy_id -> sorted invoices
+    :param payments: dict filled with policy_id -> sorted payments
+    """
+    for policy_id in policy_ids:
+        invoices[policy_id] = []
+        payments[policy_id] = []
+    if not policy_ids:
+        return
+    # Plain tuples, the non-pay walks read these attributes over and over.
+    rows = session.execute(_INVOICES, {"policy_ids": policy_ids}).fetchall()
+    for policy_id, group in groupby(rows, key=itemgetter(1)):
+        invoices[policy_id] = [_Invoice(*row) for row in group]
+    rows = session.execute(_PAYMENTS, {"policy_ids": policy_ids}).fetchall()
+    for policy_id, group in groupby(rows, key=itemgetter(0)):
+        payments[policy_id] = [_Paid(*row[1:]) for row in group]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post a lockbox payment file")
+    parser.add_argument("path", help="lockbox CSV file")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only report, do not post"
+    )
+    parser.add_argument("--rejects", help="write the rejected rows to this CSV file")
+    args = parser.parse_args()
+
+    with open(args.path, newline="") as lines:
+        report = ingest_payments(
+            lines, chunk_size=args.chunk_size, dry_run=args.dry_run
+        )
+    if args.rejects:
+        with open(args.rejects, "w", newline="") as output:
+            writer = csv.writer(output)
+            writer.writerow(Rejection._fields)
+            writer.writerows(report.rejected)
+    else:
+        for rejection in report.rejected:
+            print("line {0} {1}: {2}".format(*rejection))
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from sqlalchemy import event
+
+"""
+#######################################################
+Built-in instrumentation.
+
+Off unless enable() is called (ACCOUNTING_METRICS=1 does it when the app
+starts). While off, no SQLAlchemy listener is registered and the
+PolicyAccounting methods are the plain ones, so the only cost left is a
+flag check in the Flask request hooks and in section().
+
+Once enabled:
+
+  - every SQL statement is counted and timed, attributed to the section
+    running it: the innermost PolicyAccounting method, a block of a view
+    wrapped in section(), or else the Flask endpoint
+  - every section is timed
+  - the request hooks in accounting.views time every request per
+    endpoint, method and status (streamed bodies are not included)
+
+render() returns it all in the Prometheus text format, see /metrics.
+#######################################################
+"""
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name -> (type, help), in the order render() writes them.
+METRICS = (
+    (
+        "accounting_http_request_duration_seconds",
+        "histogram",
+        "Time spent serving a request, body streaming excluded.",
+    ),
+    (
+        "accounting_section_duration_seconds",
+        "histogram",
+        "Time spent in a PolicyAccounting method or view section.",
+    ),
+    (
+        "accounting_sql_statements_total",
+        "counter",
+        "SQL statements executed, by the section running them.",
+    ),
+    (
+        "accounting_sql_duration_seconds",
+        "histogram",
+        "Time spent executing SQL statements, by the section running them.",
+    ),
+)
+
+# PolicyAccounting methods timed as sections while metrics are enabled.
+INSTRUMENTED_METHODS = (
+    "__init__",
+    "return_account_balance",
+    "make_payment",
+    "evaluate_cancellation_pending_due_to_non_pay",
+    "find_cancellation_pending_invoice",
+    "evaluate_cancel",
+    "find_cancel_invoice",
+    "switch_billing_schedule",
+    "make_invoices",
+    "cancel_policy",
+)
+
+DEFAULT_SECTION = "other"
+
+
+class Histogram(object):
+    """
+    Bucket counts (the last bucket is +Inf), sum and count of observations
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """
+    Counters and histograms keyed by metric name and a tuple of
+    (label, value) pairs
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, labels):
+        with self._lock:
+            return self._counters.get((name, labels), 0)
+
+    def histogram(self, name, labels):
+        with self._lock:
+            return self._histograms.get((name, labels))
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format
+        :return:
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count))
+                for key, h in self._histograms.items()
+            )
+        lines = []
+        for name, kind, help_text in METRICS:
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for (sample, labels), value in counters:
+                if sample == name:
+                    lines.append(_sample(name, labels, value))
+            for (sample, labels), (counts, total, count) in histograms:
+                if sample != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        _sample(
+                            name + "_bucket", labels + (("le", str(bound)),), cumulative
+                        )
+                    )
+                lines.append(_sample(name + "_sum", labels, total))
+                lines.append(_sample(name + "_count", labels, count))
+        return "\n".join(lines) + "\n"
+
+
+def _sample(name, labels, value):
+    if not labels:
+        return "{0} {1}".format(name, value)
+    return "{0}{{{1}}} {2}".format(
+        name,
+        ",".join(
+            '{0}="{1}"'.format(label, _escape(label_value))
+            for label, label_value in labels
+        ),
+        value,
+    )
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+_state = {"enabled": False, "engine": None, "methods": {}}
+_local = threading.local()
+
+
+def enabled():
+    return _state["enabled"]
+
+
+def enable(engine=None):
+    """
+    Start counting: listen to the cursor events of `engine` (the
+    application engine by default) and time the PolicyAccounting methods
+    :param engine:
+    :return:
+    """
+    if _state["enabled"]:
+        return
+    from accounting.sql_base import get_engine
+    from accounting.utils import PolicyAccounting
+
+    engine = engine or get_engine()
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    for name in INSTRUMENTED_METHODS:
+        method = PolicyAccounting.__dict__[name]
+        _state["methods"][name] = method
+        setattr(PolicyAccounting, name, _instrumented(method, "PolicyAccounting"))
+    _state.update(enabled=True, engine=engine)
+
+
+def disable():
+    """
+    Undo enable(). Collected metrics are kept, see registry.clear()
+    """
+    if not _state["enabled"]:
+        return
+    from accounting.utils import PolicyAccounting
+
+    engine = _state["engine"]
+    event.remove(engine, "before_cursor_execute", _before_cursor_execute)
+    event.remove(engine, "after_cursor_execute", _after_cursor_execute)
+    for name, method in _state["methods"].items():
+        setattr(PolicyAccounting, name, method)
+    _state.update(enabled=False, engine=None, methods={})
+
+
+def section(name):
+    """
+    Context manager timing a block and attributing its SQL to `name`,
+    a no-op while metrics are disabled
+    :param name:
+    :return:
+    """
+    if not _state["enabled"]:
+        return nullcontext()
+    return _timed_section(name)
+
+
+@contextmanager
+def _timed_section(name):
+    sections = _sections()
+    sections.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(
+            "accounting_section_duration_seconds",
+            (("section", name),),
+            time.perf_counter() - start,
+        )
+        sections.pop()
+
+
+def _sections():
+    sections = getattr(_local, "sections", None)
+    if sections is None:
+        sections = _local.sections = []
+    return sections
+
+
+def _instrumented(method, owner):
+    name = "{0}.{1}".format(owner, method.__name__)
+
+    @wraps(method)
+    def instrumented(*args, **kwargs):
+        with _timed_section(name):
+            return method(*args, **kwargs)
+
+    return instrumented
+
+
+def request_started(endpoint):
+    """
+    Flask before_request: the endpoint is the section of the request's
+    SQL until a narrower one starts
+    """
+    _local.request = (endpoint or DEFAULT_SECTION, time.perf_counter())
+    _sections().append(_local.request[0])
+
+
+def request_finished(method, status):
+    """
+    Flask after_request: record the request latency
+    """
+    endpoint, start = getattr(_local, "request", (None, None))
+    if start is None:
+        return
+    registry.observe(
+        "accounting_http_request_duration_seconds",
+        (("endpoint", endpoint), ("method", method), ("status", str(status))),
+        time.perf_counter() - start,
+    )
+
+
+def request_torn_down():
+    """
+    Flask teardown_request: forget the request, streamed bodies included
+    """
+    _local.request = (None, None)
+    _local.sections = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["metrics_query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("metrics_query_start", None)
+    if start is None:
+        # Started before enable()
+        return
+    elapsed = time.perf_counter() - start
+    sections = getattr(_local, "sections", None)
+    labels = (("section", sections[-1] if sections else DEFAULT_SECTION),)
+    registry.inc("accounting_sql_statements_total", labels)
+    registry.observe("accounting_sql_duration_seconds", labels, elapsed)
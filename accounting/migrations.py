@@ -0,0 +1,245 @@
+from sqlalchemy import MetaData, func, inspect, select
+from sqlalchemy.schema import CreateTable
+
+from accounting.ledger import rebuild_ledger
+from accounting.models import (
+    LEDGER_TRIGGERS,
+    VERSION_TRIGGERS,
+    Base,
+    Contact,
+    Policy,
+)
+from accounting.sql_base import Session, get_engine
+
+"""
+#######################################################
+Schema migrations for existing databases.
+
+Importing the models creates nothing: upgrade() creates a new database,
+or brings an older accounting.sqlite up to the current models, and is
+safe to run any number of times. create_all only creates missing tables;
+it never touches tables that already exist, and only installs the
+triggers on a new database. Data migrations are tracked with SQLite's
+PRAGMA user_version (SCHEMA_VERSION in accounting.models), each one
+installs the triggers of its schema version:
+
+    python -m accounting.migrations
+#######################################################
+"""
+
+
+def _duplicate_policy_numbers(bind):
+    return [
+        policy_number
+        for policy_number, in bind.execute(
+            select([Policy.policy_number])
+            .group_by(Policy.policy_number)
+            .having(func.count(Policy.id) > 1)
+        )
+    ]
+
+
+def create_missing_indexes(bind=None):
+    """
+    Create every index declared on the models that the database lacks
+    :param bind:
+    :return: names of the indexes created
+    """
+    bind = bind or get_engine()
+    duplicates = _duplicate_policy_numbers(bind)
+    if duplicates:
+        raise UserWarning(
+            "Policy numbers must be unique before migrating, duplicated: "
+            "{0}".format(", ".join(duplicates))
+        )
+
+    inspector = inspect(bind)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(bind)
+                created.append(index.name)
+    if created:
+        # Give the query planner statistics for the new indexes.
+        bind.execute("ANALYZE")
+    return created
+
+
+# Columns that held whole dollars before schema version 1.
+MONEY_COLUMNS = (
+    ("policies", "annual_premium"),
+    ("invoices", "amount_due"),
+    ("payments", "amount_paid"),
+)
+
+
+def schema_version(bind=None):
+    bind = bind or get_engine()
+    return bind.execute("PRAGMA user_version").scalar()
+
+
+def _drop_triggers(connection, prefix):
+    for (name,) in connection.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'trigger' AND name LIKE '{0}%'".format(prefix)
+    ).fetchall():
+        connection.execute("DROP TRIGGER {0}".format(name))
+
+
+def migrate_money_to_cents(bind=None):
+    """
+    Version 1: store money as integer cents. Dollar amounts (including
+    the fractional ones float division left behind) are rounded to the
+    cent and the ledger is rebuilt from the converted rows.
+    :param bind:
+    :return: True if the database was migrated
+    """
+    bind = bind or get_engine()
+    if schema_version(bind) >= 1:
+        return False
+    with bind.begin() as connection:
+        for table, column in MONEY_COLUMNS:
+            connection.execute(
+                "UPDATE {0} SET {1} = CAST(ROUND({1} * 100) AS INTEGER)".format(
+                    table, column
+                )
+            )
+        connection.execute("PRAGMA user_version = 1")
+    _rebuild_ledger(bind)
+    return True
+
+
+def migrate_live_ledger(bind=None):
+    """
+    Version 2: soft-deleted invoices no longer count towards balances.
+    The ledger triggers are recreated with the live invoice condition
+    and the ledger is rebuilt from the live rows.
+    :param bind:
+    :return: True if the database was migrated
+    """
+    bind = bind or get_engine()
+    if schema_version(bind) >= 2:
+        return False
+    with bind.begin() as connection:
+        _drop_triggers(connection, "ledger_")
+        for statement in LEDGER_TRIGGERS:
+            connection.execute(statement)
+        connection.execute("PRAGMA user_version = 2")
+    _rebuild_ledger(bind)
+    return True
+
+
+def add_policy_version_columns(bind=None):
+    """
+    The version and modified_at columns of policies, which create_all
+    does not add to an existing table. upgrade() adds them before any
+    data migration, so nothing written against the current models trips
+    over their absence.
+    :param bind:
+    :return: names of the columns added
+    """
+    bind = bind or get_engine()
+    columns = {column["name"] for column in inspect(bind).get_columns("policies")}
+    added = []
+    with bind.begin() as connection:
+        if "version" not in columns:
+            connection.execute(
+                "ALTER TABLE policies ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+            )
+            added.append("version")
+        if "modified_at" not in columns:
+            connection.execute("ALTER TABLE policies ADD COLUMN modified_at DATETIME")
+            added.append("modified_at")
+    return added
+
+
+def migrate_policy_versions(bind=None):
+    """
+    Version 3: policies get the version and modified_at columns, and the
+    triggers bumping them on every write to their invoices and payments.
+    Existing policies start at version 0 with no modification date.
+    :param bind:
+    :return: True if the database was migrated
+    """
+    bind = bind or get_engine()
+    if schema_version(bind) >= 3:
+        return False
+    add_policy_version_columns(bind)
+    with bind.begin() as connection:
+        for statement in VERSION_TRIGGERS:
+            connection.execute(statement)
+        connection.execute("PRAGMA user_version = 3")
+    return True
+
+
+def migrate_semi_annual_schedule(bind=None):
+    """
+    Version 4: policies accept the Semi-Annual billing schedule. SQLite
+    cannot change the CHECK constraint of a column, so the policies table
+    is rebuilt from the current model and its rows copied over, along
+    with its index and the version triggers that name it.
+    :param bind:
+    :return: True if the database was migrated
+    """
+    bind = bind or get_engine()
+    if schema_version(bind) >= 4:
+        return False
+    metadata = MetaData()
+    Contact.__table__.tometadata(metadata)
+    rebuilt = Policy.__table__.tometadata(metadata, name="policies_new")
+    columns = ", ".join(column.name for column in Policy.__table__.columns)
+    with bind.begin() as connection:
+        connection.execute("DROP TABLE IF EXISTS policies_new")
+        connection.execute(CreateTable(rebuilt))
+        connection.execute(
+            "INSERT INTO policies_new ({0}) SELECT {0} FROM policies".format(columns)
+        )
+        # Renaming checks every trigger, these would name a missing table.
+        _drop_triggers(connection, "version_")
+        connection.execute("DROP TABLE policies")
+        connection.execute("ALTER TABLE policies_new RENAME TO policies")
+        for index in Policy.__table__.indexes:
+            index.create(connection)
+        for statement in VERSION_TRIGGERS:
+            connection.execute(statement)
+        connection.execute("PRAGMA user_version = 4")
+    return True
+
+
+# In schema version order, see SCHEMA_VERSION in accounting.models.
+MIGRATIONS = (
+    migrate_money_to_cents,
+    migrate_live_ledger,
+    migrate_policy_versions,
+    migrate_semi_annual_schedule,
+)
+
+
+def _rebuild_ledger(bind):
+    session = Session(bind=bind)
+    try:
+        rebuild_ledger(session=session)
+    finally:
+        session.close()
+
+
+def upgrade(bind=None):
+    """
+    Bring the database up to the current schema
+    :param bind:
+    :return: names of the indexes created
+    """
+    bind = bind or get_engine()
+    Base.metadata.create_all(bind)
+    add_policy_version_columns(bind)
+    for migration in MIGRATIONS:
+        migration(bind)
+    return create_missing_indexes(bind)
+
+
+if __name__ == "__main__":
+    for name in upgrade():
+        print("created index {0}".format(name))
+    print("Database up to date")
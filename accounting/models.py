@@ -1,17 +1,27 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, VARCHAR, INTEGER, DATE, Enum, ForeignKey, Boolean
+from sqlalchemy import DATETIME
+from sqlalchemy import DDL, Index, event, text
 from sqlalchemy.orm import relation
-from sqlalchemy import create_engine
-from accounting.config import SQLALCHEMY_DATABASE_URI
+from accounting.money import Money, json_amount
 
 
 Base = declarative_base()
 
+# PRAGMA user_version of a database created by these models, see
+# accounting.migrations. 1: money columns hold integer cents. 2: the
+# ledger only counts live (not soft-deleted) invoices. 3: policies carry
+# a version their invoice and payment writes bump. 4: policies accept the
+# Semi-Annual billing schedule.
+SCHEMA_VERSION = 4
+
 
 class Policy(Base):
     __tablename__ = "policies"
 
-    __table_args__ = {}
+    __table_args__ = (
+        Index("ix_policies_policy_number", "policy_number", unique=True),
+    )
 
     # column definitions
     id = Column(u"id", INTEGER(), primary_key=True, nullable=False)
@@ -25,17 +35,23 @@ class Policy(Base):
     )
     billing_schedule = Column(
         u"billing_schedule",
-        Enum(u"Annual", u"Two-Pay", u"Quarterly", u"Monthly"),
+        Enum(u"Annual", u"Two-Pay", u"Semi-Annual", u"Quarterly", u"Monthly"),
         default=u"Annual",
         nullable=False,
     )
-    annual_premium = Column(u"annual_premium", INTEGER(), nullable=False)
+    annual_premium = Column(u"annual_premium", Money(), nullable=False)
     named_insured = Column(u"named_insured", INTEGER(), ForeignKey("contacts.id"))
     agent = Column(u"agent", INTEGER(), ForeignKey("contacts.id"))
     cancel_date = Column(u"cancel_date", DATE(), nullable=True, default=None)
     cancel_reason = Column(
         u"cancel_reason", VARCHAR(length=128), nullable=True, default=None
     )
+    # Maintained by VERSION_TRIGGERS, for the ETag and Last-Modified
+    # headers of the invoices endpoint.
+    version = Column(
+        u"version", INTEGER(), default=0, server_default="0", nullable=False
+    )
+    modified_at = Column(u"modified_at", DATETIME(), nullable=True, default=None)
 
     def __init__(self, policy_number, effective_date, annual_premium):
         self.policy_number = policy_number
@@ -44,7 +60,10 @@ class Policy(Base):
 
     invoices = relation(
         "Invoice",
-        primaryjoin="and_(Invoice.policy_id==Policy.id, Invoice.deleted == 0)",
+        # false() renders a literal 0, which lets SQLite use the partial
+        # index on live invoices (a bound parameter would not match it).
+        primaryjoin="and_(Invoice.policy_id==Policy.id, "
+        "Invoice.deleted == false())",
     )
 
 
@@ -66,7 +85,18 @@ class Contact(Base):
 class Invoice(Base):
     __tablename__ = "invoices"
 
-    __table_args__ = {}
+    __table_args__ = (
+        Index("ix_invoices_policy_id_bill_date", "policy_id", "bill_date"),
+        Index("ix_invoices_policy_id_due_date", "policy_id", "due_date"),
+        Index("ix_invoices_policy_id_cancel_date", "policy_id", "cancel_date"),
+        # Live invoices only, for Policy.invoices
+        Index(
+            "ix_invoices_live_policy_id_bill_date",
+            "policy_id",
+            "bill_date",
+            sqlite_where=text("deleted = 0"),
+        ),
+    )
 
     # column definitions
     id = Column(u"id", INTEGER(), primary_key=True, nullable=False)
@@ -76,7 +106,7 @@ class Invoice(Base):
     bill_date = Column(u"bill_date", DATE(), nullable=False)
     due_date = Column(u"due_date", DATE(), nullable=False)
     cancel_date = Column(u"cancel_date", DATE(), nullable=False)
-    amount_due = Column(u"amount_due", INTEGER(), nullable=False)
+    amount_due = Column(u"amount_due", Money(), nullable=False)
     deleted = Column(
         u"deleted", Boolean, default=False, server_default="0", nullable=False
     )
@@ -93,14 +123,18 @@ class Invoice(Base):
             "id": self.id,
             "bill_date": self.bill_date.strftime("%Y-%m-%d"),
             "due_date": self.due_date.strftime("%Y-%m-%d"),
-            "amount_due": self.amount_due,
+            "amount_due": json_amount(self.amount_due),
         }
 
 
 class Payment(Base):
     __tablename__ = "payments"
 
-    __table_args__ = {}
+    __table_args__ = (
+        Index(
+            "ix_payments_policy_id_transaction_date", "policy_id", "transaction_date"
+        ),
+    )
 
     # column definitions
     id = Column(u"id", INTEGER(), primary_key=True, nullable=False)
@@ -110,7 +144,7 @@ class Payment(Base):
     contact_id = Column(
         u"contact_id", INTEGER(), ForeignKey("contacts.id"), nullable=False
     )
-    amount_paid = Column(u"amount_paid", INTEGER(), nullable=False)
+    amount_paid = Column(u"amount_paid", Money(), nullable=False)
     transaction_date = Column(u"transaction_date", DATE(), nullable=False)
 
     def __init__(self, policy_id, contact_id, amount_paid, transaction_date):
@@ -120,5 +154,160 @@ class Payment(Base):
         self.transaction_date = transaction_date
 
 
-engine = create_engine(SQLALCHEMY_DATABASE_URI)
-Base.metadata.create_all(engine)
+class LedgerEntry(Base):
+    """
+    Running balance of a policy at every date an invoice is billed or a
+    payment is made, in integer cents. Maintained by the triggers below,
+    rebuilt and checked with accounting.ledger.
+    """
+
+    __tablename__ = "ledger_entries"
+
+    __table_args__ = (
+        Index(
+            "ix_ledger_entries_policy_id_entry_date",
+            "policy_id",
+            "entry_date",
+            unique=True,
+        ),
+    )
+
+    # column definitions
+    id = Column(u"id", INTEGER(), primary_key=True, nullable=False)
+    policy_id = Column(
+        u"policy_id", INTEGER(), ForeignKey("policies.id"), nullable=False
+    )
+    entry_date = Column(u"entry_date", DATE(), nullable=False)
+    balance = Column(u"balance", INTEGER(), nullable=False)
+
+    def __init__(self, policy_id, entry_date, balance):
+        self.policy_id = policy_id
+        self.entry_date = entry_date
+        self.balance = balance
+
+
+class InvoiceArchive(Base):
+    """
+    Soft-deleted invoices moved out of the invoices table by
+    accounting.archive. Invoice ids can be reused once archived, so the
+    archive keeps them in invoice_id next to its own key.
+    """
+
+    __tablename__ = "invoices_archive"
+
+    __table_args__ = (Index("ix_invoices_archive_policy_id", "policy_id"),)
+
+    # column definitions
+    id = Column(u"id", INTEGER(), primary_key=True, nullable=False)
+    invoice_id = Column(u"invoice_id", INTEGER(), nullable=False)
+    policy_id = Column(
+        u"policy_id", INTEGER(), ForeignKey("policies.id"), nullable=False
+    )
+    bill_date = Column(u"bill_date", DATE(), nullable=False)
+    due_date = Column(u"due_date", DATE(), nullable=False)
+    cancel_date = Column(u"cancel_date", DATE(), nullable=False)
+    amount_due = Column(u"amount_due", Money(), nullable=False)
+    archived_at = Column(u"archived_at", DATETIME(), nullable=False)
+
+
+def _ledger_apply(row, day, amount):
+    """
+    Trigger body adding `amount` to the running balance of policy
+    `row`.policy_id from `day` on, creating the entry for `day` if needed
+    """
+    return """
+    INSERT OR IGNORE INTO ledger_entries (policy_id, entry_date, balance)
+    VALUES ({row}.policy_id, {row}.{day}, COALESCE((
+        SELECT balance FROM ledger_entries
+        WHERE policy_id = {row}.policy_id AND entry_date < {row}.{day}
+        ORDER BY entry_date DESC LIMIT 1), 0));
+    UPDATE ledger_entries SET balance = balance + ({amount})
+    WHERE policy_id = {row}.policy_id AND entry_date >= {row}.{day};
+    """.format(
+        row=row, day=day, amount=amount
+    )
+
+
+def _ledger_triggers(table, day, amount, sign, live=None):
+    """
+    Triggers keeping the ledger in step with `table`; `sign` is 1 for
+    rows adding to the balance and -1 for rows paying it off. `live`,
+    when given, is the condition ({row} being NEW or OLD) for a row to
+    count at all.
+    """
+
+    def when(row):
+        return " WHEN " + live.format(row=row) if live else ""
+
+    new = "{0} * NEW.{1}".format(sign, amount)
+    old = "{0} * OLD.{1}".format(-sign, amount)
+    return [
+        "CREATE TRIGGER IF NOT EXISTS ledger_{0}_insert AFTER INSERT ON {0}{1} "
+        "BEGIN {2} END".format(table, when("NEW"), _ledger_apply("NEW", day, new)),
+        "CREATE TRIGGER IF NOT EXISTS ledger_{0}_delete AFTER DELETE ON {0}{1} "
+        "BEGIN {2} END".format(table, when("OLD"), _ledger_apply("OLD", day, old)),
+        "CREATE TRIGGER IF NOT EXISTS ledger_{0}_update_old AFTER UPDATE ON {0}{1} "
+        "BEGIN {2} END".format(table, when("OLD"), _ledger_apply("OLD", day, old)),
+        "CREATE TRIGGER IF NOT EXISTS ledger_{0}_update_new AFTER UPDATE ON {0}{1} "
+        "BEGIN {2} END".format(table, when("NEW"), _ledger_apply("NEW", day, new)),
+    ]
+
+
+# The ledger is kept current by the database itself, so ORM flushes,
+# Core executemany calls and bulk Query.update/delete are all covered.
+# Soft-deleting an invoice takes it off the ledger like a delete would.
+LEDGER_TRIGGERS = _ledger_triggers(
+    "invoices", "bill_date", "amount_due", 1, live="{row}.deleted = 0"
+) + _ledger_triggers("payments", "transaction_date", "amount_paid", -1)
+
+
+def _version_triggers(table):
+    """
+    Triggers bumping the version of the policy of every row of `table`
+    written, both policies' when an update moves a row to another one
+    """
+    bump = (
+        "UPDATE policies SET version = version + 1, "
+        "modified_at = CURRENT_TIMESTAMP WHERE id IN ({0});"
+    )
+    return [
+        "CREATE TRIGGER IF NOT EXISTS version_{0}_insert AFTER INSERT ON {0} "
+        "BEGIN {1} END".format(table, bump.format("NEW.policy_id")),
+        "CREATE TRIGGER IF NOT EXISTS version_{0}_delete AFTER DELETE ON {0} "
+        "BEGIN {1} END".format(table, bump.format("OLD.policy_id")),
+        "CREATE TRIGGER IF NOT EXISTS version_{0}_update AFTER UPDATE ON {0} "
+        "BEGIN {1} END".format(table, bump.format("OLD.policy_id, NEW.policy_id")),
+    ]
+
+
+# Anything the invoices endpoint answers (the balance, the live invoices)
+# changes with these rows only.
+VERSION_TRIGGERS = _version_triggers("invoices") + _version_triggers("payments")
+
+
+def _new_database(ddl, target, bind, tables=None, **kw):
+    """
+    Whether create_all just made the policies table, i.e. a new database.
+    An existing one gets its triggers from accounting.migrations, in
+    schema version order: a trigger written against the current schema
+    can break the data migrations of an older one.
+    """
+    return tables is not None and Policy.__table__ in tables
+
+
+for _statement in LEDGER_TRIGGERS + VERSION_TRIGGERS:
+    event.listen(
+        Base.metadata,
+        "after_create",
+        DDL(_statement).execute_if(dialect="sqlite", callable_=_new_database),
+    )
+
+# A new database starts at the current schema version, so migrations
+# meant for older ones skip it.
+event.listen(
+    Policy.__table__,
+    "after_create",
+    DDL("PRAGMA user_version = {0}".format(SCHEMA_VERSION)).execute_if(
+        dialect="sqlite"
+    ),
+)
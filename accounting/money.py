@@ -0,0 +1,126 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from sqlalchemy import INTEGER, type_coerce
+from sqlalchemy.types import TypeDecorator
+
+"""
+#######################################################
+Money as integer cents.
+
+Amounts are stored as INTEGER cents (policies.annual_premium,
+invoices.amount_due, payments.amount_paid, ledger_entries.balance). The
+Money column type keeps the Python side of the models in Decimal
+dollars, so Policy(..., 1200) still means $1200.00, while the hot paths
+(the ledger and its triggers, the sweep) read the raw cents through
+cents() and add plain ints. Decimals are only built at the edges.
+
+A premium split into installments puts the cents that do not divide
+evenly on the first installment: $1600 monthly is one $133.37 invoice
+followed by eleven $133.33 ones.
+#######################################################
+"""
+
+CENT = Decimal("0.01")
+
+
+def to_cents(amount):
+    """
+    Dollars (int, Decimal, float or numeric string) to integer cents,
+    rounding half cents up
+    :param amount:
+    :return:
+    """
+    if isinstance(amount, int):
+        return amount * 100
+    if isinstance(amount, float):
+        # repr gives the shortest decimal that round trips, 0.1 -> "0.1"
+        amount = repr(amount)
+    return int(Decimal(amount).quantize(CENT, rounding=ROUND_HALF_UP).scaleb(2))
+
+
+def from_cents(cents):
+    """
+    Integer cents to Decimal dollars: 60000 -> Decimal("600"),
+    13337 -> Decimal("133.37")
+    :param cents:
+    :return:
+    """
+    return Decimal(cents) / 100
+
+
+def split_cents(total, installments):
+    """
+    Split `total` cents into `installments` amounts that add up to it,
+    the remainder going to the first one
+    :param total:
+    :param installments:
+    :return:
+    """
+    share, remainder = divmod(total, installments)
+    return [share + remainder] + [share] * (installments - 1)
+
+
+def installment_amounts(annual_premium, installments):
+    """
+    Decimal dollar amounts of the installments of a premium
+    :param annual_premium: dollars
+    :param installments:
+    :return:
+    """
+    return [
+        from_cents(cents)
+        for cents in split_cents(to_cents(annual_premium), installments)
+    ]
+
+
+def json_amount(amount):
+    """
+    A dollar amount as a JSON number: an int when it is whole
+    :param amount:
+    :return:
+    """
+    if amount == amount.to_integral_value():
+        return int(amount)
+    return float(amount)
+
+
+def json_cents(cents):
+    """
+    Integer cents as the JSON number json_amount(from_cents(cents))
+    gives, without building a Decimal
+    :param cents:
+    :return:
+    """
+    dollars, remainder = divmod(cents, 100)
+    if not remainder:
+        return dollars
+    # int / int is correctly rounded, the same float as float(Decimal).
+    return cents / 100
+
+
+def cents(column):
+    """
+    `column` read as the raw integer cents instead of Decimal dollars,
+    for SQL aggregates and hot loops
+    :param column: a Money column
+    :return:
+    """
+    return type_coerce(column, INTEGER())
+
+
+class Money(TypeDecorator):
+    """
+    INTEGER cents in the database, Decimal dollars in Python
+    """
+
+    impl = INTEGER
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return to_cents(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return from_cents(value)
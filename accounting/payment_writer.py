@@ -0,0 +1,339 @@
+import queue
+import threading
+import time
+from concurrent import futures
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm.exc import NoResultFound
+
+from accounting import config
+from accounting.balances import as_date, cancellation_pending_invoice
+from accounting.lockbox import load_payment_history, record_payment
+from accounting.models import Contact, Payment, Policy
+from accounting.money import to_cents
+from accounting.sql_base import Session
+from accounting.utils import refuse_canceled
+
+"""
+#######################################################
+Group commit for payments.
+
+SQLite has a single writer, and every commit of
+PolicyAccounting.make_payment waits for its own fsync. A PaymentWriter
+takes payments from any number of threads on a bounded queue and one
+writer thread commits them in groups: a group closes once it holds
+max_batch payments or max_delay seconds after its first one arrived,
+whichever comes first, and the whole group shares one transaction and
+one fsync. The writer only waits for company when the previous group
+had some (like PostgreSQL's commit_siblings), a lone caller does not
+pay the delay.
+
+Each group is checked with make_payment's rules, in the order the
+payments were submitted: the policy must exist and not be canceled, the
+contact (the named insured by default) must exist, and only an agent
+can pay a policy that is cancellation pending due to non-pay. Earlier
+payments of the group count towards the later ones. A refused payment
+fails its own future with the exception make_payment would have raised,
+the rest of the group is still written. A future only resolves, with the
+id of the payment, once the group is committed. Whatever goes wrong
+while writing a group fails the futures of the whole group and the
+writer carries on with the next one.
+
+    with PaymentWriter() as writer:
+        payment_id = writer.make_payment(policy_id, amount=Decimal("365"))
+
+Unlike PolicyAccounting, the writer does not bill a policy that has no
+invoices yet.
+#######################################################
+"""
+
+# Tells the writer thread to finish what is queued and exit.
+_STOP = object()
+
+_POLICIES = select(
+    [
+        Policy.id,
+        Policy.status,
+        Policy.cancel_date,
+        Policy.cancel_reason,
+        Policy.named_insured,
+    ]
+).where(Policy.id.in_(bindparam("policy_ids", expanding=True)))
+
+_CONTACTS = select([Contact.id, Contact.role]).where(
+    Contact.id.in_(bindparam("contact_ids", expanding=True))
+)
+
+
+class _Request(object):
+    __slots__ = ("policy_id", "contact_id", "amount", "date_cursor", "future")
+
+    def __init__(self, policy_id, contact_id, amount, date_cursor):
+        self.policy_id = policy_id
+        self.contact_id = contact_id
+        self.amount = amount
+        self.date_cursor = date_cursor
+        self.future = futures.Future()
+
+
+class PaymentWriter(object):
+    """
+    Bounded payment queue drained by one writer thread, see the module
+    docstring
+    """
+
+    def __init__(
+        self,
+        max_batch=None,
+        max_delay=None,
+        max_queue=None,
+        session_factory=Session,
+    ):
+        """
+        :param max_batch: most payments committed together
+        :param max_delay: seconds a group waits for more payments
+        :param max_queue: most payments waiting to be written
+        :param session_factory: makes the writer thread's session
+        """
+        self.max_batch = max_batch or config.PAYMENT_WRITER_MAX_BATCH
+        self.max_delay = (
+            config.PAYMENT_WRITER_MAX_DELAY if max_delay is None else max_delay
+        )
+        self.session_factory = session_factory
+        self._queue = queue.Queue(max_queue or config.PAYMENT_WRITER_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.groups = 0
+        self.written = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self._run, name="payment-writer", daemon=True
+                )
+                self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Write what is already queued, then stop the writer thread
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+        if thread.is_alive():
+            self._queue.put(_STOP)
+        thread.join()
+        # Only left behind if the thread died, never leave a caller waiting.
+        left = []
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not _STOP and request.future.set_running_or_notify_cancel():
+                left.append(request)
+        _fail(left, UserWarning("The payment writer stopped"))
+        with self._lock:
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def submit(
+        self, policy_id, contact_id=0, date_cursor=None, amount=Decimal(0), timeout=None
+    ):
+        """
+        Queue a payment, waiting for room in the queue when it is full
+        :param policy_id:
+        :param contact_id: 0 for the named insured
+        :param date_cursor: transaction date (default today)
+        :param amount:
+        :param timeout: seconds to wait for room, None waits as long as
+            it takes
+        :return: concurrent.futures.Future of the payment id
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        request = _Request(policy_id, contact_id, amount, as_date(date_cursor))
+        # Under the lock, so nothing is queued behind the stop marker.
+        with self._lock:
+            if self._thread is None or self._stopping or not self._thread.is_alive():
+                raise UserWarning("The payment writer is not running")
+            try:
+                self._queue.put(request, timeout=timeout)
+            except queue.Full:
+                raise UserWarning("The payment queue is full, try again later")
+        return request.future
+
+    def make_payment(
+        self, policy_id, contact_id=0, date_cursor=None, amount=Decimal(0), timeout=None
+    ):
+        """
+        Submit a payment and wait until it is committed
+        :param timeout: seconds to wait in all, for room in the queue and
+            for the commit (default config.PAYMENT_WRITER_TIMEOUT)
+        :return: the payment id
+        :raise UserWarning: when the payment is not written in time
+        """
+        if timeout is None:
+            timeout = config.PAYMENT_WRITER_TIMEOUT
+        deadline = time.monotonic() + timeout
+        future = self.submit(policy_id, contact_id, date_cursor, amount, timeout)
+        try:
+            return future.result(max(deadline - time.monotonic(), 0))
+        except futures.TimeoutError:
+            if future.cancel():
+                raise UserWarning(
+                    "The payment was not written within {0} seconds".format(timeout)
+                )
+            raise UserWarning(
+                "The payment is still being written after {0} seconds, check "
+                "the policy's payments before paying again".format(timeout)
+            )
+
+    def _run(self):
+        stopping = False
+        delay = 0
+        while not stopping:
+            request = self._queue.get()
+            if request is _STOP:
+                break
+            group = [request]
+            deadline = time.monotonic() + delay
+            while len(group) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        request = self._queue.get(timeout=remaining)
+                    else:
+                        request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is _STOP:
+                    stopping = True
+                    break
+                group.append(request)
+            delay = self.max_delay if len(group) > 1 else 0
+            try:
+                self._write(group)
+            except Exception as error:
+                _fail(group, error)
+
+    def _write(self, group):
+        """
+        Check and commit one group, then resolve its futures
+        """
+        group = [
+            request
+            for request in group
+            if request.future.set_running_or_notify_cancel()
+        ]
+        if not group:
+            return
+        session = None
+        try:
+            session = self.session_factory()
+            accepted = self._check(session, group)
+            payments = [
+                Payment(
+                    request.policy_id,
+                    request.contact_id,
+                    request.amount,
+                    request.date_cursor,
+                )
+                for request in accepted
+            ]
+            session.add_all(payments)
+            session.flush()
+            payment_ids = [payment.id for payment in payments]
+            session.commit()
+        except Exception as error:
+            _fail(group, error)
+            return
+        finally:
+            if session is not None:
+                # Rolls back whatever the group left uncommitted.
+                session.close()
+        self.groups += 1
+        self.written += len(accepted)
+        for request, payment_id in zip(accepted, payment_ids):
+            request.future.set_result(payment_id)
+
+    def _check(self, session, group):
+        """
+        make_payment's rules on a group, with one query per table. Fails
+        the futures of the refused payments and fills in the contact of
+        the accepted ones.
+        :return: the accepted requests, in order
+        """
+        policy_ids = sorted({request.policy_id for request in group})
+        policies = {
+            policy.id: policy
+            for policy in session.execute(
+                _POLICIES, {"policy_ids": policy_ids}
+            ).fetchall()
+        }
+        contact_ids = {request.contact_id for request in group if request.contact_id}
+        contact_ids.update(
+            policy.named_insured for policy in policies.values() if policy.named_insured
+        )
+        roles = {}
+        if contact_ids:
+            roles = dict(
+                session.execute(
+                    _CONTACTS, {"contact_ids": sorted(contact_ids)}
+                ).fetchall()
+            )
+        invoices = {}
+        payments = {}
+        load_payment_history(session, sorted(policies), invoices, payments)
+
+        accepted = []
+        for request in group:
+            try:
+                policy = policies.get(request.policy_id)
+                if policy is None:
+                    raise NoResultFound("We couldn't find any policy with this id")
+                refuse_canceled(policy)
+                request.contact_id = request.contact_id or policy.named_insured
+                if request.contact_id not in roles:
+                    raise NoResultFound("We couldn't find any contact with this id")
+                if (
+                    roles[request.contact_id] != "Agent"
+                    and cancellation_pending_invoice(
+                        invoices[policy.id], payments[policy.id], request.date_cursor
+                    )
+                    is not None
+                ):
+                    raise UserWarning(
+                        "Policy has passed the due date without being "
+                        "paid in full, only an agent can't make a payment"
+                    )
+            except (NoResultFound, UserWarning) as error:
+                request.future.set_exception(error)
+                continue
+            record_payment(
+                payments[policy.id], request.date_cursor, to_cents(request.amount)
+            )
+            accepted.append(request)
+        return accepted
+
+
+def _fail(requests, error):
+    """
+    Fail the futures of the requests that are not resolved yet
+    """
+    for request in requests:
+        if not request.future.done():
+            request.future.set_exception(error)
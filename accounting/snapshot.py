@@ -0,0 +1,634 @@
+import argparse
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import Integer, bindparam, cast, false, func, select, union_all
+
+from accounting import config
+from accounting.balances import as_date
+from accounting.models import Invoice, Payment, Policy
+from accounting.money import cents, from_cents, json_amount
+from accounting.sql_base import get_engine
+
+"""
+#######################################################
+Columnar balance snapshot.
+
+An optional read-only copy of the live invoices and payments, held in
+flat array columns instead of ORM objects, to answer balance and invoice
+lookups without going to the database:
+
+  - policies: sorted ids, the id of every policy number, and the
+    status, cancel date and reason of the policies that are not active
+  - movements: one entry per policy and date with the running balance
+    after that date (a prefix sum, in cents), so a balance is one binary
+    search over the dates of the policy
+  - invoices: id, bill date, due date and amount of every live invoice
+
+Dates are kept as ordinals and amounts as integer cents, and each policy
+owns the slice offsets[i]:offsets[i + 1] of its columns.
+
+refresh() only reads the policies, invoices and payments with ids above
+the last ones seen and keeps them in a small per-policy overlay, until
+MAX_PENDING_ROWS of them trigger a full reload. Rows changed in place
+(soft-deleted invoices, deleted payments, edited amounts, policies
+canceled or reinstated) are caught by comparing the count and total of
+the rows already held with the database, which also triggers a full
+reload. Dates and cancel reasons edited in place are not caught; call
+reload() after such a change.
+
+The invoices endpoint uses the snapshot when ACCOUNTING_SNAPSHOT=1, see
+current_snapshot(). Load one by hand to see its footprint:
+
+    python -m accounting.snapshot
+#######################################################
+"""
+
+MAX_PENDING_ROWS = 50000
+
+# Rows fetched per round trip while loading.
+FETCH_SIZE = 10000
+
+
+def _ordinal(column):
+    """
+    date.toordinal() of a DATE column, computed by SQLite
+    """
+    # julianday("0001-01-01") is 1721425.5, the ordinal of that day is 1.
+    return cast(func.julianday(column) - 1721424.5, Integer)
+
+
+# The rows of each table with ids in (after_<table>, last_<table>], see
+# _window(). Dates come back as ordinals and amounts in cents.
+_POLICIES = (
+    select(
+        [
+            Policy.id,
+            Policy.policy_number,
+            Policy.status,
+            Policy.cancel_date,
+            Policy.cancel_reason,
+        ]
+    )
+    .where(Policy.id > bindparam("after_policy"))
+    .where(Policy.id <= bindparam("last_policy"))
+    .order_by(Policy.id)
+)
+
+_INVOICES = (
+    select(
+        [
+            Invoice.id,
+            Invoice.policy_id,
+            _ordinal(Invoice.bill_date),
+            _ordinal(Invoice.due_date),
+            cents(Invoice.amount_due),
+        ]
+    )
+    .where(Invoice.deleted == false())
+    .where(Invoice.id > bindparam("after_invoice"))
+    .where(Invoice.id <= bindparam("last_invoice"))
+    .order_by(Invoice.policy_id, Invoice.bill_date, Invoice.id)
+)
+
+# What the live invoices and the payments add to each policy on each
+# day, in policy and day order, summed up by SQLite.
+_movements = union_all(
+    select(
+        [
+            Invoice.policy_id.label("policy_id"),
+            Invoice.bill_date.label("day"),
+            cents(Invoice.amount_due).label("amount"),
+        ]
+    )
+    .where(Invoice.deleted == false())
+    .where(Invoice.id > bindparam("after_invoice"))
+    .where(Invoice.id <= bindparam("last_invoice")),
+    select([Payment.policy_id, Payment.transaction_date, -cents(Payment.amount_paid)])
+    .where(Payment.id > bindparam("after_payment"))
+    .where(Payment.id <= bindparam("last_payment")),
+).alias("movements")
+
+_MOVEMENTS = (
+    select(
+        [
+            _movements.c.policy_id,
+            _ordinal(_movements.c.day),
+            func.sum(_movements.c.amount),
+        ]
+    )
+    .group_by(_movements.c.policy_id, _movements.c.day)
+    .order_by(_movements.c.policy_id, _movements.c.day)
+)
+
+# Count and total in cents of the live invoices and the payments, and
+# count and sum of the ids of the policies that are not active, to spot
+# rows changed in place since they were loaded.
+_TOTALS = select(
+    [
+        select([func.count(), func.coalesce(func.sum(Policy.id), 0)])
+        .where(Policy.status != "Active")
+        .where(Policy.id > bindparam("after_policy"))
+        .where(Policy.id <= bindparam("last_policy"))
+        .alias("inactive_totals"),
+        select([func.count(), func.coalesce(func.sum(cents(Invoice.amount_due)), 0)])
+        .where(Invoice.deleted == false())
+        .where(Invoice.id > bindparam("after_invoice"))
+        .where(Invoice.id <= bindparam("last_invoice"))
+        .alias("invoice_totals"),
+        select([func.count(), func.coalesce(func.sum(cents(Payment.amount_paid)), 0)])
+        .where(Payment.id > bindparam("after_payment"))
+        .where(Payment.id <= bindparam("last_payment"))
+        .alias("payment_totals"),
+    ]
+)
+
+_LAST_IDS = select(
+    [
+        select([func.coalesce(func.max(model.id), 0)]).as_scalar()
+        for model in (Policy, Invoice, Payment)
+    ]
+)
+
+# (policy, invoice, payment) ids, and (count, sum of ids) of the
+# inactive policies and (count, total in cents) of the live invoices and
+# payments held.
+_Marks = namedtuple("_Marks", "policy invoice payment")
+_Totals = namedtuple(
+    "_Totals",
+    "inactive inactive_ids invoices invoice_cents payments payment_cents",
+)
+
+_NOTHING = _Marks(0, 0, 0)
+
+
+class SnapshotPolicy(
+    namedtuple("SnapshotPolicy", "id status cancel_date cancel_reason")
+):
+    """
+    Status of a policy as the snapshot holds it, enough for
+    refuse_canceled
+    """
+
+    __slots__ = ()
+
+
+class SnapshotInvoice(
+    namedtuple("SnapshotInvoice", "id bill_date due_date amount_due")
+):
+    """
+    A live invoice as the snapshot holds it, amount_due in dollars
+    """
+
+    __slots__ = ()
+
+    def serialize(self):
+        # Same shape as Invoice.serialize
+        return {
+            "id": self.id,
+            "bill_date": self.bill_date.strftime("%Y-%m-%d"),
+            "due_date": self.due_date.strftime("%Y-%m-%d"),
+            "amount_due": json_amount(self.amount_due),
+        }
+
+
+class _Columns(object):
+    """
+    The bulk of a snapshot, built once per full load and then only read
+    """
+
+    def __init__(self):
+        self.policy_ids = array("q")
+        self.numbers = {}
+        # policy_id -> SnapshotPolicy of the policies that are not active
+        self.inactive = {}
+        self.offsets = array("q", [0])
+        self.days = array("i")
+        self.balances = array("q")
+        self.invoice_offsets = array("q", [0])
+        self.invoice_ids = array("q")
+        self.bill_days = array("i")
+        self.due_days = array("i")
+        self.amounts = array("q")
+
+    def arrays(self):
+        return (
+            self.policy_ids,
+            self.offsets,
+            self.days,
+            self.balances,
+            self.invoice_offsets,
+            self.invoice_ids,
+            self.bill_days,
+            self.due_days,
+            self.amounts,
+        )
+
+    def index(self, policy_id):
+        index = bisect_left(self.policy_ids, policy_id)
+        if index < len(self.policy_ids) and self.policy_ids[index] == policy_id:
+            return index
+        return None
+
+
+class _State(object):
+    """
+    Columns plus the overlay of rows added since they were built.
+    refresh() swaps in a new state instead of changing this one, so a
+    reader holding it always sees a consistent copy.
+    """
+
+    def __init__(self, columns, marks, totals, loaded_at):
+        self.columns = columns
+        self.marks = marks
+        self.totals = totals
+        self.loaded_at = loaded_at
+        # policy_id -> [(day, cents)] in day order / [SnapshotInvoice]
+        self.movements = {}
+        self.invoices = {}
+        # policy number -> id / policy_id -> SnapshotPolicy of inactive
+        # policies added since the full load
+        self.numbers = {}
+        self.inactive = {}
+        self.pending = 0
+
+
+class BalanceSnapshot(object):
+    """
+    Columnar copy of the live invoices and payments, see the module
+    docstring. Empty until reload() or refresh() is called.
+    """
+
+    def __init__(self, bind=None, max_pending_rows=MAX_PENDING_ROWS):
+        self._bind = bind
+        self.max_pending_rows = max_pending_rows
+        self._state = None
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.refreshes = 0
+
+    @property
+    def bind(self):
+        # The application engine unless given one, looked up on first use.
+        return self._bind or get_engine()
+
+    @property
+    def loaded(self):
+        return self._state is not None
+
+    @property
+    def age(self):
+        """
+        Seconds since the last reload or refresh
+        """
+        if self._state is None:
+            return None
+        return time.monotonic() - self._state.loaded_at
+
+    def reload(self):
+        """
+        Load every live invoice and payment into fresh columns
+        :return:
+        """
+        with self._lock:
+            with self.bind.connect() as connection:
+                with connection.begin():
+                    self._state = _load(connection)
+            self.reloads += 1
+
+    def refresh(self, verify=True):
+        """
+        Pick up the rows added since the last load, or reload everything
+        when that is cheaper or the rows held have changed
+        :param verify: compare the count and total of the rows held with
+            the database first
+        :return: True when it ended up reloading
+        """
+        with self._lock:
+            state = self._state
+            with self.bind.connect() as connection:
+                with connection.begin():
+                    reload = state is None or (verify and _changed(connection, state))
+                    if not reload:
+                        refreshed = _refresh(connection, state)
+                        reload = refreshed.pending > self.max_pending_rows
+                    if reload:
+                        refreshed = _load(connection)
+            self._state = refreshed
+            if reload:
+                self.reloads += 1
+            else:
+                self.refreshes += 1
+            return reload
+
+    def policy_id(self, policy_number):
+        """
+        :return: id of the policy, None when the snapshot does not know it
+        """
+        state = self._loaded_state()
+        policy_id = state.columns.numbers.get(policy_number)
+        if policy_id is None:
+            policy_id = state.numbers.get(policy_number)
+        return policy_id
+
+    def policy(self, policy_id):
+        """
+        :return: SnapshotPolicy with the status of the policy, an active
+            one for ids the snapshot does not hold as inactive
+        """
+        state = self._loaded_state()
+        policy = state.columns.inactive.get(policy_id)
+        if policy is None:
+            policy = state.inactive.get(policy_id)
+        if policy is None:
+            policy = SnapshotPolicy(policy_id, "Active", None, None)
+        return policy
+
+    def balance_cents(self, policy_id, date_cursor):
+        """
+        Balance of the policy at date_cursor, like ledger_balance
+        :param policy_id:
+        :param date_cursor:
+        :return: integer cents
+        """
+        state = self._loaded_state()
+        columns = state.columns
+        day = as_date(date_cursor).toordinal()
+        balance = 0
+        index = columns.index(policy_id)
+        if index is not None:
+            first = columns.offsets[index]
+            found = bisect_right(columns.days, day, first, columns.offsets[index + 1])
+            if found > first:
+                balance = columns.balances[found - 1]
+        for movement_day, amount in state.movements.get(policy_id, ()):
+            if movement_day > day:
+                break
+            balance += amount
+        return balance
+
+    def return_account_balance(self, policy_id, date_cursor):
+        """
+        PolicyAccounting.return_account_balance from the snapshot
+        :param policy_id:
+        :param date_cursor:
+        :return: Decimal dollars
+        """
+        return from_cents(self.balance_cents(policy_id, date_cursor))
+
+    def invoices(self, policy_id):
+        """
+        Live invoices of the policy in bill date order
+        :param policy_id:
+        :return: list of SnapshotInvoice
+        """
+        state = self._loaded_state()
+        columns = state.columns
+        invoices = []
+        index = columns.index(policy_id)
+        if index is not None:
+            for at in range(
+                columns.invoice_offsets[index], columns.invoice_offsets[index + 1]
+            ):
+                invoices.append(
+                    SnapshotInvoice(
+                        columns.invoice_ids[at],
+                        date.fromordinal(columns.bill_days[at]),
+                        date.fromordinal(columns.due_days[at]),
+                        from_cents(columns.amounts[at]),
+                    )
+                )
+        added = state.invoices.get(policy_id)
+        if added:
+            invoices.extend(added)
+            invoices.sort(key=lambda invoice: (invoice.bill_date, invoice.id))
+        return invoices
+
+    def footprint(self):
+        """
+        Approximate memory held, in bytes
+        :return: dict with the array columns, the policy number index and
+            the overlay apart, and the number of invoices held
+        """
+        state = self._loaded_state()
+        columns = state.columns
+        numbers = columns.numbers
+        overlay = (
+            sys.getsizeof(state.movements)
+            + sys.getsizeof(state.invoices)
+            + sys.getsizeof(state.numbers)
+            + sys.getsizeof(state.inactive)
+            + sum(sys.getsizeof(rows) for rows in state.movements.values())
+            + sum(sys.getsizeof(rows) for rows in state.invoices.values())
+            + state.pending * sys.getsizeof((0, 0))
+        )
+        return {
+            "invoices": state.totals.invoices,
+            "columns": sum(
+                column.buffer_info()[1] * column.itemsize for column in columns.arrays()
+            ),
+            "policy_index": sys.getsizeof(numbers)
+            + sum(
+                sys.getsizeof(number) + sys.getsizeof(policy_id)
+                for number, policy_id in numbers.items()
+            )
+            + sys.getsizeof(columns.inactive)
+            + sum(sys.getsizeof(policy) for policy in columns.inactive.values()),
+            "overlay": overlay,
+        }
+
+    def _loaded_state(self):
+        state = self._state
+        if state is None:
+            raise UserWarning("The balance snapshot is not loaded")
+        return state
+
+
+def _last_ids(connection):
+    return _Marks(*connection.execute(_LAST_IDS).first())
+
+
+def _window(after, last):
+    """
+    Parameters selecting the rows with ids after the `after` marks, up to
+    the `last` ones
+    """
+    window = {}
+    for table in _Marks._fields:
+        window["after_" + table] = getattr(after, table)
+        window["last_" + table] = getattr(last, table)
+    return window
+
+
+def _rows(result, size=FETCH_SIZE):
+    while True:
+        rows = result.fetchmany(size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def _totals(connection, window):
+    return _Totals(*connection.execute(_TOTALS, window).first())
+
+
+def _load(connection):
+    """
+    Full load of the live rows into a new _State
+    """
+    marks = _last_ids(connection)
+    window = _window(_NOTHING, marks)
+    columns = _Columns()
+    for policy_id, policy_number, status, cancel_date, cancel_reason in _rows(
+        connection.execute(_POLICIES, window)
+    ):
+        columns.policy_ids.append(policy_id)
+        columns.numbers[policy_number] = policy_id
+        if status != "Active":
+            columns.inactive[policy_id] = SnapshotPolicy(
+                policy_id, status, cancel_date, cancel_reason
+            )
+
+    # Policy ids of the rows, to find where each policy starts once they
+    # are all in.
+    invoice_policies = array("q")
+    for invoice_id, policy_id, bill_day, due_day, amount in _rows(
+        connection.execute(_INVOICES, window)
+    ):
+        invoice_policies.append(policy_id)
+        columns.invoice_ids.append(invoice_id)
+        columns.bill_days.append(bill_day)
+        columns.due_days.append(due_day)
+        columns.amounts.append(amount)
+
+    movement_policies = array("q")
+    previous = balance = None
+    for policy_id, day, amount in _rows(connection.execute(_MOVEMENTS, window)):
+        if policy_id != previous:
+            previous, balance = policy_id, 0
+        balance += amount
+        movement_policies.append(policy_id)
+        columns.days.append(day)
+        columns.balances.append(balance)
+
+    for policy_id in columns.policy_ids:
+        columns.offsets.append(
+            bisect_right(movement_policies, policy_id, columns.offsets[-1])
+        )
+        columns.invoice_offsets.append(
+            bisect_right(invoice_policies, policy_id, columns.invoice_offsets[-1])
+        )
+    return _State(columns, marks, _totals(connection, window), time.monotonic())
+
+
+def _changed(connection, state):
+    """
+    Whether rows held by the state were deleted or edited, or policies
+    held changed status since
+    """
+    return _totals(connection, _window(_NOTHING, state.marks)) != state.totals
+
+
+def _refresh(connection, state):
+    """
+    New _State sharing the columns of `state`, with the rows added since
+    it was loaded in the overlay
+    """
+    marks = _last_ids(connection)
+    window = _window(state.marks, marks)
+    added = _totals(connection, window)
+    refreshed = _State(
+        state.columns,
+        marks,
+        _Totals(*(held + new for held, new in zip(state.totals, added))),
+        time.monotonic(),
+    )
+    refreshed.movements = dict(state.movements)
+    refreshed.invoices = dict(state.invoices)
+    refreshed.numbers = dict(state.numbers)
+    refreshed.inactive = dict(state.inactive)
+    refreshed.pending = state.pending
+
+    for policy_id, policy_number, status, cancel_date, cancel_reason in (
+        connection.execute(_POLICIES, window)
+    ):
+        refreshed.numbers[policy_number] = policy_id
+        if status != "Active":
+            refreshed.inactive[policy_id] = SnapshotPolicy(
+                policy_id, status, cancel_date, cancel_reason
+            )
+    for invoice_id, policy_id, bill_day, due_day, amount in connection.execute(
+        _INVOICES, window
+    ):
+        refreshed.invoices[policy_id] = refreshed.invoices.get(policy_id, []) + [
+            SnapshotInvoice(
+                invoice_id,
+                date.fromordinal(bill_day),
+                date.fromordinal(due_day),
+                from_cents(amount),
+            )
+        ]
+    for policy_id, group in groupby(
+        connection.execute(_MOVEMENTS, window).fetchall(), key=itemgetter(0)
+    ):
+        movements = [(day, amount) for _, day, amount in group]
+        refreshed.movements[policy_id] = sorted(
+            refreshed.movements.get(policy_id, []) + movements, key=itemgetter(0)
+        )
+        refreshed.pending += len(movements)
+    return refreshed
+
+
+_snapshot = BalanceSnapshot()
+
+
+def current_snapshot(max_age=None):
+    """
+    The process wide snapshot, loaded on first use and refreshed once it
+    is older than max_age seconds. A thread finding another one already
+    refreshing it goes on with the previous state.
+    :param max_age: config.SNAPSHOT_MAX_AGE by default
+    :return: BalanceSnapshot
+    """
+    if max_age is None:
+        max_age = config.SNAPSHOT_MAX_AGE
+    if not _snapshot.loaded:
+        _snapshot.refresh()
+    elif _snapshot.age > max_age and not _snapshot._lock.locked():
+        _snapshot.refresh()
+    return _snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load the balance snapshot and report its footprint"
+    )
+    parser.parse_args()
+
+    snapshot = BalanceSnapshot()
+    start = time.perf_counter()
+    snapshot.reload()
+    seconds = time.perf_counter() - start
+    footprint = snapshot.footprint()
+    total = footprint["columns"] + footprint["policy_index"] + footprint["overlay"]
+    print("{0} invoices loaded in {1:.2f}s".format(footprint["invoices"], seconds))
+    for name in ("columns", "policy_index", "overlay"):
+        print("{0:<13} {1:>12,} bytes".format(name, footprint[name]))
+    if footprint["invoices"]:
+        print(
+            "{0:.1f} MB per million invoices".format(
+                total / footprint["invoices"] * 1e6 / 2**20
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
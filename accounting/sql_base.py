@@ -1,8 +1,87 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from accounting.config import SQLALCHEMY_DATABASE_URI
+import threading
 
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session as BaseSession
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from accounting import config
 
-engine = create_engine(SQLALCHEMY_DATABASE_URI)
-Session = sessionmaker(bind=engine)
-DBSession = Session()
+IN_MEMORY_SQLITE = ("sqlite://", "sqlite:///:memory:")
+
+
+def engine_options(uri):
+    """
+    create_engine keyword arguments for the pool settings in config
+    :param uri:
+    :return:
+    """
+    if uri in IN_MEMORY_SQLITE:
+        # One private database per connection, pooling makes no sense.
+        return {}
+    options = {
+        "pool_size": config.SQLALCHEMY_POOL_SIZE,
+        "max_overflow": config.SQLALCHEMY_MAX_OVERFLOW,
+        "pool_timeout": config.SQLALCHEMY_POOL_TIMEOUT,
+        "pool_recycle": config.SQLALCHEMY_POOL_RECYCLE,
+    }
+    if uri.startswith("sqlite"):
+        # A pooled connection is opened by one request thread and later
+        # handed to another, which pysqlite refuses unless told otherwise.
+        # The scoped session below still keeps each connection on a
+        # single thread at a time.
+        options["poolclass"] = QueuePool
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+def _enable_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    The application engine, created on first use so importing the
+    package never touches the database
+    :return:
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                uri = config.SQLALCHEMY_DATABASE_URI
+                engine = create_engine(uri, **engine_options(uri))
+                if uri.startswith("sqlite") and config.SQLITE_WAL:
+                    event.listen(engine, "connect", _enable_wal)
+                _engine = engine
+    return _engine
+
+
+def __getattr__(name):
+    # accounting.sql_base.engine, from before get_engine().
+    if name == "engine":
+        return get_engine()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+class LazySession(BaseSession):
+    """
+    Session bound to get_engine() the first time it needs a connection,
+    unless it was given a bind
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.bind is None:
+            self.bind = get_engine()
+        return super(LazySession, self).get_bind(mapper, clause)
+
+
+Session = sessionmaker(class_=LazySession)
+# One session per thread. Flask removes the request thread's session in
+# teardown_appcontext (see accounting.views).
+DBSession = scoped_session(Session)
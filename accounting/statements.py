@@ -0,0 +1,203 @@
+import argparse
+import csv
+import heapq
+import json
+import sys
+from collections import namedtuple
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import false, literal
+
+from accounting.balances import as_date
+from accounting.models import Invoice, Payment, Policy
+from accounting.money import cents, from_cents
+from accounting.sql_base import DBSession
+
+"""
+#######################################################
+Policy statement export.
+
+Streams every policy's opening balance, invoices and payments over a
+period, with the running balance after each line. Policies, invoices
+and payments are read with three yield_per queries ordered by policy,
+merged per policy in date order and written out line by line, so
+memory use stays flat however big the book is:
+
+    python -m accounting.statements --from 2015-01-01 --to 2015-01-31
+    python -m accounting.statements --format ndjson --output jan.ndjson
+#######################################################
+"""
+
+OPENING = "opening"
+INVOICE = "invoice"
+PAYMENT = "payment"
+
+FIELDS = ("policy_number", "date", "entry", "id", "amount", "balance")
+
+StatementLine = namedtuple("StatementLine", FIELDS)
+
+
+def _movements(session, date_to, chunk_size):
+    """
+    (policy_id, date, entry, id, signed cents) of every live invoice and
+    payment up to date_to, in policy and date order, invoices first on
+    the same day
+    """
+    invoices = (
+        session.query(
+            Invoice.policy_id,
+            Invoice.bill_date,
+            literal(INVOICE),
+            Invoice.id,
+            cents(Invoice.amount_due),
+        )
+        .filter(Invoice.deleted == false())
+        .filter(Invoice.bill_date <= date_to)
+        .order_by(Invoice.policy_id, Invoice.bill_date, Invoice.id)
+        .yield_per(chunk_size)
+    )
+    payments = (
+        session.query(
+            Payment.policy_id,
+            Payment.transaction_date,
+            literal(PAYMENT),
+            Payment.id,
+            -cents(Payment.amount_paid),
+        )
+        .filter(Payment.transaction_date <= date_to)
+        .order_by(Payment.policy_id, Payment.transaction_date, Payment.id)
+        .yield_per(chunk_size)
+    )
+    return heapq.merge(invoices, payments, key=itemgetter(0, 1))
+
+
+def _policy_lines(policy_number, movements, date_from):
+    """
+    Statement lines of one policy from its movements in date order
+    """
+    balance = 0
+    opened = False
+    for _, day, entry, entry_id, amount in movements:
+        if day < date_from:
+            balance += amount
+            continue
+        if not opened:
+            yield StatementLine(
+                policy_number, date_from, OPENING, None, None, from_cents(balance)
+            )
+            opened = True
+        balance += amount
+        yield StatementLine(
+            policy_number,
+            day,
+            entry,
+            entry_id,
+            from_cents(abs(amount)),
+            from_cents(balance),
+        )
+    if not opened:
+        yield StatementLine(
+            policy_number, date_from, OPENING, None, None, from_cents(balance)
+        )
+
+
+def statement_lines(date_from, date_to, session=DBSession, chunk_size=1000):
+    """
+    Yields the StatementLines of every policy, in policy id order
+    :param date_from: first day of the period
+    :param date_to: last day of the period
+    :param session:
+    :param chunk_size: rows fetched per round trip on each query
+    :return:
+    """
+    date_from, date_to = as_date(date_from), as_date(date_to)
+    by_policy = groupby(_movements(session, date_to, chunk_size), key=itemgetter(0))
+    group = next(by_policy, None)
+    for policy_id, policy_number in (
+        session.query(Policy.id, Policy.policy_number)
+        .order_by(Policy.id)
+        .yield_per(chunk_size)
+    ):
+        # Movements of policies that no longer exist
+        while group is not None and group[0] < policy_id:
+            group = next(by_policy, None)
+        if group is not None and group[0] == policy_id:
+            yield from _policy_lines(policy_number, group[1], date_from)
+            group = next(by_policy, None)
+        else:
+            yield from _policy_lines(policy_number, (), date_from)
+
+
+def _row(line):
+    return {
+        "policy_number": line.policy_number,
+        "date": line.date.strftime("%Y-%m-%d"),
+        "entry": line.entry,
+        "id": line.id,
+        "amount": None if line.amount is None else str(line.amount),
+        "balance": str(line.balance),
+    }
+
+
+def write_csv(lines, out):
+    """
+    :param lines: StatementLines
+    :param out: text file
+    :return: number of lines written
+    """
+    writer = csv.DictWriter(out, fieldnames=FIELDS)
+    writer.writeheader()
+    written = 0
+    for line in lines:
+        writer.writerow(_row(line))
+        written += 1
+    return written
+
+
+def write_ndjson(lines, out):
+    """
+    One JSON object per line
+    :param lines: StatementLines
+    :param out: text file
+    :return: number of lines written
+    """
+    written = 0
+    for line in lines:
+        out.write(json.dumps(_row(line)))
+        out.write("\n")
+        written += 1
+    return written
+
+
+WRITERS = {"csv": write_csv, "ndjson": write_ndjson}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export policy statements")
+    parser.add_argument(
+        "--from",
+        dest="date_from",
+        help="first day, YYYY-MM-DD (default first day of --to's month)",
+    )
+    parser.add_argument("--to", dest="date_to", help="last day (default today)")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    parser.add_argument("--output", default="-", help="file name, - for stdout")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    date_to = as_date(args.date_to) if args.date_to else datetime.now().date()
+    date_from = as_date(args.date_from) if args.date_from else date_to.replace(day=1)
+    lines = statement_lines(date_from, date_to, chunk_size=args.chunk_size)
+    write = WRITERS[args.format]
+    if args.output == "-":
+        written = write(lines, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as out:
+            written = write(lines, out)
+    print("{0} statement lines written".format(written), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
+
+from sqlalchemy import create_engine, false, func
+from sqlalchemy.orm import sessionmaker
+
+from accounting.balances import as_date, cancel_invoice, cancellation_pending_invoice
+from accounting.config import SQLALCHEMY_DATABASE_URI
+from accounting.models import Invoice, Payment, Policy
+from accounting.money import cents
+from accounting.sql_base import DBSession, engine_options
+
+"""
+#######################################################
+Nightly cancellation sweep.
+
+Runs the evaluate_cancel / evaluate_cancellation_pending_due_to_non_pay
+rules over every active policy without building a PolicyAccounting per
+policy: policies are read in id ordered chunks, their invoices and
+payments are fetched with one IN query each, delinquency is worked out
+in memory and the cancellations of a chunk are written in one
+transaction.
+
+With workers > 1 the policy id range is split into shards that run in a
+process pool, each worker on its own engine and session.
+#######################################################
+"""
+
+NON_PAY_CANCEL_REASON = "Non-payment"
+
+# More shards than workers, so one dense id range does not leave the
+# other workers idle at the end of the run.
+SHARDS_PER_WORKER = 4
+
+
+class SweepReport(object):
+    """
+    What a sweep found. `canceled` and `pending` hold
+    (policy_id, policy_number, invoice_id) tuples, where invoice_id is
+    the invoice that caused the result.
+    """
+
+    def __init__(self, date_cursor, dry_run):
+        self.date_cursor = date_cursor
+        self.dry_run = dry_run
+        self.checked = 0
+        self.canceled = []
+        self.pending = []
+
+    def merge(self, other):
+        """
+        Fold the report of a later shard into this one
+        """
+        self.checked += other.checked
+        self.canceled.extend(other.canceled)
+        self.pending.extend(other.pending)
+
+    def summary(self):
+        return "{0} policies checked, {1} {2}, {3} cancellation pending".format(
+            self.checked,
+            len(self.canceled),
+            "to cancel (dry run)" if self.dry_run else "canceled",
+            len(self.pending),
+        )
+
+
+def sweep_policies(
+    date_cursor=None,
+    chunk_size=500,
+    dry_run=False,
+    reason=NON_PAY_CANCEL_REASON,
+    first_id=None,
+    last_id=None,
+    workers=1,
+):
+    """
+    Cancel every active policy that evaluate_cancel would flag
+    :param date_cursor: defaults to today
+    :param chunk_size: policies read (and cancellations committed) per chunk
+    :param dry_run: only report, do not write anything
+    :param reason: cancel_reason stored on canceled policies
+    :param first_id: optional inclusive lower bound on Policy.id
+    :param last_id: optional inclusive upper bound on Policy.id
+    :param workers: number of worker processes, 1 runs in this process
+    :return: SweepReport
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    date_cursor = as_date(date_cursor)
+    if workers <= 1:
+        return _sweep(
+            DBSession, date_cursor, chunk_size, dry_run, reason, first_id, last_id
+        )
+
+    report = SweepReport(date_cursor, dry_run)
+    shards = _shards(first_id, last_id, workers * SHARDS_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _sweep_shard, date_cursor, chunk_size, dry_run, reason, low, high
+            )
+            for low, high in shards
+        ]
+        # Shards cover consecutive id ranges, so merging them in
+        # submission order keeps the report in policy id order, exactly
+        # like a serial run.
+        for future in futures:
+            report.merge(future.result())
+    return report
+
+
+def _shards(first_id, last_id, count):
+    """
+    Split the active policy id range into at most `count` (low, high)
+    inclusive ranges
+    """
+    query = DBSession.query(func.min(Policy.id), func.max(Policy.id)).filter(
+        Policy.status == "Active"
+    )
+    if first_id is not None:
+        query = query.filter(Policy.id >= first_id)
+    if last_id is not None:
+        query = query.filter(Policy.id <= last_id)
+    low, high = query.one()
+    DBSession.rollback()
+    if low is None:
+        return []
+    step = max(1, -(-(high - low + 1) // count))
+    return [
+        (start, min(start + step - 1, high)) for start in range(low, high + 1, step)
+    ]
+
+
+def _sweep_shard(date_cursor, chunk_size, dry_run, reason, first_id, last_id):
+    """
+    Process pool entry point: sweep one id range on a private engine,
+    never on the module level DBSession inherited from the parent
+    """
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URI, **engine_options(SQLALCHEMY_DATABASE_URI)
+    )
+    session = sessionmaker(bind=engine)()
+    try:
+        return _sweep(
+            session, date_cursor, chunk_size, dry_run, reason, first_id, last_id
+        )
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def _sweep(session, date_cursor, chunk_size, dry_run, reason, first_id, last_id):
+    report = SweepReport(date_cursor, dry_run)
+
+    # Start below the first id so every chunk is a primary key range search.
+    cursor_id = first_id - 1 if first_id is not None else 0
+    while True:
+        query = session.query(Policy.id, Policy.policy_number).filter(
+            Policy.status == "Active"
+        )
+        query = query.filter(Policy.id > cursor_id)
+        if last_id is not None:
+            query = query.filter(Policy.id <= last_id)
+        policies = query.order_by(Policy.id).limit(chunk_size).all()
+        if not policies:
+            break
+        cursor_id = policies[-1].id
+
+        canceled = _sweep_chunk(session, policies, date_cursor, report)
+        if canceled and not dry_run:
+            session.query(Policy).filter(Policy.id.in_(canceled)).update(
+                {
+                    Policy.status: "Canceled",
+                    Policy.cancel_date: date_cursor,
+                    Policy.cancel_reason: reason,
+                },
+                synchronize_session=False,
+            )
+            session.commit()
+
+    return report
+
+
+def _sweep_chunk(session, policies, date_cursor, report):
+    """
+    Evaluate one chunk of policies in memory and record the results
+    :return: ids of the policies to cancel
+    """
+    policy_ids = [policy.id for policy in policies]
+    # Amounts stay in integer cents, the walks only compare them to zero.
+    invoices = _group_by_policy(
+        session.query(
+            Invoice.id,
+            Invoice.policy_id,
+            Invoice.bill_date,
+            Invoice.due_date,
+            Invoice.cancel_date,
+            cents(Invoice.amount_due).label("amount_due"),
+        )
+        .filter(Invoice.policy_id.in_(policy_ids))
+        .filter(Invoice.deleted == false())
+        .order_by(Invoice.policy_id, Invoice.bill_date, Invoice.id)
+    )
+    payments = _group_by_policy(
+        session.query(
+            Payment.policy_id,
+            Payment.transaction_date,
+            cents(Payment.amount_paid).label("amount_paid"),
+        )
+        .filter(Payment.policy_id.in_(policy_ids))
+        .filter(Payment.transaction_date <= date_cursor)
+        .order_by(Payment.policy_id, Payment.transaction_date)
+    )
+
+    canceled = []
+    for policy in policies:
+        policy_invoices = invoices.get(policy.id, [])
+        policy_payments = payments.get(policy.id, [])
+        report.checked += 1
+
+        invoice = cancel_invoice(policy_invoices, policy_payments, date_cursor)
+        if invoice is not None:
+            canceled.append(policy.id)
+            report.canceled.append((policy.id, policy.policy_number, invoice.id))
+            continue
+        invoice = cancellation_pending_invoice(
+            policy_invoices, policy_payments, date_cursor
+        )
+        if invoice is not None:
+            report.pending.append((policy.id, policy.policy_number, invoice.id))
+    return canceled
+
+
+def _group_by_policy(rows):
+    return {
+        policy_id: list(group)
+        for policy_id, group in groupby(rows, key=attrgetter("policy_id"))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nightly cancellation sweep")
+    parser.add_argument("--date", help="date cursor, YYYY-MM-DD (default today)")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only report, do not cancel"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="worker processes (default 1)"
+    )
+    args = parser.parse_args()
+
+    report = sweep_policies(
+        date_cursor=args.date,
+        chunk_size=args.chunk_size,
+        dry_run=args.dry_run,
+        workers=args.workers,
+    )
+    for policy_id, policy_number, invoice_id in report.canceled:
+        print("cancel  {0} (invoice {1})".format(policy_number, invoice_id))
+    for policy_id, policy_number, invoice_id in report.pending:
+        print("pending {0} (invoice {1})".format(policy_number, invoice_id))
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,75 @@
 #!/user/bin/env python2.7
 
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-from datetime import date
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from fractions import Fraction
+from operator import itemgetter
 
-from accounting.sql_base import DBSession
-from accounting.models import Contact, Invoice, Policy
-from accounting.utils import PolicyAccounting
+from aiohttp.test_utils import TestClient, TestServer
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import NoResultFound
+
+from accounting import app, create_app, metrics
+from accounting.aio import DB_KEY, AsyncPolicyAccounting, create_async_app
+from accounting.aging import BUCKETS, aging_report, print_aging_report
+from accounting.archive import archive_deleted_invoices, compact
+from accounting.billing import (
+    BILLING_SCHEDULES,
+    BillingSchedule,
+    billing_schedule,
+    invoice_dates,
+    invoice_rows,
+    make_invoices_bulk,
+)
+from accounting.cache import BalanceCache, balance_cache
+from accounting.ledger import (
+    check_ledger,
+    ledger_balance,
+    ledger_suspended,
+    rebuild_ledger,
+)
+from accounting.lockbox import ingest_payments
+from accounting.migrations import (
+    MIGRATIONS,
+    migrate_live_ledger,
+    migrate_money_to_cents,
+    migrate_policy_versions,
+    schema_version,
+    upgrade,
+)
+from accounting.payment_writer import PaymentWriter
+from accounting.snapshot import BalanceSnapshot, current_snapshot
+from accounting.sql_base import DBSession, Session, engine
+from accounting.statements import statement_lines, write_csv, write_ndjson
+from accounting.money import from_cents, json_amount, json_cents, split_cents, to_cents
+from accounting.models import (
+    LEDGER_TRIGGERS,
+    SCHEMA_VERSION,
+    VERSION_TRIGGERS,
+    Base,
+    Contact,
+    Invoice,
+    InvoiceArchive,
+    LedgerEntry,
+    Payment,
+    Policy,
+)
+from accounting.sweep import sweep_policies
+from accounting.utils import PolicyAccounting, refuse_canceled
 
 """
 #######################################################
@@ -14,6 +78,11 @@ Test Suite for Accounting
 """
 
 
+def setUpModule():
+    # Importing the models creates nothing, the schema is created here.
+    upgrade()
+
+
 class TestBillingSchedules(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -55,6 +124,72 @@ class TestBillingSchedules(unittest.TestCase):
             self.policy.invoices[0].amount_due, self.policy.annual_premium
         )
 
+    def test_semi_annual_billing_schedule(self):
+        self.policy.billing_schedule = "Semi-Annual"
+        self.policy.annual_premium = 1000
+        DBSession.commit()
+        try:
+            PolicyAccounting(self.policy.id)
+            invoices = sorted(self.policy.invoices, key=lambda i: i.bill_date)
+            self.assertEqual(
+                [(i.bill_date, i.due_date) for i in invoices],
+                [
+                    (date(2015, 1, 1), date(2015, 2, 1)),
+                    (date(2015, 7, 1), date(2015, 8, 1)),
+                ],
+            )
+            self.assertEqual([i.amount_due for i in invoices], [500, 500])
+        finally:
+            self.policy.annual_premium = 1200
+            DBSession.commit()
+
+    def test_unknown_billing_schedule(self):
+        with self.assertRaises(KeyError):
+            billing_schedule("Weekly")
+        with self.assertRaises(KeyError):
+            invoice_dates(date(2015, 1, 1), "Weekly")
+        # Not a schedule the model accepts, so the policy is never saved.
+        policy = Policy("Test Weekly", date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Weekly"
+        with self.assertRaises(KeyError):
+            PolicyAccounting(policy=policy)
+        self.assertFalse(DBSession.new)
+
+    def test_dates_match_relativedelta(self):
+        start = date(2015, 1, 1)
+        for effective_date in (start + timedelta(days=i) for i in range(0, 731, 3)):
+            for name, schedule in BILLING_SCHEDULES.items():
+                months = 12 // schedule.installments
+                expected = []
+                for i in range(schedule.installments):
+                    bill_date = effective_date + relativedelta(months=i * months)
+                    expected.append(
+                        (
+                            bill_date,
+                            bill_date + relativedelta(months=1),
+                            bill_date + relativedelta(months=1, days=14),
+                        )
+                    )
+                self.assertEqual(list(invoice_dates(effective_date, name)), expected)
+
+    def test_invoice_dates_are_memoized(self):
+        effective_date = date(2031, 3, 31)
+        before = invoice_dates.cache_info()
+        first = invoice_dates(effective_date, "Monthly")
+        self.assertIs(invoice_dates(effective_date, "Monthly"), first)
+        after = invoice_dates.cache_info()
+        self.assertEqual(after.misses - before.misses, 1)
+        self.assertEqual(after.hits - before.hits, 1)
+
+    def test_uneven_fractions(self):
+        schedule = BillingSchedule(
+            "Front Loaded",
+            2,
+            ((0, 1, 14), (6, 1, 14)),
+            (Fraction(2, 3), Fraction(1, 3)),
+        )
+        self.assertEqual(schedule.amounts(100), [Decimal("66.67"), Decimal("33.33")])
+
 
 class TestReturnAccountBalance(unittest.TestCase):
     @classmethod
@@ -141,3 +276,2374 @@ class TestReturnAccountBalance(unittest.TestCase):
         self.assertEquals(
             pa.return_account_balance(date_cursor=invoices[1].bill_date), 0
         )
+
+    def test_balance_includes_invoices_billed_on_date_cursor(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy.id)
+        invoices = (
+            DBSession.query(Invoice)
+            .filter_by(policy_id=self.policy.id)
+            .order_by(Invoice.bill_date)
+            .all()
+        )
+        second_bill_date = invoices[1].bill_date
+        self.assertEqual(
+            pa.return_account_balance(second_bill_date - timedelta(days=1)), 300
+        )
+        self.assertEqual(pa.return_account_balance(second_bill_date), 600)
+        self.assertEqual(
+            pa.return_account_balance(
+                datetime.combine(second_bill_date, datetime.min.time())
+            ),
+            600,
+        )
+
+
+def raw_balance(policy_id, date_cursor):
+    """
+    Balance added up from the raw invoices and payments tables, live
+    invoices only
+    """
+    invoiced = sum(
+        invoice.amount_due
+        for invoice in DBSession.query(Invoice)
+        .filter_by(policy_id=policy_id, deleted=False)
+        .filter(Invoice.bill_date <= date_cursor)
+    )
+    paid = sum(
+        payment.amount_paid
+        for payment in DBSession.query(Payment)
+        .filter_by(policy_id=policy_id)
+        .filter(Payment.transaction_date <= date_cursor)
+    )
+    return invoiced - paid
+
+
+def reference_cancellation_pending_invoice(pa, date_cursor):
+    """
+    The original one-balance-query-per-invoice implementation
+    """
+    invoices = (
+        DBSession.query(Invoice)
+        .filter_by(policy_id=pa.policy.id, deleted=False)
+        .filter(Invoice.due_date <= date_cursor)
+        .filter(Invoice.cancel_date >= date_cursor)
+        .order_by(Invoice.bill_date)
+        .all()
+    )
+    for invoice in invoices:
+        if raw_balance(pa.policy.id, invoice.due_date):
+            return invoice
+    return None
+
+
+def reference_cancel_invoice(pa, date_cursor):
+    """
+    The original one-balance-query-per-invoice implementation
+    """
+    invoices = (
+        DBSession.query(Invoice)
+        .filter_by(policy_id=pa.policy.id, deleted=False)
+        .filter(Invoice.cancel_date <= date_cursor)
+        .order_by(Invoice.bill_date)
+        .all()
+    )
+    for invoice in invoices:
+        if raw_balance(pa.policy.id, invoice.cancel_date):
+            return invoice
+    return None
+
+
+class TestSinglePassEvaluation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(cls.test_agent)
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+
+        cls.policy = Policy("Test Single Pass Policy", date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        DBSession.add(cls.policy)
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.delete(cls.test_insured)
+        DBSession.delete(cls.test_agent)
+        DBSession.delete(cls.policy)
+        DBSession.commit()
+
+    def tearDown(self):
+        self.clear_schedule()
+
+    def clear_schedule(self):
+        DBSession.query(Invoice).filter_by(policy_id=self.policy.id).delete()
+        DBSession.query(Payment).filter_by(policy_id=self.policy.id).delete()
+        DBSession.commit()
+
+    def make_random_schedule(self, rng):
+        # Distinct bill dates so "first invoice in bill_date order" is
+        # well defined for the reference implementation too.
+        offsets = rng.sample(range(365), rng.randint(1, 12))
+        for offset in offsets:
+            bill_date = self.policy.effective_date + timedelta(days=offset)
+            due_date = bill_date + timedelta(days=rng.randint(0, 45))
+            invoice = Invoice(
+                self.policy.id,
+                bill_date,
+                due_date,
+                due_date + timedelta(days=rng.randint(0, 20)),
+                rng.choice([50, 100, 300]),
+            )
+            invoice.deleted = rng.random() < 0.1
+            DBSession.add(invoice)
+        for _ in range(rng.randint(0, 12)):
+            DBSession.add(
+                Payment(
+                    self.policy.id,
+                    self.test_insured.id,
+                    rng.choice([50, 100, 300]),
+                    self.policy.effective_date + timedelta(days=rng.randint(0, 420)),
+                )
+            )
+        DBSession.commit()
+
+    def test_matches_reference_on_random_schedules(self):
+        rng = random.Random(20150101)
+        for _ in range(40):
+            self.make_random_schedule(rng)
+            pa = PolicyAccounting(self.policy.id)
+            for _ in range(8):
+                date_cursor = self.policy.effective_date + timedelta(
+                    days=rng.randint(0, 450)
+                )
+                self.assertIs(
+                    pa.find_cancellation_pending_invoice(date_cursor),
+                    reference_cancellation_pending_invoice(pa, date_cursor),
+                )
+                self.assertIs(
+                    pa.find_cancel_invoice(date_cursor),
+                    reference_cancel_invoice(pa, date_cursor),
+                )
+                self.assertEqual(
+                    pa.evaluate_cancel(date_cursor),
+                    reference_cancel_invoice(pa, date_cursor) is not None,
+                )
+                self.assertEqual(
+                    pa.return_account_balance(date_cursor),
+                    raw_balance(self.policy.id, date_cursor),
+                )
+            self.clear_schedule()
+
+
+class TestCancellationSweep(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(cls.test_agent)
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+
+        cls.paid = Policy("Test Sweep Paid", date(2015, 1, 1), 1200)
+        cls.delinquent = Policy("Test Sweep Delinquent", date(2015, 1, 1), 1200)
+        cls.pending = Policy("Test Sweep Pending", date(2015, 1, 20), 1200)
+        cls.policies = [cls.paid, cls.delinquent, cls.pending]
+        for policy in cls.policies:
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            DBSession.add(policy)
+        DBSession.commit()
+        for policy in cls.policies:
+            PolicyAccounting(policy.id)
+        DBSession.add(
+            Payment(cls.paid.id, cls.test_insured.id, 1200, date(2015, 1, 15))
+        )
+        DBSession.commit()
+        cls.policy_ids = [policy.id for policy in cls.policies]
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies:
+            DBSession.query(Invoice).filter_by(policy_id=policy.id).delete()
+            DBSession.query(Payment).filter_by(policy_id=policy.id).delete()
+            DBSession.delete(policy)
+        DBSession.delete(cls.test_insured)
+        DBSession.delete(cls.test_agent)
+        DBSession.commit()
+
+    def tearDown(self):
+        for policy in self.policies:
+            policy.status = "Active"
+            policy.cancel_date = None
+            policy.cancel_reason = None
+        DBSession.commit()
+
+    def sweep(self, **kwargs):
+        return sweep_policies(
+            date_cursor=date(2015, 3, 1),
+            chunk_size=2,
+            first_id=min(self.policy_ids),
+            last_id=max(self.policy_ids),
+            **kwargs
+        )
+
+    def test_dry_run_reports_without_canceling(self):
+        report = self.sweep(dry_run=True)
+        self.assertEqual(report.checked, 3)
+        self.assertEqual(
+            [policy_id for policy_id, _, _ in report.canceled], [self.delinquent.id]
+        )
+        self.assertEqual(
+            [policy_id for policy_id, _, _ in report.pending], [self.pending.id]
+        )
+        DBSession.expire_all()
+        self.assertEqual([policy.status for policy in self.policies], ["Active"] * 3)
+
+    def test_matches_policy_accounting(self):
+        report = self.sweep(dry_run=True)
+        canceled = {
+            policy_id: invoice_id for policy_id, _, invoice_id in report.canceled
+        }
+        pending = {policy_id: invoice_id for policy_id, _, invoice_id in report.pending}
+        for policy in self.policies:
+            pa = PolicyAccounting(policy.id)
+            invoice = pa.find_cancel_invoice(date(2015, 3, 1))
+            self.assertEqual(canceled.get(policy.id), invoice and invoice.id)
+            if invoice is None:
+                invoice = pa.find_cancellation_pending_invoice(date(2015, 3, 1))
+                self.assertEqual(pending.get(policy.id), invoice and invoice.id)
+
+    def test_sweep_cancels_delinquent_policies(self):
+        report = self.sweep()
+        self.assertEqual(len(report.canceled), 1)
+        DBSession.expire_all()
+        self.assertEqual(self.delinquent.status, "Canceled")
+        self.assertEqual(self.delinquent.cancel_date, date(2015, 3, 1))
+        self.assertEqual(self.paid.status, "Active")
+        self.assertEqual(self.pending.status, "Active")
+        # Already canceled policies are not picked up again
+        self.assertEqual(self.sweep().checked, 2)
+
+    def test_parallel_sweep_matches_serial(self):
+        serial = self.sweep(dry_run=True)
+        parallel = self.sweep(dry_run=True, workers=2)
+        self.assertEqual(parallel.checked, serial.checked)
+        self.assertEqual(parallel.canceled, serial.canceled)
+        self.assertEqual(parallel.pending, serial.pending)
+
+    def test_parallel_sweep_cancels_delinquent_policies(self):
+        report = self.sweep(workers=2)
+        self.assertEqual([entry[0] for entry in report.canceled], [self.delinquent.id])
+        DBSession.expire_all()
+        self.assertEqual(self.delinquent.status, "Canceled")
+        self.assertEqual(self.paid.status, "Active")
+
+
+class TestSwitchBillingSchedule(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.delete(cls.test_insured)
+        DBSession.commit()
+
+    def setUp(self):
+        self.policy = Policy("Test Switch Policy", date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = "Monthly"
+        self.policy.named_insured = self.test_insured.id
+        DBSession.add(self.policy)
+        DBSession.commit()
+        self.pa = PolicyAccounting(self.policy.id)
+
+    def tearDown(self):
+        DBSession.query(Invoice).filter_by(policy_id=self.policy.id).delete()
+        DBSession.query(Payment).filter_by(policy_id=self.policy.id).delete()
+        DBSession.delete(self.policy)
+        DBSession.commit()
+
+    def live_invoices(self):
+        return (
+            DBSession.query(Invoice)
+            .filter_by(policy_id=self.policy.id, deleted=False)
+            .order_by(Invoice.bill_date)
+            .all()
+        )
+
+    def test_full_switch_rebuilds_the_schedule(self):
+        self.pa.switch_billing_schedule("Quarterly")
+        invoices = self.live_invoices()
+        self.assertEqual(
+            [invoice.bill_date.month for invoice in invoices], [1, 4, 7, 10]
+        )
+        self.assertEqual([invoice.amount_due for invoice in invoices], [300] * 4)
+
+    def test_incremental_switch_keeps_billed_invoices(self):
+        self.pa.make_payment(
+            contact_id=self.test_insured.id, date_cursor=date(2015, 1, 15), amount=100
+        )
+        billed = [i.id for i in self.live_invoices() if i.bill_date.month <= 3]
+        balance = self.pa.return_account_balance(date(2015, 3, 15))
+
+        self.pa.switch_billing_schedule(
+            "Quarterly", incremental=True, date_cursor=date(2015, 3, 15)
+        )
+        invoices = self.live_invoices()
+        self.assertEqual([invoice.id for invoice in invoices[:3]], billed)
+        self.assertEqual(
+            [(i.bill_date, i.amount_due) for i in invoices[3:]],
+            [
+                (date(2015, 4, 1), 300),
+                (date(2015, 7, 1), 300),
+                (date(2015, 10, 1), 300),
+            ],
+        )
+        self.assertEqual(self.policy.billing_schedule, "Quarterly")
+        self.assertEqual(self.pa.return_account_balance(date(2015, 3, 15)), balance)
+        self.assertEqual(self.pa.return_account_balance(date(2015, 12, 31)), 1100)
+        self.assertEqual(
+            DBSession.query(Invoice).filter_by(policy_id=self.policy.id).count(), 6
+        )
+
+    def test_incremental_switch_without_bill_dates_left(self):
+        self.pa.switch_billing_schedule(
+            "Annual", incremental=True, date_cursor=date(2015, 2, 10)
+        )
+        invoices = self.live_invoices()
+        self.assertEqual(len(invoices), 3)
+        self.assertEqual(
+            (invoices[-1].bill_date, invoices[-1].amount_due), (date(2015, 2, 10), 1000)
+        )
+
+    def test_repeated_incremental_switches(self):
+        rng = random.Random(14)
+        schedules = ["Annual", "Two-Pay", "Quarterly", "Monthly"]
+        date_cursor = date(2015, 1, 1)
+        for _ in range(15):
+            date_cursor += timedelta(days=rng.randint(1, 40))
+            schedule = rng.choice(
+                [s for s in schedules if s != self.policy.billing_schedule]
+            )
+            self.pa.switch_billing_schedule(
+                schedule, incremental=True, date_cursor=date_cursor
+            )
+            invoices = self.live_invoices()
+            self.assertEqual(sum(i.amount_due for i in invoices), 1200)
+            self.assertEqual(
+                DBSession.query(Invoice).filter_by(policy_id=self.policy.id).count(),
+                len(invoices),
+            )
+            self.assertEqual(
+                self.pa.return_account_balance(date(2016, 6, 1)), 1200, schedule
+            )
+
+
+class TestBulkInvoices(unittest.TestCase):
+    effective_dates = [
+        date(2015, 1, 1),
+        date(2015, 1, 31),
+        date(2015, 8, 31),
+        date(2015, 12, 31),
+        date(2016, 2, 29),
+    ]
+    schedules = ["Annual", "Two-Pay", "Quarterly", "Monthly"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.policies = []
+        for effective_date in cls.effective_dates:
+            for schedule in cls.schedules:
+                policy = Policy(
+                    "Test Bulk {0} {1}".format(schedule, effective_date),
+                    effective_date,
+                    1600,
+                )
+                policy.billing_schedule = schedule
+                cls.policies.append(policy)
+                DBSession.add(policy)
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies:
+            DBSession.query(Invoice).filter_by(policy_id=policy.id).delete()
+            DBSession.delete(policy)
+        DBSession.commit()
+
+    def schedule_of(self, policy):
+        return [
+            (i.bill_date, i.due_date, i.cancel_date, i.amount_due)
+            for i in DBSession.query(Invoice)
+            .filter_by(policy_id=policy.id, deleted=False)
+            .order_by(Invoice.bill_date)
+        ]
+
+    def test_matches_make_invoices(self):
+        for policy in self.policies:
+            PolicyAccounting(policy.id)
+            expected = self.schedule_of(policy)
+            rows = [
+                (r["bill_date"], r["due_date"], r["cancel_date"], r["amount_due"])
+                for r in invoice_rows([policy])
+            ]
+            self.assertEqual(rows, expected, policy.policy_number)
+
+    def test_make_invoices_bulk_replaces_live_invoices(self):
+        for policy in self.policies:
+            PolicyAccounting(policy.id)
+        expected = [self.schedule_of(policy) for policy in self.policies]
+
+        created = make_invoices_bulk(self.policies, chunk_size=7)
+        self.assertEqual(created, sum(len(invoices) for invoices in expected))
+        self.assertEqual(
+            [self.schedule_of(policy) for policy in self.policies], expected
+        )
+
+
+class TestMoney(unittest.TestCase):
+    schedules = ["Annual", "Two-Pay", "Quarterly", "Monthly"]
+
+    def setUp(self):
+        self.policies = []
+
+    def tearDown(self):
+        for policy in self.policies:
+            DBSession.query(Invoice).filter_by(policy_id=policy.id).delete()
+            DBSession.delete(policy)
+        DBSession.commit()
+
+    def random_premium(self, rng):
+        return from_cents(rng.randint(0, 10**8))
+
+    def test_split_cents(self):
+        rng = random.Random(13)
+        for _ in range(2000):
+            total = rng.randint(0, 10**10)
+            installments = rng.randint(1, 24)
+            amounts = split_cents(total, installments)
+            self.assertEqual(len(amounts), installments)
+            self.assertEqual(sum(amounts), total)
+            # Everything but the remainder is shared evenly.
+            self.assertEqual(amounts[0] - amounts[-1], total % installments)
+            self.assertEqual(len(set(amounts[1:])), min(1, installments - 1))
+
+    def test_conversions(self):
+        self.assertEqual(to_cents(1600), 160000)
+        self.assertEqual(to_cents(0.1), 10)
+        self.assertEqual(to_cents("133.335"), 13334)
+        self.assertEqual(str(from_cents(60000)), "600")
+        self.assertEqual(str(from_cents(13337)), "133.37")
+        rng = random.Random(7)
+        for _ in range(1000):
+            amount = rng.randint(-(10**10), 10**10)
+            self.assertEqual(to_cents(from_cents(amount)), amount)
+
+    def test_json_cents(self):
+        rng = random.Random(11)
+        amounts = [0, 100, 13333, -13333, -200] + [
+            rng.randint(-(10**10), 10**10) for _ in range(1000)
+        ]
+        for amount in amounts:
+            expected = json_amount(from_cents(amount))
+            self.assertEqual(json_cents(amount), expected)
+            self.assertIs(type(json_cents(amount)), type(expected))
+
+    def test_invoice_rows_add_up_to_premium(self):
+        rng = random.Random(42)
+        for _ in range(500):
+            policy = Policy("Test Money Rows", date(2015, 1, 31), 0)
+            policy.id = 0
+            policy.annual_premium = self.random_premium(rng)
+            policy.billing_schedule = rng.choice(self.schedules)
+            amounts = [row["amount_due"] for row in invoice_rows([policy])]
+            self.assertEqual(sum(amounts), policy.annual_premium)
+            self.assertEqual(max(amounts), amounts[0])
+
+    def test_make_invoices_add_up_to_premium(self):
+        rng = random.Random(1600)
+        for i in range(20):
+            policy = Policy(
+                "Test Money {0}".format(i), date(2015, 1, 1), self.random_premium(rng)
+            )
+            policy.billing_schedule = rng.choice(self.schedules)
+            DBSession.add(policy)
+            DBSession.commit()
+            self.policies.append(policy)
+            pa = PolicyAccounting(policy.id)
+            invoices = pa.policy.invoices
+            self.assertEqual(
+                sum(invoice.amount_due for invoice in invoices), policy.annual_premium
+            )
+            last_bill_date = max(invoice.bill_date for invoice in invoices)
+            self.assertEqual(
+                pa.return_account_balance(last_bill_date), policy.annual_premium
+            )
+
+    def test_amounts_are_stored_in_cents(self):
+        policy = Policy("Test Money Storage", date(2015, 1, 1), 1600)
+        policy.billing_schedule = "Monthly"
+        DBSession.add(policy)
+        DBSession.commit()
+        self.policies.append(policy)
+        PolicyAccounting(policy.id)
+        stored = [
+            amount
+            for amount, in DBSession.execute(
+                "SELECT amount_due FROM invoices WHERE policy_id = :policy_id "
+                "ORDER BY bill_date",
+                {"policy_id": policy.id},
+            )
+        ]
+        self.assertEqual(stored, [13337] + [13333] * 11)
+
+
+class TestMoneyMigration(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        self.engine = create_engine("sqlite:///" + self.path)
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_new_database_is_current(self):
+        self.assertEqual(schema_version(self.engine), SCHEMA_VERSION)
+        for migration in MIGRATIONS:
+            self.assertFalse(migration(self.engine))
+
+    def test_ledger_drops_deleted_invoices(self):
+        with self.engine.begin() as connection:
+            connection.execute("PRAGMA user_version = 1")
+            connection.execute("DROP TRIGGER ledger_invoices_update_old")
+            connection.execute(
+                "INSERT INTO policies (id, policy_number, effective_date, status, "
+                "billing_schedule, annual_premium) "
+                "VALUES (1, 'Old Policy', '2015-01-01', 'Active', 'Annual', 30000)"
+            )
+            connection.execute(
+                "INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, "
+                "amount_due, deleted) VALUES "
+                "(1, '2015-01-01', '2015-02-01', '2015-02-15', 10000, 0), "
+                "(1, '2015-01-01', '2015-02-01', '2015-02-15', 20000, 0)"
+            )
+            # Soft-delete the second one without the ledger noticing.
+            connection.execute(
+                "UPDATE invoices SET deleted = 1 WHERE amount_due = 20000"
+            )
+
+        self.assertTrue(migrate_live_ledger(self.engine))
+        self.assertEqual(schema_version(self.engine), 2)
+        triggers = {
+            name
+            for name, in self.engine.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+            )
+        }
+        self.assertIn("ledger_invoices_update_old", triggers)
+        session = Session(bind=self.engine)
+        try:
+            self.assertEqual(ledger_balance(1, date(2015, 1, 1), session), 10000)
+        finally:
+            session.close()
+
+    def test_adds_policy_versions(self):
+        with self.engine.begin() as connection:
+            connection.execute("PRAGMA user_version = 2")
+            for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'trigger' AND name LIKE 'version_%'"
+            ).fetchall():
+                connection.execute("DROP TRIGGER {0}".format(name))
+            # A policies table from before the version columns.
+            connection.execute("ALTER TABLE policies RENAME TO old_policies")
+            connection.execute(
+                "CREATE TABLE policies (id INTEGER PRIMARY KEY, "
+                "policy_number VARCHAR(128) NOT NULL, effective_date DATE NOT NULL, "
+                "status VARCHAR(8) NOT NULL, billing_schedule VARCHAR(9) NOT NULL, "
+                "annual_premium INTEGER NOT NULL, named_insured INTEGER, "
+                "agent INTEGER, cancel_date DATE, cancel_reason VARCHAR(128))"
+            )
+            connection.execute("DROP TABLE old_policies")
+            connection.execute(
+                "INSERT INTO policies (id, policy_number, effective_date, status, "
+                "billing_schedule, annual_premium) "
+                "VALUES (1, 'Old Policy', '2015-01-01', 'Active', 'Annual', 30000)"
+            )
+
+        self.assertTrue(migrate_policy_versions(self.engine))
+        self.assertFalse(migrate_policy_versions(self.engine))
+        self.assertEqual(schema_version(self.engine), 3)
+        with self.engine.begin() as connection:
+            connection.execute(
+                "INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, "
+                "amount_due, deleted) VALUES "
+                "(1, '2015-01-01', '2015-02-01', '2015-02-15', 30000, 0)"
+            )
+        session = Session(bind=self.engine)
+        try:
+            version, modified_at = session.query(
+                Policy.version, Policy.modified_at
+            ).one()
+            self.assertEqual(version, 1)
+            self.assertIsNotNone(modified_at)
+        finally:
+            session.close()
+
+    def test_converts_dollars_to_cents(self):
+        with self.engine.begin() as connection:
+            connection.execute("PRAGMA user_version = 0")
+            connection.execute(
+                "INSERT INTO contacts (id, name, role) "
+                "VALUES (1, 'Old Insured', 'Named Insured')"
+            )
+            connection.execute(
+                "INSERT INTO policies (id, policy_number, effective_date, status, "
+                "billing_schedule, annual_premium) "
+                "VALUES (1, 'Old Policy', '2015-01-01', 'Active', 'Monthly', 1600)"
+            )
+            connection.execute(
+                "INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, "
+                "amount_due, deleted) VALUES "
+                "(1, '2015-01-01', '2015-02-01', '2015-02-15', 133.33333333333334, 0)"
+            )
+            connection.execute(
+                "INSERT INTO payments (policy_id, contact_id, amount_paid, "
+                "transaction_date) VALUES (1, 1, 100, '2015-01-10')"
+            )
+
+        self.assertTrue(migrate_money_to_cents(self.engine))
+        self.assertFalse(migrate_money_to_cents(self.engine))
+        self.assertEqual(schema_version(self.engine), 1)
+        session = Session(bind=self.engine)
+        try:
+            self.assertEqual(session.query(Policy.annual_premium).scalar(), 1600)
+            self.assertEqual(
+                session.execute("SELECT amount_due FROM invoices").scalar(), 13333
+            )
+            self.assertEqual(
+                session.execute("SELECT amount_paid FROM payments").scalar(), 10000
+            )
+            self.assertEqual(ledger_balance(1, date(2015, 2, 1), session), 3333)
+        finally:
+            session.close()
+
+
+# The tables as the first version of the models created them, with whole
+# dollar amounts and no ledger, triggers or indexes.
+BASELINE_SCHEMA = (
+    "CREATE TABLE contacts (id INTEGER NOT NULL, name VARCHAR(128) NOT NULL, "
+    "role VARCHAR(13) NOT NULL, PRIMARY KEY (id), "
+    "CHECK (role IN ('Named Insured', 'Agent')))",
+    "CREATE TABLE policies (id INTEGER NOT NULL, "
+    "policy_number VARCHAR(128) NOT NULL, effective_date DATE NOT NULL, "
+    "status VARCHAR(8) NOT NULL, billing_schedule VARCHAR(9) NOT NULL, "
+    "annual_premium INTEGER NOT NULL, named_insured INTEGER, agent INTEGER, "
+    "cancel_date DATE, cancel_reason VARCHAR(128), PRIMARY KEY (id), "
+    "CHECK (status IN ('Active', 'Canceled', 'Expired')), "
+    "CHECK (billing_schedule IN ('Annual', 'Two-Pay', 'Quarterly', 'Monthly')), "
+    "FOREIGN KEY(named_insured) REFERENCES contacts (id), "
+    "FOREIGN KEY(agent) REFERENCES contacts (id))",
+    "CREATE TABLE invoices (id INTEGER NOT NULL, policy_id INTEGER NOT NULL, "
+    "bill_date DATE NOT NULL, due_date DATE NOT NULL, cancel_date DATE NOT NULL, "
+    "amount_due INTEGER NOT NULL, deleted BOOLEAN DEFAULT '0' NOT NULL, "
+    "PRIMARY KEY (id), FOREIGN KEY(policy_id) REFERENCES policies (id), "
+    "CHECK (deleted IN (0, 1)))",
+    "CREATE TABLE payments (id INTEGER NOT NULL, policy_id INTEGER NOT NULL, "
+    "contact_id INTEGER NOT NULL, amount_paid INTEGER NOT NULL, "
+    "transaction_date DATE NOT NULL, PRIMARY KEY (id), "
+    "FOREIGN KEY(policy_id) REFERENCES policies (id), "
+    "FOREIGN KEY(contact_id) REFERENCES contacts (id))",
+)
+
+
+class TestBaselineUpgrade(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        self.engine = create_engine("sqlite:///" + self.path)
+        with self.engine.begin() as connection:
+            for statement in BASELINE_SCHEMA:
+                connection.execute(statement)
+            connection.execute(
+                "INSERT INTO contacts (id, name, role) "
+                "VALUES (1, 'Old Insured', 'Named Insured')"
+            )
+            connection.execute(
+                "INSERT INTO policies (id, policy_number, effective_date, status, "
+                "billing_schedule, annual_premium) "
+                "VALUES (1, 'Old Policy', '2015-01-01', 'Active', 'Two-Pay', 1600)"
+            )
+            connection.execute(
+                "INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, "
+                "amount_due, deleted) VALUES "
+                "(1, '2015-01-01', '2015-02-01', '2015-02-15', 800, 0), "
+                "(1, '2015-07-01', '2015-08-01', '2015-08-15', 800, 0), "
+                "(1, '2015-07-01', '2015-08-01', '2015-08-15', 500, 1)"
+            )
+            connection.execute(
+                "INSERT INTO payments (policy_id, contact_id, amount_paid, "
+                "transaction_date) VALUES (1, 1, 300, '2015-01-10')"
+            )
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_upgrades_to_current_schema(self):
+        self.assertTrue(upgrade(self.engine))
+        self.assertEqual(upgrade(self.engine), [])
+        self.assertEqual(schema_version(self.engine), SCHEMA_VERSION)
+        triggers = {
+            name
+            for name, in self.engine.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+            )
+        }
+        self.assertEqual(len(triggers), len(LEDGER_TRIGGERS + VERSION_TRIGGERS))
+
+        session = Session(bind=self.engine)
+        try:
+            self.assertEqual(session.query(Policy.annual_premium).scalar(), 1600)
+            self.assertEqual(session.query(Policy.version).scalar(), 0)
+            self.assertEqual(ledger_balance(1, date(2015, 7, 1), session), 130000)
+            session.add(Payment(1, 1, 1300, date(2015, 7, 10)))
+            session.commit()
+            self.assertEqual(ledger_balance(1, date(2015, 7, 10), session), 0)
+            self.assertEqual(session.query(Policy.version).scalar(), 1)
+            # The rebuilt table takes the schedule its CHECK refused.
+            session.query(Policy).update({"billing_schedule": "Semi-Annual"})
+            session.commit()
+            with self.assertRaises(IntegrityError):
+                session.add(Policy("Old Policy", date(2015, 1, 1), 1))
+                session.commit()
+        finally:
+            session.rollback()
+            session.close()
+
+
+class TestArchive(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+        cls.policy = Policy("Test Archive Policy", date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Monthly"
+        cls.policy.named_insured = cls.test_insured.id
+        DBSession.add(cls.policy)
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        for model in (InvoiceArchive, Invoice, LedgerEntry):
+            DBSession.query(model).filter_by(policy_id=cls.policy.id).delete()
+        DBSession.delete(cls.policy)
+        DBSession.delete(cls.test_insured)
+        DBSession.commit()
+
+    def test_archives_soft_deleted_invoices(self):
+        pa = PolicyAccounting(self.policy.id)
+        deleted = []
+        for invoice in DBSession.query(Invoice).filter_by(policy_id=self.policy.id):
+            if invoice.bill_date.month % 3 == 0:
+                invoice.deleted = True
+                deleted.append((invoice.id, invoice.bill_date, invoice.amount_due))
+        DBSession.commit()
+        balance = pa.return_account_balance(date(2015, 12, 31))
+
+        self.assertEqual(archive_deleted_invoices(batch_size=3), len(deleted))
+        self.assertEqual(archive_deleted_invoices(batch_size=3), 0)
+        self.assertEqual(
+            DBSession.query(Invoice).filter_by(policy_id=self.policy.id).count(), 8
+        )
+        self.assertEqual(
+            [
+                (row.invoice_id, row.bill_date, row.amount_due)
+                for row in DBSession.query(InvoiceArchive)
+                .filter_by(policy_id=self.policy.id)
+                .order_by(InvoiceArchive.invoice_id)
+            ],
+            deleted,
+        )
+        balance_cache.clear()
+        self.assertEqual(pa.return_account_balance(date(2015, 12, 31)), balance)
+        self.assertEqual(balance, 800)
+        self.assertNotIn(self.policy.id, check_ledger())
+
+    def test_compact(self):
+        # On a scratch database: fresh ANALYZE statistics for the tiny
+        # test tables would change the plans TestQueryPlans checks.
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        scratch = create_engine("sqlite:///" + path)
+        try:
+            Base.metadata.create_all(scratch)
+            compact(scratch)
+            self.assertTrue(
+                scratch.execute(
+                    "SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'"
+                ).scalar()
+            )
+        finally:
+            scratch.dispose()
+            os.remove(path)
+
+
+class PaymentBooksMixin(object):
+    """
+    Two identical books, A and B, of policy_count active policies plus a
+    canceled one, with one named insured and one agent. Tests post
+    payments to book A in bulk and replay them on book B one at a time
+    with make_payment, then compare.
+    """
+
+    name = None
+    policy_count = 6
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("{0} Agent".format(cls.name), "Agent")
+        cls.test_insured = Contact("{0} Insured".format(cls.name), "Named Insured")
+        DBSession.add(cls.test_agent)
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+
+        cls.policies = {}
+        for book in ("A", "B"):
+            for i in range(cls.policy_count + 1):
+                policy = Policy(cls.policy_number(book, i), date(2015, 1, 1), 1200)
+                policy.billing_schedule = ("Monthly", "Quarterly")[i % 2]
+                policy.named_insured = cls.test_insured.id
+                policy.agent = cls.test_agent.id
+                DBSession.add(policy)
+                cls.policies[book, i] = policy
+        DBSession.commit()
+        for (book, i), policy in cls.policies.items():
+            PolicyAccounting(policy.id)
+            if i == cls.policy_count:
+                policy.status = "Canceled"
+                policy.cancel_date = date(2015, 3, 1)
+                policy.cancel_reason = "Underwriting"
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies.values():
+            DBSession.query(Payment).filter_by(policy_id=policy.id).delete()
+            DBSession.query(Invoice).filter_by(policy_id=policy.id).delete()
+            DBSession.delete(policy)
+        DBSession.delete(cls.test_insured)
+        DBSession.delete(cls.test_agent)
+        DBSession.commit()
+
+    def tearDown(self):
+        for policy in self.policies.values():
+            DBSession.query(Payment).filter_by(policy_id=policy.id).delete()
+        DBSession.commit()
+        balance_cache.clear()
+
+    @classmethod
+    def policy_number(cls, book, i):
+        return "{0} {1} {2}".format(cls.name, book, i)
+
+    def random_payments(self, count):
+        """
+        (i, amount, transaction date, contact id) of payments to the i-th
+        policy of a book, some of them to a policy number past the last
+        one and to a contact that does not exist
+        """
+        rng = random.Random(20150601)
+        contacts = [0, self.test_insured.id, self.test_agent.id, 999999]
+        return [
+            (
+                rng.randint(0, self.policy_count + 1),
+                rng.choice([50, 100, 300]),
+                date(2015, 1, 1) + timedelta(days=rng.randint(0, 364)),
+                rng.choice(contacts),
+            )
+            for _ in range(count)
+        ]
+
+    def pay_book_b(self, payments):
+        """
+        make_payment every one of random_payments on book B
+        :return: None or the type of the exception, per payment
+        """
+        outcomes = []
+        for i, amount, day, contact in payments:
+            try:
+                policy_id = (
+                    DBSession.query(Policy.id)
+                    .filter_by(policy_number=self.policy_number("B", i))
+                    .one()
+                    .id
+                )
+                PolicyAccounting(policy_id).make_payment(contact, day, amount)
+            except (NoResultFound, UserWarning) as error:
+                DBSession.rollback()
+                outcomes.append(type(error))
+                continue
+            outcomes.append(None)
+        self.assertTrue(None in outcomes and UserWarning in outcomes)
+        return outcomes
+
+    def assertBooksMatch(self):
+        for i in range(self.policy_count):
+            self.assertEqual(
+                ledger_balance(self.policies["A", i].id, date(2016, 1, 1)),
+                ledger_balance(self.policies["B", i].id, date(2016, 1, 1)),
+            )
+
+
+class TestLockbox(PaymentBooksMixin, unittest.TestCase):
+    name = "Test Lockbox"
+
+    def lockbox(self, rows):
+        lines = io.StringIO()
+        writer = csv.writer(lines)
+        writer.writerow(["policy_number", "amount", "transaction_date", "contact_id"])
+        writer.writerows(rows)
+        lines.seek(0)
+        return lines
+
+    def test_posts_payments_and_reports_rejections(self):
+        insured, agent = self.test_insured.id, self.test_agent.id
+        policy = self.policies["A", 0]
+        pa = PolicyAccounting(policy.id)
+        self.assertEqual(pa.return_account_balance("2015-03-20"), 300)
+        report = ingest_payments(
+            self.lockbox(
+                [
+                    ["Test Lockbox A 0", "100", "2015-01-10", ""],
+                    ["Nobody's Policy", "100", "2015-01-10", ""],
+                    ["Test Lockbox A 6", "100", "2015-01-10", ""],
+                    ["Test Lockbox A 0", "ten", "2015-01-10", ""],
+                    ["Test Lockbox A 0", "-5", "2015-01-10", ""],
+                    ["Test Lockbox A 0", "100", "03/20/2015", ""],
+                    ["Test Lockbox A 0", "100", "2015-01-10", "999999"],
+                    # February's invoice went past due on March 1st and
+                    # later payments do not change that.
+                    ["Test Lockbox A 0", "100", "2015-03-10", insured],
+                    ["Test Lockbox A 0", "100", "2015-03-10", agent],
+                    ["Test Lockbox A 0", "100", "2015-03-10", insured],
+                ]
+            ),
+            chunk_size=4,
+        )
+        self.assertEqual(report.accepted, 2)
+        self.assertEqual(report.amount, 20000)
+        self.assertEqual(
+            [(line, reason) for line, _, reason in report.rejected],
+            [
+                (3, "unknown policy number"),
+                (4, "policy is canceled"),
+                (5, "bad amount 'ten'"),
+                (6, "amount must be positive"),
+                (7, "bad transaction date '03/20/2015'"),
+                (8, "unknown contact 999999"),
+                (9, "policy is past due, only an agent can make a payment"),
+                (11, "policy is past due, only an agent can make a payment"),
+            ],
+        )
+        self.assertEqual(
+            DBSession.query(Payment).filter_by(policy_id=policy.id).count(), 2
+        )
+        self.assertEqual(pa.return_account_balance("2015-03-20"), 100)
+
+    def test_dry_run_writes_nothing(self):
+        report = ingest_payments(
+            self.lockbox([["Test Lockbox A 1", "300", "2015-01-10", ""]]),
+            dry_run=True,
+        )
+        self.assertEqual(report.accepted, 1)
+        self.assertEqual(
+            DBSession.query(Payment)
+            .filter_by(policy_id=self.policies["A", 1].id)
+            .count(),
+            0,
+        )
+
+    def triggers(self):
+        return sorted(
+            name
+            for (name,) in DBSession.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+            )
+        )
+
+    def test_deferred_triggers(self):
+        triggers = self.triggers()
+        policy_ids = [self.policies["A", i].id for i in (0, 1)]
+
+        def versions():
+            return [
+                DBSession.query(Policy.version).filter_by(id=policy_id).scalar()
+                for policy_id in policy_ids
+            ]
+
+        before = versions()
+        ingest_payments(
+            self.lockbox(
+                [
+                    ["Test Lockbox A 0", "100", "2015-01-10", ""],
+                    ["Test Lockbox A 0", "50", "2015-01-20", ""],
+                    ["Test Lockbox A 1", "300", "2015-01-10", ""],
+                ]
+            )
+        )
+        # One bump per policy paid, the ledger is rebuilt for both.
+        self.assertEqual(versions(), [version + 1 for version in before])
+        self.assertEqual(ledger_balance(policy_ids[0], date(2015, 1, 20)), -5000)
+        self.assertFalse(set(policy_ids) & set(check_ledger()))
+        self.assertEqual(self.triggers(), triggers)
+
+        def failing_file():
+            yield "policy_number,amount,transaction_date\n"
+            yield "Test Lockbox A 1,100,2015-01-20\n"
+            raise IOError("connection reset")
+
+        with self.assertRaises(IOError):
+            ingest_payments(failing_file(), chunk_size=1)
+        self.assertEqual(self.triggers(), triggers)
+        self.assertEqual(
+            DBSession.query(Payment).filter_by(policy_id=policy_ids[1]).count(), 1
+        )
+
+    def test_missing_columns(self):
+        with self.assertRaises(UserWarning):
+            ingest_payments(io.StringIO("policy_number,amount\nx,1\n"))
+
+    def test_matches_make_payment(self):
+        payments = self.random_payments(200)
+        report = ingest_payments(
+            self.lockbox(
+                [self.policy_number("A", i), amount, day, contact or ""]
+                for i, amount, day, contact in payments
+            ),
+            chunk_size=16,
+        )
+        outcomes = self.pay_book_b(payments)
+
+        rejected = [rejection.line for rejection in report.rejected]
+        self.assertEqual(
+            sorted(set(range(2, len(payments) + 2)) - set(rejected)),
+            [line for line, outcome in enumerate(outcomes, 2) if outcome is None],
+        )
+        self.assertBooksMatch()
+
+
+class TestPaymentWriter(PaymentBooksMixin, unittest.TestCase):
+    name = "Test Writer"
+
+    def held_writer(self, **options):
+        """
+        A started PaymentWriter stuck on its first payment until release
+        is set, and the event set once it got there
+        """
+        entered, release = threading.Event(), threading.Event()
+
+        def held_session():
+            entered.set()
+            release.wait(5)
+            return Session()
+
+        writer = PaymentWriter(session_factory=held_session, **options).start()
+        return writer, entered, release
+
+    def test_commits_in_groups(self):
+        policy = self.policies["A", 0]
+        pa = PolicyAccounting(policy.id)
+        self.assertEqual(pa.return_account_balance("2015-12-31"), 1200)
+        writer, entered, release = self.held_writer(max_batch=5, max_delay=5)
+        futures = [writer.submit(policy.id, date_cursor=date(2015, 1, 1), amount=10)]
+        self.assertTrue(entered.wait(5))
+        futures += [
+            writer.submit(policy.id, date_cursor=date(2015, 1, 1), amount=10)
+            for _ in range(11)
+        ]
+        release.set()
+        # The lone first payment, two full groups of what queued up behind
+        # it, then stopping closes the last one before its delay is up.
+        writer.stop()
+        self.assertEqual(writer.groups, 4)
+        self.assertEqual(writer.written, 12)
+        payment_ids = [future.result(timeout=0) for future in futures]
+        self.assertEqual(len(set(payment_ids)), 12)
+        self.assertEqual(
+            DBSession.query(Payment).filter(Payment.id.in_(payment_ids)).count(), 12
+        )
+        # The ORM flush of the writer invalidated the cached balance.
+        self.assertEqual(pa.return_account_balance("2015-12-31"), 1080)
+        with self.assertRaises(UserWarning):
+            writer.submit(policy.id, amount=10)
+
+    def test_refuses_like_make_payment(self):
+        insured, agent = self.test_insured.id, self.test_agent.id
+        policy = self.policies["A", 0]
+        with PaymentWriter(max_delay=5) as writer:
+            futures = [
+                writer.submit(policy.id, 0, date(2015, 1, 10), 100),
+                writer.submit(999999, 0, date(2015, 1, 10), 100),
+                writer.submit(
+                    self.policies["A", self.policy_count].id, 0, date(2015, 1, 10), 100
+                ),
+                writer.submit(policy.id, 999999, date(2015, 1, 10), 100),
+                # February's invoice went past due on March 1st and
+                # later payments do not change that.
+                writer.submit(policy.id, insured, date(2015, 3, 10), 100),
+                writer.submit(policy.id, agent, date(2015, 3, 10), 300),
+                writer.submit(policy.id, insured, date(2015, 3, 10), 100),
+                # The agent's payment of the same group settled March.
+                writer.submit(policy.id, insured, date(2015, 4, 10), 100),
+            ]
+        errors = [future.exception(timeout=0) for future in futures]
+        self.assertEqual(
+            [type(error).__name__ if error else None for error in errors],
+            [
+                None,
+                "NoResultFound",
+                "UserWarning",
+                "NoResultFound",
+                "UserWarning",
+                None,
+                "UserWarning",
+                None,
+            ],
+        )
+        self.assertIn("canceled", str(errors[2]))
+        self.assertIn("only an agent", str(errors[4]))
+        self.assertEqual(
+            DBSession.query(Payment.contact_id)
+            .filter_by(policy_id=policy.id)
+            .order_by(Payment.id)
+            .all(),
+            [(insured,), (agent,), (insured,)],
+        )
+
+    def test_matches_make_payment(self):
+        payments = self.random_payments(120)
+        with PaymentWriter(max_batch=16, max_delay=5) as writer:
+            futures = [
+                writer.submit(
+                    getattr(self.policies.get(("A", i)), "id", -1),
+                    contact,
+                    day,
+                    amount,
+                )
+                for i, amount, day, contact in payments
+            ]
+        self.assertGreater(writer.groups, 1)
+        outcomes = self.pay_book_b(payments)
+
+        self.assertEqual(
+            [
+                type(future.exception(timeout=0)) if future.exception() else None
+                for future in futures
+            ],
+            outcomes,
+        )
+        self.assertBooksMatch()
+
+    def test_bounded_queue(self):
+        policy_id = self.policies["A", 1].id
+        writer, entered, release = self.held_writer(max_delay=0, max_queue=1)
+        try:
+            first = writer.submit(policy_id, date_cursor=date(2015, 1, 1), amount=1)
+            self.assertTrue(entered.wait(5))
+            second = writer.submit(policy_id, date_cursor=date(2015, 1, 1), amount=1)
+            with self.assertRaises(UserWarning):
+                writer.submit(
+                    policy_id, date_cursor=date(2015, 1, 1), amount=1, timeout=0.01
+                )
+        finally:
+            release.set()
+            writer.stop()
+        self.assertTrue(first.result(timeout=0) and second.result(timeout=0))
+
+    def test_survives_a_failed_group(self):
+        policy_id = self.policies["A", 1].id
+        sessions = iter([RuntimeError("no connection")])
+
+        def failing_session():
+            error = next(sessions, None)
+            if error:
+                raise error
+            return Session()
+
+        with PaymentWriter(max_delay=0, session_factory=failing_session) as writer:
+            with self.assertRaises(RuntimeError):
+                writer.make_payment(policy_id, 0, date(2015, 1, 1), 1, timeout=5)
+            self.assertTrue(writer.make_payment(policy_id, 0, date(2015, 1, 1), 1))
+        self.assertEqual(
+            DBSession.query(Payment).filter_by(policy_id=policy_id).count(), 1
+        )
+
+    def test_make_payment_waits_a_bounded_time(self):
+        policy_id = self.policies["A", 1].id
+        writer, entered, release = self.held_writer(max_delay=0)
+        try:
+            first = writer.submit(policy_id, date_cursor=date(2015, 1, 1), amount=1)
+            self.assertTrue(entered.wait(5))
+            # Still queued when the time is up, so it is never written.
+            with self.assertRaisesRegex(UserWarning, "not written"):
+                writer.make_payment(policy_id, 0, date(2015, 1, 1), 1, timeout=0.05)
+        finally:
+            release.set()
+            writer.stop()
+        self.assertTrue(first.result(timeout=0))
+        self.assertEqual(
+            DBSession.query(Payment).filter_by(policy_id=policy_id).count(), 1
+        )
+
+
+# Runs a statement export and prints the peak RSS of the process in KiB.
+# ru_maxrss can carry the high-water mark of the forking parent over,
+# VmHWM belongs to the exec'ed process alone.
+EXPORT_PEAK_RSS_SCRIPT = """
+import resource, runpy, sys
+sys.argv = ["statements", "--from", "2015-06-01", "--to", "2015-12-31",
+            "--format", "ndjson", "--output", {output!r}]
+runpy.run_module("accounting.statements", run_name="__main__")
+try:
+    with open("/proc/self/status") as status:
+        print([line.split()[1] for line in status if line.startswith("VmHWM:")][0])
+except (OSError, IndexError):
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+class TestStatements(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+        cls.policy = Policy("Test Statement Policy", date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        DBSession.add(cls.policy)
+        DBSession.commit()
+        cls.pa = PolicyAccounting(cls.policy.id)
+        for day, amount in ((date(2015, 1, 20), 300), (date(2015, 4, 1), 150)):
+            DBSession.add(Payment(cls.policy.id, cls.test_insured.id, amount, day))
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.query(Payment).filter_by(policy_id=cls.policy.id).delete()
+        DBSession.query(Invoice).filter_by(policy_id=cls.policy.id).delete()
+        DBSession.delete(cls.policy)
+        DBSession.delete(cls.test_insured)
+        DBSession.commit()
+
+    def lines(self, date_from, date_to):
+        return [
+            line
+            for line in statement_lines(date_from, date_to, chunk_size=2)
+            if line.policy_number == self.policy.policy_number
+        ]
+
+    def test_lines_follow_the_balance(self):
+        lines = self.lines(date(2015, 2, 1), date(2015, 7, 31))
+        self.assertEqual(
+            [(line.date, line.entry, line.amount, line.balance) for line in lines],
+            [
+                (date(2015, 2, 1), "opening", None, 0),
+                (date(2015, 4, 1), "invoice", 300, 300),
+                (date(2015, 4, 1), "payment", 150, 150),
+                (date(2015, 7, 1), "invoice", 300, 450),
+            ],
+        )
+        self.assertEqual(
+            lines[-1].balance, self.pa.return_account_balance(date(2015, 7, 31))
+        )
+
+    def test_quiet_period_still_has_an_opening_line(self):
+        lines = self.lines(date(2015, 5, 1), date(2015, 5, 31))
+        self.assertEqual(
+            [(line.entry, line.balance) for line in lines], [("opening", 150)]
+        )
+
+    def test_writers(self):
+        lines = self.lines(date(2015, 1, 1), date(2015, 12, 31))
+        out = io.StringIO()
+        self.assertEqual(write_csv(lines, out), len(lines))
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows[-1]["balance"], "750")
+        out = io.StringIO()
+        write_ndjson(lines, out)
+        rows = [json.loads(row) for row in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), len(lines))
+        self.assertEqual(rows[1]["entry"], "invoice")
+        self.assertEqual(rows[1]["amount"], "300")
+
+    def peak_rss_kb(self, policy_count):
+        """
+        Peak RSS of a process exporting a scratch book of policy_count
+        monthly policies
+        """
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        uri = "sqlite:///" + path
+        scratch = create_engine(uri)
+        try:
+            Base.metadata.create_all(scratch)
+            with scratch.begin() as connection:
+                # The export does not read the ledger, skip its upkeep.
+                for statement in LEDGER_TRIGGERS:
+                    name = statement.split()[5]
+                    connection.execute("DROP TRIGGER {0}".format(name))
+                connection.execute(
+                    Policy.__table__.insert(),
+                    [
+                        {
+                            "id": i + 1,
+                            "policy_number": "Policy {0}".format(i),
+                            "effective_date": date(2015, 1, 1),
+                            "billing_schedule": "Monthly",
+                            "annual_premium": 1200,
+                        }
+                        for i in range(policy_count)
+                    ],
+                )
+                connection.execute(
+                    Invoice.__table__.insert(),
+                    [
+                        {
+                            "policy_id": i + 1,
+                            "bill_date": date(2015, month, 1),
+                            "due_date": date(2015, month, 15),
+                            "cancel_date": date(2015, month, 28),
+                            "amount_due": 100,
+                        }
+                        for i in range(policy_count)
+                        for month in range(1, 13)
+                    ],
+                )
+            script = EXPORT_PEAK_RSS_SCRIPT.format(output=os.devnull)
+            result = subprocess.run(
+                [sys.executable, "-c", script],
+                env=dict(os.environ, ACCOUNTING_DATABASE_URI=uri),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            )
+            return int(result.stdout.split()[-1])
+        finally:
+            scratch.dispose()
+            os.remove(path)
+
+    def test_memory_stays_flat(self):
+        small = self.peak_rss_kb(1000)
+        large = self.peak_rss_kb(8000)
+        # 84000 more invoices; holding them would take tens of MB.
+        self.assertLess(large - small, 8 * 1024, (small, large))
+
+
+def fifo_aging(date_cursor):
+    """
+    Aging buckets in cents per billing schedule, one policy at a time:
+    the paid total goes to the oldest invoices first
+    """
+    totals = {}
+    for policy in DBSession.query(Policy).order_by(Policy.id):
+        paid = sum(
+            to_cents(payment.amount_paid)
+            for payment in DBSession.query(Payment)
+            .filter_by(policy_id=policy.id)
+            .filter(Payment.transaction_date <= date_cursor)
+        )
+        invoices = (
+            DBSession.query(Invoice)
+            .filter_by(policy_id=policy.id, deleted=False)
+            .filter(Invoice.bill_date <= date_cursor)
+            .order_by(Invoice.bill_date, Invoice.id)
+        )
+        for invoice in invoices:
+            amount = to_cents(invoice.amount_due)
+            applied = min(paid, amount)
+            paid -= applied
+            days = (date_cursor - invoice.due_date).days
+            bucket = next(
+                (
+                    index
+                    for index, (_, _, high) in enumerate(BUCKETS)
+                    if high is None or days <= high
+                ),
+            )
+            buckets = totals.setdefault(policy.billing_schedule, [0] * len(BUCKETS))
+            buckets[bucket] += amount - applied
+    DBSession.rollback()
+    return totals
+
+
+class TestAgingReport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Aging Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add_all([cls.test_agent, cls.test_insured])
+        DBSession.commit()
+        cls.policies = []
+        for number, schedule, premium, effective_date in (
+            ("Test Aging Quarterly", "Quarterly", 1200, date(2015, 1, 1)),
+            ("Test Aging Annual", "Annual", 500, date(2015, 6, 1)),
+        ):
+            policy = Policy(number, effective_date, premium)
+            policy.billing_schedule = schedule
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            DBSession.add(policy)
+            DBSession.commit()
+            PolicyAccounting(policy.id)
+            cls.policies.append(policy)
+        PolicyAccounting(cls.policies[0].id).make_payment(
+            cls.test_insured.id, date(2015, 1, 20), 400
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies:
+            DBSession.query(Invoice).filter_by(policy_id=policy.id).delete()
+            DBSession.query(Payment).filter_by(policy_id=policy.id).delete()
+            DBSession.query(LedgerEntry).filter_by(policy_id=policy.id).delete()
+            DBSession.delete(policy)
+        DBSession.delete(cls.test_agent)
+        DBSession.delete(cls.test_insured)
+        DBSession.commit()
+
+    def test_payments_go_to_the_oldest_invoice_first(self):
+        rows = aging_report(date(2015, 6, 15), group_by="agent")
+        (row,) = [row for row in rows if row.group == self.test_agent.id]
+        # 400 paid covers January's 300 and 100 of April's invoice, due
+        # May 1st. June's annual invoice is not due until July 1st.
+        self.assertEqual(row.current, 500)
+        self.assertEqual(row.days_31_60, 200)
+        self.assertEqual(row.days_1_30 + row.days_61_90 + row.over_90, 0)
+        self.assertEqual(row.total, 700)
+
+    def test_matches_policy_by_policy_walk(self):
+        for date_cursor in (date(2015, 3, 15), date(2015, 8, 20), date(2016, 2, 1)):
+            expected = fifo_aging(date_cursor)
+            rows = aging_report(date_cursor, group_by="billing_schedule")
+            self.assertEqual(
+                {row.group: [to_cents(amount) for amount in row[1:-1]] for row in rows},
+                expected,
+                date_cursor,
+            )
+            (book,) = aging_report(date_cursor)
+            self.assertEqual(
+                to_cents(book.total), sum(sum(buckets) for buckets in expected.values())
+            )
+
+    def test_csv_output(self):
+        out = io.StringIO()
+        print_aging_report(
+            date(2015, 6, 15), "billing_schedule", output_format="csv", out=out
+        )
+        lines = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(lines[0][0], "group")
+        self.assertIn("Quarterly", [line[0] for line in lines[1:]])
+
+    def test_unknown_grouping(self):
+        with self.assertRaises(UserWarning):
+            aging_report(date(2015, 6, 15), group_by="named_insured")
+
+
+class TestInvoicesEndpoint(unittest.TestCase):
+    # Requests remove the session of the thread they run on, so this suite
+    # keeps ids around instead of ORM objects.
+    @classmethod
+    def setUpClass(cls):
+        insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(insured)
+        DBSession.commit()
+        policy = Policy("Test Endpoint Policy", date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        policy.named_insured = insured.id
+        DBSession.add(policy)
+        DBSession.commit()
+        PolicyAccounting(policy.id)
+        cls.insured_id, cls.policy_id = insured.id, policy.id
+        DBSession.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.query(Invoice).filter_by(policy_id=cls.policy_id).delete()
+        DBSession.query(Policy).filter_by(id=cls.policy_id).delete()
+        DBSession.query(Contact).filter_by(id=cls.insured_id).delete()
+        DBSession.commit()
+
+    def get_invoices(self, client, date_cursor="2015-05-01"):
+        return client.get(
+            "/policy/api/invoices",
+            query_string={
+                "policy_number": "Test Endpoint Policy",
+                "date_cursor": date_cursor,
+            },
+        )
+
+    def test_returns_balance_and_invoices(self):
+        response = self.get_invoices(app.test_client())
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data["balance"], "600")
+        self.assertEqual(len(data["invoices"]), 4)
+
+    def test_at_most_two_round_trips(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        client = app.test_client()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            response = self.get_invoices(client)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["balance"], "600")
+        self.assertLessEqual(len(statements), 2, "\n".join(statements))
+
+    def test_conditional_get(self):
+        client = app.test_client()
+        response = self.get_invoices(client)
+        etag = response.headers["ETag"]
+        self.assertIsNotNone(response.last_modified)
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            response = client.get(
+                "/policy/api/invoices",
+                query_string={
+                    "policy_number": "Test Endpoint Policy",
+                    "date_cursor": "2015-05-01",
+                },
+                headers={"If-None-Match": etag},
+            )
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b"")
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(len(statements), 1)
+
+        # A payment changes the balance, and so the version.
+        payment = Payment(self.policy_id, self.insured_id, 100, date(2015, 2, 1))
+        DBSession.add(payment)
+        DBSession.commit()
+        payment_id = payment.id
+        try:
+            response = client.get(
+                "/policy/api/invoices",
+                query_string={
+                    "policy_number": "Test Endpoint Policy",
+                    "date_cursor": "2015-05-01",
+                },
+                headers={"If-None-Match": etag},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["ETag"], etag)
+            self.assertEqual(response.get_json()["balance"], "500")
+        finally:
+            DBSession.query(Payment).filter_by(id=payment_id).delete()
+            DBSession.commit()
+
+    def test_encoders_agree(self):
+        client = app.test_client()
+        fast = self.get_invoices(client).get_data()
+        app.config["FAST_JSON"] = False
+        try:
+            slow = self.get_invoices(client).get_data()
+        finally:
+            app.config["FAST_JSON"] = True
+        self.assertEqual(fast, slow)
+        first = json.loads(fast)["invoices"][0]
+        self.assertEqual(first["bill_date"], "2015-01-01")
+        self.assertEqual(first["due_date"], "2015-02-01")
+        self.assertEqual(first["amount_due"], 300)
+
+    def get_batch(self, client, policy_numbers, date_cursor="2015-05-01"):
+        return client.post(
+            "/policy/api/invoices/batch",
+            json={"policy_numbers": policy_numbers, "date_cursor": date_cursor},
+        )
+
+    def test_batch_matches_single_policy_endpoint(self):
+        client = app.test_client()
+        single = self.get_invoices(client).get_json()
+        response = self.get_batch(client, ["Test Endpoint Policy", "No Such Policy"])
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data["not_found"], ["No Such Policy"])
+        self.assertEqual(len(data["policies"]), 1)
+        batched = data["policies"][0]
+        self.assertEqual(batched["policy_number"], "Test Endpoint Policy")
+        self.assertEqual(batched["balance"], single["balance"])
+        self.assertEqual(
+            batched["invoices"], sorted(single["invoices"], key=lambda i: i["id"])
+        )
+
+    def test_batch_statement_count(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        client = app.test_client()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            response = self.get_batch(
+                client, ["Test Endpoint Policy"] + ["Missing %d" % i for i in range(50)]
+            )
+            response.get_data()
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 2)
+
+    def test_batch_rejects_bad_input(self):
+        client = app.test_client()
+        self.assertEqual(self.get_batch(client, "Policy One").status_code, 400)
+        self.assertEqual(
+            self.get_batch(client, ["Policy One"], "01/05/2015").status_code, 400
+        )
+
+    def test_concurrent_requests(self):
+        results = []
+
+        def worker():
+            client = app.test_client()
+            for _ in range(10):
+                response = self.get_invoices(client)
+                results.append((response.status_code, response.get_json()))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 80)
+        for status_code, data in results:
+            self.assertEqual(status_code, 200)
+            self.assertEqual(data["balance"], "600")
+
+
+class TestMetrics(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        policy = Policy("Test Metrics Policy", date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        DBSession.add(policy)
+        DBSession.commit()
+        PolicyAccounting(policy.id)
+        cls.policy_id = policy.id
+        DBSession.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.query(Invoice).filter_by(policy_id=cls.policy_id).delete()
+        DBSession.query(Policy).filter_by(id=cls.policy_id).delete()
+        DBSession.commit()
+
+    def setUp(self):
+        metrics.registry.clear()
+        balance_cache.clear()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.registry.clear()
+
+    def test_disabled_adds_nothing(self):
+        original = PolicyAccounting.__dict__["return_account_balance"]
+        metrics.enable()
+        self.assertIsNot(PolicyAccounting.__dict__["return_account_balance"], original)
+        metrics.disable()
+        self.assertIs(PolicyAccounting.__dict__["return_account_balance"], original)
+        self.assertFalse(
+            event.contains(
+                engine, "before_cursor_execute", metrics._before_cursor_execute
+            )
+        )
+        PolicyAccounting(self.policy_id).return_account_balance("2015-05-01")
+        self.assertEqual(metrics.registry.render().count("\n"), 8)
+        self.assertEqual(app.test_client().get("/metrics").status_code, 404)
+
+    def test_counts_statements_per_method(self):
+        metrics.enable()
+        pa = PolicyAccounting(self.policy_id)
+        pa.return_account_balance("2015-05-01")
+        pa.evaluate_cancel("2015-05-01")
+        self.assertEqual(
+            metrics.registry.counter(
+                "accounting_sql_statements_total",
+                (("section", "PolicyAccounting.return_account_balance"),),
+            ),
+            1,
+        )
+        # evaluate_cancel runs its query inside find_cancel_invoice.
+        self.assertGreater(
+            metrics.registry.counter(
+                "accounting_sql_statements_total",
+                (("section", "PolicyAccounting.find_cancel_invoice"),),
+            ),
+            0,
+        )
+        self.assertEqual(
+            metrics.registry.histogram(
+                "accounting_section_duration_seconds",
+                (("section", "PolicyAccounting.evaluate_cancel"),),
+            ).count,
+            1,
+        )
+
+    def test_metrics_endpoint(self):
+        metrics.enable()
+        client = app.test_client()
+        response = client.get(
+            "/policy/api/invoices",
+            query_string={
+                "policy_number": "Test Metrics Policy",
+                "date_cursor": "2015-05-01",
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        body = response.get_data(as_text=True)
+        self.assertIn(
+            "accounting_http_request_duration_seconds_count"
+            '{endpoint="get_tasks",method="GET",status="200"} 1\n',
+            body,
+        )
+        self.assertIn(
+            "accounting_http_request_duration_seconds_bucket"
+            '{endpoint="get_tasks",method="GET",status="200",le="+Inf"} 1\n',
+            body,
+        )
+        # The policy's version, then its invoices with the balance.
+        self.assertIn(
+            'accounting_sql_statements_total{section="get_tasks.lookup"} 2\n', body
+        )
+        self.assertIn(
+            'accounting_section_duration_seconds_count{section="get_tasks.serialize"} 1',
+            body,
+        )
+
+
+class TestAsyncEndpoint(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(insured)
+        DBSession.commit()
+        # The first policy is left unbilled for the endpoint to bill it.
+        policies = []
+        for policy_number in ("Test Async Policy", "Test Async Evaluations"):
+            policy = Policy(policy_number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = "Quarterly"
+            policy.named_insured = insured.id
+            DBSession.add(policy)
+            policies.append(policy)
+        DBSession.commit()
+        cls.insured_id = insured.id
+        cls.policy_ids = [policy.id for policy in policies]
+        cls.policy_id = cls.policy_ids[1]
+        DBSession.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        for model in (Payment, Invoice):
+            DBSession.query(model).filter(model.policy_id.in_(cls.policy_ids)).delete(
+                synchronize_session=False
+            )
+        DBSession.query(Policy).filter(Policy.id.in_(cls.policy_ids)).delete(
+            synchronize_session=False
+        )
+        DBSession.query(Contact).filter_by(id=cls.insured_id).delete()
+        DBSession.commit()
+
+    def run_async(self, test):
+        async def run():
+            async with TestClient(TestServer(create_async_app(pool_size=2))) as client:
+                return await test(client)
+
+        return asyncio.run(run())
+
+    def test_matches_sync_endpoint(self):
+        query = {"policy_number": "Test Async Policy", "date_cursor": "2015-05-01"}
+
+        async def fetch(client):
+            response = await client.get("/policy/api/invoices", params=query)
+            return response.status, await response.json()
+
+        status, data = self.run_async(fetch)
+        self.assertEqual(status, 200)
+        expected = app.test_client().get("/policy/api/invoices", query_string=query)
+        self.assertEqual(data, expected.get_json())
+        self.assertEqual(data["balance"], "600")
+        self.assertEqual(len(data["invoices"]), 4)
+
+    def test_errors(self):
+        async def fetch(client):
+            bad_date = await client.get(
+                "/policy/api/invoices",
+                params={"policy_number": "Policy One", "date_cursor": "01/05/2015"},
+            )
+            missing = await client.get(
+                "/policy/api/invoices",
+                params={"policy_number": "No Such Policy", "date_cursor": "2015-05-01"},
+            )
+            return (
+                (bad_date.status, await bad_date.json()),
+                (missing.status, await missing.json()),
+            )
+
+        bad_date, missing = self.run_async(fetch)
+        self.assertEqual(bad_date, (400, {"message": "Bad date format"}))
+        self.assertEqual(missing, (404, {"message": "Policy Not Found"}))
+
+    def test_evaluations_match_sync(self):
+        pa = PolicyAccounting(self.policy_id)
+        DBSession.add(
+            Payment(self.policy_id, pa.policy.named_insured, 300, date(2015, 1, 20))
+        )
+        DBSession.commit()
+        dates = [date(2015, 1, 1) + timedelta(days=n) for n in range(0, 400, 9)]
+
+        async def evaluate(client):
+            db = client.server.app[DB_KEY]
+            apa = await AsyncPolicyAccounting.load(db, policy_id=self.policy_id)
+            results = []
+            for day in dates:
+                pending = await apa.find_cancellation_pending_invoice(day)
+                cancel = await apa.find_cancel_invoice(day)
+                results.append(
+                    (
+                        await apa.return_account_balance(day),
+                        pending and pending.id,
+                        cancel and cancel.id,
+                    )
+                )
+            return results
+
+        results = self.run_async(evaluate)
+        for day, (balance, pending, cancel) in zip(dates, results):
+            self.assertEqual(balance, pa.return_account_balance(day), day)
+            expected = pa.find_cancellation_pending_invoice(day)
+            self.assertEqual(pending, expected and expected.id, day)
+            expected = pa.find_cancel_invoice(day)
+            self.assertEqual(cancel, expected and expected.id, day)
+
+
+class TestBalanceCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = BalanceCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_hits_and_misses(self):
+        self.assertIsNone(self.cache.get(1, date(2015, 1, 1)))
+        self.cache.set(1, date(2015, 1, 1), 100)
+        self.assertEqual(self.cache.get(1, datetime(2015, 1, 1)), 100)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.set(1, date(2015, 1, 1), 100)
+        self.cache.set(2, date(2015, 1, 1), 200)
+        self.cache.get(1, date(2015, 1, 1))
+        self.cache.set(3, date(2015, 1, 1), 300)
+        self.assertIsNone(self.cache.get(2, date(2015, 1, 1)))
+        self.assertEqual(self.cache.get(1, date(2015, 1, 1)), 100)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        self.cache.set(1, date(2015, 1, 1), 100)
+        self.now = 10
+        self.assertIsNone(self.cache.get(1, date(2015, 1, 1)))
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_invalidate_drops_every_date_of_a_policy(self):
+        self.cache.set(1, date(2015, 1, 1), 100)
+        self.cache.set(1, date(2015, 2, 1), 200)
+        self.cache.invalidate([1])
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_set_after_invalidation_is_dropped(self):
+        generation = self.cache.generation(1)
+        self.cache.invalidate([2])
+        self.cache.set(1, date(2015, 1, 1), 100, generation)
+        self.assertEqual(self.cache.get(1, date(2015, 1, 1)), 100)
+        self.cache.invalidate([1])
+        self.cache.set(1, date(2015, 1, 1), 100, generation)
+        self.assertIsNone(self.cache.get(1, date(2015, 1, 1)))
+        self.assertEqual(self.cache.stats()["stale_sets"], 1)
+        self.cache.set(1, date(2015, 1, 1), 90, self.cache.generation(1))
+        self.assertEqual(self.cache.get(1, date(2015, 1, 1)), 90)
+
+    def test_clear_outdates_every_generation(self):
+        generation = self.cache.generation(1)
+        self.cache.clear()
+        self.cache.set(1, date(2015, 1, 1), 100, generation)
+        self.assertIsNone(self.cache.get(1, date(2015, 1, 1)))
+        # Forgetting generations past max_size does the same.
+        generation = self.cache.generation(1)
+        self.cache.invalidate([2, 3, 4])
+        self.cache.set(1, date(2015, 1, 1), 100, generation)
+        self.assertIsNone(self.cache.get(1, date(2015, 1, 1)))
+
+
+class TestBalanceCacheInvalidation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+        cls.policy = Policy("Test Cache Policy", date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        DBSession.add(cls.policy)
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.query(Invoice).filter_by(policy_id=cls.policy.id).delete()
+        DBSession.query(Payment).filter_by(policy_id=cls.policy.id).delete()
+        DBSession.delete(cls.policy)
+        DBSession.delete(cls.test_insured)
+        DBSession.commit()
+
+    def setUp(self):
+        self.pa = PolicyAccounting(self.policy.id)
+        self.pa.return_account_balance(date(2015, 2, 1))
+
+    def tearDown(self):
+        DBSession.query(Payment).filter_by(policy_id=self.policy.id).delete()
+        DBSession.commit()
+
+    def test_repeated_reads_are_served_from_cache(self):
+        hits = balance_cache.hits
+        self.assertEqual(self.pa.return_account_balance(date(2015, 2, 1)), 1200)
+        self.assertEqual(balance_cache.hits, hits + 1)
+
+    def test_make_payment_invalidates(self):
+        self.pa.make_payment(
+            contact_id=self.test_insured.id, date_cursor=date(2015, 1, 15), amount=200
+        )
+        self.assertEqual(self.pa.return_account_balance(date(2015, 2, 1)), 1000)
+
+    def test_writes_outside_policy_accounting_invalidate(self):
+        DBSession.add(
+            Payment(self.policy.id, self.test_insured.id, 300, date(2015, 1, 15))
+        )
+        DBSession.commit()
+        self.assertEqual(self.pa.return_account_balance(date(2015, 2, 1)), 900)
+
+    def test_uncommitted_reads_are_not_kept_after_rollback(self):
+        DBSession.add(
+            Payment(self.policy.id, self.test_insured.id, 300, date(2015, 1, 15))
+        )
+        DBSession.flush()
+        self.assertEqual(self.pa.return_account_balance(date(2015, 2, 1)), 900)
+        DBSession.rollback()
+        self.assertEqual(self.pa.return_account_balance(date(2015, 2, 1)), 1200)
+
+    def test_balance_read_before_a_commit_is_not_cached(self):
+        balance_cache.invalidate([self.policy.id])
+        read, committed = threading.Event(), threading.Event()
+        balances = []
+
+        def read_balance():
+            try:
+                pa = PolicyAccounting(self.policy.id)
+                balances.append(pa.return_account_balance(date(2015, 2, 1)))
+            finally:
+                DBSession.remove()
+
+        reader = threading.Thread(target=read_balance)
+
+        def hold_reader(conn, cursor, statement, *args):
+            # The reader got its balance, hold it until the payment is in.
+            if threading.current_thread() is reader and "ledger_entries" in statement:
+                read.set()
+                committed.wait(5)
+
+        event.listen(engine, "after_cursor_execute", hold_reader)
+        try:
+            reader.start()
+            self.assertTrue(read.wait(5))
+            DBSession.add(
+                Payment(self.policy.id, self.test_insured.id, 300, date(2015, 1, 15))
+            )
+            DBSession.commit()
+            committed.set()
+            reader.join(5)
+        finally:
+            committed.set()
+            event.remove(engine, "after_cursor_execute", hold_reader)
+        self.assertEqual(balances, [1200])
+        self.assertEqual(self.pa.return_account_balance(date(2015, 2, 1)), 900)
+
+
+class TestLedger(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(cls.test_insured)
+        DBSession.commit()
+        cls.policy = Policy("Test Ledger Policy", date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        DBSession.add(cls.policy)
+        DBSession.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.query(LedgerEntry).filter_by(policy_id=cls.policy.id).delete()
+        DBSession.delete(cls.policy)
+        DBSession.delete(cls.test_insured)
+        DBSession.commit()
+
+    def setUp(self):
+        self.pa = PolicyAccounting(self.policy.id)
+
+    def tearDown(self):
+        DBSession.query(Invoice).filter_by(policy_id=self.policy.id).delete()
+        DBSession.query(Payment).filter_by(policy_id=self.policy.id).delete()
+        DBSession.commit()
+
+    def assertLedgerMatchesRaw(self):
+        for day in range(0, 400, 7):
+            date_cursor = self.policy.effective_date + timedelta(days=day)
+            self.assertEqual(
+                from_cents(ledger_balance(self.policy.id, date_cursor)),
+                raw_balance(self.policy.id, date_cursor),
+                date_cursor,
+            )
+
+    def test_orm_writes_update_the_ledger(self):
+        self.pa.make_payment(
+            contact_id=self.test_insured.id, date_cursor=date(2015, 1, 20), amount=300
+        )
+        self.assertLedgerMatchesRaw()
+        # The ledger holds integer cents.
+        self.assertEqual(ledger_balance(self.policy.id, date(2015, 4, 1)), 30000)
+
+    def test_core_and_bulk_writes_update_the_ledger(self):
+        DBSession.execute(
+            Payment.__table__.insert(),
+            [
+                {
+                    "policy_id": self.policy.id,
+                    "contact_id": self.test_insured.id,
+                    "amount_paid": 100,
+                    "transaction_date": date(2015, 1, 1) + timedelta(days=day),
+                }
+                for day in (0, 40, 40, 95)
+            ],
+        )
+        DBSession.query(Invoice).filter_by(
+            policy_id=self.policy.id, bill_date=date(2015, 4, 1)
+        ).update({"amount_due": 250}, synchronize_session=False)
+        DBSession.query(Payment).filter_by(
+            policy_id=self.policy.id, transaction_date=date(2015, 2, 10)
+        ).delete(synchronize_session=False)
+        DBSession.commit()
+        self.assertLedgerMatchesRaw()
+
+    def test_soft_deleted_invoices_leave_the_ledger(self):
+        invoice = (
+            DBSession.query(Invoice)
+            .filter_by(policy_id=self.policy.id, bill_date=date(2015, 4, 1))
+            .one()
+        )
+        invoice.deleted = True
+        DBSession.commit()
+        self.assertEqual(self.pa.return_account_balance(date(2015, 4, 1)), 300)
+        self.assertLedgerMatchesRaw()
+        self.assertNotIn(self.policy.id, check_ledger())
+
+    def test_check_and_rebuild(self):
+        self.assertNotIn(self.policy.id, check_ledger())
+        DBSession.query(LedgerEntry).filter_by(policy_id=self.policy.id).update(
+            {"balance": 0}, synchronize_session=False
+        )
+        DBSession.commit()
+        self.assertIn(self.policy.id, check_ledger())
+        rebuild_ledger(chunk_size=2)
+        self.assertNotIn(self.policy.id, check_ledger())
+        self.assertLedgerMatchesRaw()
+
+    def test_writes_while_suspended_are_caught_up(self):
+        def triggers():
+            return DBSession.execute(
+                "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                "AND (name LIKE 'ledger_%' OR name LIKE 'version_%')"
+            ).scalar()
+
+        def version():
+            return DBSession.query(Policy.version).filter_by(id=self.policy.id).scalar()
+
+        count, before = triggers(), version()
+        with ledger_suspended():
+            self.assertEqual(triggers(), 0)
+            DBSession.execute(
+                Payment.__table__.insert(),
+                {
+                    "policy_id": self.policy.id,
+                    "contact_id": self.test_insured.id,
+                    "amount_paid": 300,
+                    "transaction_date": date(2015, 2, 1),
+                },
+            )
+            DBSession.commit()
+            self.assertEqual(ledger_balance(self.policy.id, date(2015, 4, 1)), 60000)
+        self.assertEqual(triggers(), count)
+        self.assertGreater(version(), before)
+        self.assertNotIn(self.policy.id, check_ledger())
+        self.assertLedgerMatchesRaw()
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(self.insured)
+        DBSession.commit()
+        self.policy = Policy("Test Snapshot Policy", date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = "Quarterly"
+        self.policy.named_insured = self.insured.id
+        DBSession.add(self.policy)
+        DBSession.commit()
+        # The endpoint test removes the session of these objects.
+        self.policy_id, self.insured_id = self.policy.id, self.insured.id
+        self.pa = PolicyAccounting(self.policy.id)
+        self.pa.make_payment(self.insured.id, date(2015, 1, 10), 300)
+        self.snapshot = BalanceSnapshot()
+        self.snapshot.reload()
+
+    def tearDown(self):
+        DBSession.query(Invoice).filter_by(policy_id=self.policy_id).delete()
+        DBSession.query(Payment).filter_by(policy_id=self.policy_id).delete()
+        DBSession.query(LedgerEntry).filter_by(policy_id=self.policy_id).delete()
+        DBSession.query(Policy).filter_by(id=self.policy_id).delete()
+        DBSession.query(Contact).filter_by(id=self.insured_id).delete()
+        DBSession.commit()
+
+    def assertMatchesSqlPath(self):
+        for day in range(-10, 400, 5):
+            date_cursor = self.policy.effective_date + timedelta(days=day)
+            self.assertEqual(
+                self.snapshot.return_account_balance(self.policy.id, date_cursor),
+                self.pa.return_account_balance(date_cursor),
+                date_cursor,
+            )
+        live = (
+            DBSession.query(Invoice)
+            .filter_by(policy_id=self.policy.id, deleted=False)
+            .order_by(Invoice.bill_date, Invoice.id)
+        )
+        self.assertEqual(
+            [invoice.serialize() for invoice in self.snapshot.invoices(self.policy.id)],
+            [invoice.serialize() for invoice in live],
+        )
+
+    def test_matches_sql_path(self):
+        self.assertEqual(
+            self.snapshot.policy_id("Test Snapshot Policy"), self.policy.id
+        )
+        self.assertEqual(
+            self.snapshot.balance_cents(self.policy.id, "2015-04-01"), 30000
+        )
+        self.assertMatchesSqlPath()
+
+    def test_refresh_reads_only_new_rows(self):
+        self.pa.make_payment(self.insured.id, date(2015, 4, 5), 300)
+        self.pa.make_payment(self.insured.id, date(2015, 1, 20), 50)
+        self.assertFalse(self.snapshot.refresh())
+        self.assertEqual(self.snapshot.refreshes, 1)
+        self.assertEqual(self.snapshot.footprint()["invoices"], 4)
+        self.assertMatchesSqlPath()
+
+    def test_rows_changed_in_place_trigger_a_reload(self):
+        self.pa.switch_billing_schedule("Monthly", date_cursor=date(2015, 3, 1))
+        self.assertTrue(self.snapshot.refresh())
+        self.assertEqual(self.snapshot.reloads, 2)
+        self.assertMatchesSqlPath()
+
+    def test_too_many_new_rows_trigger_a_reload(self):
+        self.snapshot.max_pending_rows = 1
+        self.pa.make_payment(self.insured.id, date(2015, 4, 5), 300)
+        self.pa.make_payment(self.insured.id, date(2015, 7, 5), 300)
+        self.assertTrue(self.snapshot.refresh())
+        self.assertMatchesSqlPath()
+
+    def test_invoices_endpoint_matches(self):
+        client = app.test_client()
+        query_string = {
+            "policy_number": "Test Snapshot Policy",
+            "date_cursor": "2015-05-01",
+        }
+        expected = client.get("/policy/api/invoices", query_string=query_string)
+        app.config["SNAPSHOT_ENABLED"] = True
+        try:
+            current_snapshot().refresh()
+            response = client.get("/policy/api/invoices", query_string=query_string)
+        finally:
+            app.config["SNAPSHOT_ENABLED"] = False
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(response.get_json()["invoices"], key=itemgetter("id")),
+            sorted(expected.get_json()["invoices"], key=itemgetter("id")),
+        )
+        self.assertEqual(response.get_json()["balance"], expected.get_json()["balance"])
+
+    def test_canceled_policy_is_refused(self):
+        current_snapshot().refresh()
+        self.pa.cancel_policy("Underwriting", date(2015, 3, 1))
+        self.assertTrue(self.snapshot.refresh())
+        policy = self.snapshot.policy(self.policy_id)
+        self.assertEqual(policy.status, "Canceled")
+        with self.assertRaises(UserWarning):
+            refuse_canceled(policy)
+
+        client = app.test_client()
+        query_string = {
+            "policy_number": "Test Snapshot Policy",
+            "date_cursor": "2015-05-01",
+        }
+        expected = client.get("/policy/api/invoices", query_string=query_string)
+        app.config["SNAPSHOT_ENABLED"] = True
+        try:
+            # Loaded before the cancellation, it must notice on refresh.
+            current_snapshot().refresh()
+            response = client.get("/policy/api/invoices", query_string=query_string)
+        finally:
+            app.config["SNAPSHOT_ENABLED"] = False
+        self.assertEqual(expected.status_code, 500)
+        self.assertEqual(response.status_code, expected.status_code)
+
+
+class TestQueryPlans(unittest.TestCase):
+    tables = ("policies", "contacts", "invoices", "payments", "ledger_entries")
+
+    @classmethod
+    def setUpClass(cls):
+        upgrade()
+        insured = Contact("Test Insured", "Named Insured")
+        DBSession.add(insured)
+        DBSession.commit()
+        policy = Policy("Test Plan Policy", date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Monthly"
+        policy.named_insured = insured.id
+        DBSession.add(policy)
+        DBSession.commit()
+        cls.insured_id, cls.policy_id = insured.id, policy.id
+
+    @classmethod
+    def tearDownClass(cls):
+        DBSession.query(Invoice).filter_by(policy_id=cls.policy_id).delete()
+        DBSession.query(Payment).filter_by(policy_id=cls.policy_id).delete()
+        DBSession.query(Policy).filter_by(id=cls.policy_id).delete()
+        DBSession.query(Contact).filter_by(id=cls.insured_id).delete()
+        DBSession.commit()
+
+    def capture_hot_queries(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append((statement, parameters))
+
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            pa = PolicyAccounting(self.policy_id)
+            pa.make_payment(self.insured_id, date(2015, 1, 15), 100)
+            pa.return_account_balance(date(2015, 6, 1))
+            pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 6, 1))
+            pa.evaluate_cancel(date(2015, 6, 1))
+            sweep_policies(
+                date(2015, 6, 1),
+                dry_run=True,
+                first_id=self.policy_id,
+                last_id=self.policy_id,
+            )
+            app.test_client().get(
+                "/policy/api/invoices",
+                query_string={
+                    "policy_number": "Test Plan Policy",
+                    "date_cursor": "2015-06-01",
+                },
+            )
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        return statements
+
+    def test_hot_queries_do_not_scan_tables(self):
+        statements = self.capture_hot_queries()
+        self.assertTrue(statements)
+        scan = re.compile(r"SCAN (TABLE )?({0})\b".format("|".join(self.tables)))
+        with engine.connect() as connection:
+            for statement, parameters in statements:
+                plan = connection.execute(
+                    "EXPLAIN QUERY PLAN " + statement, parameters
+                ).fetchall()
+                for row in plan:
+                    self.assertIsNone(
+                        scan.match(row[-1]),
+                        "{0}\n{1}".format(row[-1], statement),
+                    )
+
+
+# Imports every module a command line tool needs and reports whether
+# Flask came along.
+STARTUP_SCRIPT = """
+import sys
+import accounting.ledger, accounting.migrations, accounting.models, accounting.utils
+print("flask" in sys.modules)
+"""
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_has_no_side_effects(self):
+        path = os.path.join(tempfile.mkdtemp(), "untouched.sqlite")
+        result = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            env=dict(os.environ, ACCOUNTING_DATABASE_URI="sqlite:///" + path),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        self.assertEqual(result.stdout.strip(), "False")
+        self.assertFalse(os.path.exists(path))
+
+    def test_create_app(self):
+        other = create_app({"TESTING": True})
+        self.assertIsNot(other, app)
+        self.assertTrue(other.config["TESTING"])
+        self.assertFalse(app.config["TESTING"])
+        response = other.test_client().get(
+            "/policy/api/invoices",
+            query_string={
+                "policy_number": "No Such Policy",
+                "date_cursor": "2015-06-01",
+            },
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json(), {"message": "Policy Not Found"})
@@ -4,11 +4,16 @@ from decimal import Decimal
 
 from sqlalchemy.orm.exc import NoResultFound
 from accounting.models import Base
-from sqlalchemy import create_engine
-from accounting.config import SQLALCHEMY_DATABASE_URI
-from typing import Union
-
-from accounting.sql_base import DBSession
+from sqlalchemy import false
+from typing import List, Optional, Union
+
+from accounting.aging import print_aging_report
+from accounting.balances import as_date
+from accounting.billing import billing_schedule, invoice_dates
+from accounting.cache import balance_cache
+from accounting.ledger import ledger_balance, load_ledger
+from accounting.money import from_cents, installment_amounts
+from accounting.sql_base import DBSession, get_engine
 from accounting.models import Contact, Invoice, Payment, Policy
 
 """
@@ -17,13 +22,19 @@ This is the base code for the engineer project.
 #######################################################
 """
 
-BILLING_SCHEDULES = {
-    "Annual": None,
-    "Semi-Annual": 3,
-    "Quarterly": 4,
-    "Monthly": 12,
-    "Two-Pay": 2,
-}
+def refuse_canceled(policy) -> None:
+    """
+    Raise UserWarning for a canceled policy, there is no accounting left
+    to do on one
+    :param policy: a Policy, or a row with its status, cancel_date and
+        cancel_reason
+    """
+    if policy.status == "Canceled":
+        raise UserWarning(
+            "This policy canceled \nCancel date: {0} \nReason: {1}".format(
+                policy.cancel_date.strftime("%Y-%m-%d"), policy.cancel_reason
+            )
+        )
 
 
 class PolicyAccounting(object):
@@ -31,15 +42,16 @@ class PolicyAccounting(object):
     Accounting helper for policies
     """
 
-    def __init__(self, policy_id: int) -> None:
-        self.policy = DBSession.query(Policy).filter_by(id=policy_id).one()
-        if self.policy.status == "Canceled":
-            raise UserWarning(
-                "This policy canceled \nCancel date: {0} \nReason: {1}".format(
-                    self.policy.cancel_date.strftime("%Y-%m-%d"),
-                    self.policy.cancel_reason,
-                )
-            )
+    def __init__(self, policy_id: int = None, policy: Policy = None) -> None:
+        """
+        :param policy_id: id of the policy to load
+        :param policy: an already loaded Policy, ideally with its invoices
+            eagerly loaded, used instead of querying it again
+        """
+        if policy is None:
+            policy = DBSession.query(Policy).filter_by(id=policy_id).one()
+        self.policy = policy
+        refuse_canceled(self.policy)
 
         if not self.policy.invoices:
             self.make_invoices()
@@ -48,34 +60,28 @@ class PolicyAccounting(object):
         self, date_cursor: Union[str, date, datetime] = None
     ) -> Decimal:
         """
-        Returns the balance of the policy in a given point in time
+        Returns the balance of the policy in a given point in time,
+        served from accounting.cache.balance_cache when possible
         :param date_cursor:
         :return:
         """
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        invoices = (
-            DBSession.query(Invoice)
-            .filter_by(policy_id=self.policy.id)
-            .filter(Invoice.bill_date <= date_cursor)
-            .order_by(Invoice.bill_date)
-            .all()
-        )
-        due_now = 0
-        for invoice in invoices:
-            due_now += invoice.amount_due
+        balance = balance_cache.get(self.policy.id, date_cursor)
+        if balance is not None:
+            return balance
+        # Taken before the read, so a commit invalidating the policy in
+        # the meantime keeps this balance out of the cache.
+        generation = balance_cache.generation(self.policy.id)
 
-        payments = (
-            DBSession.query(Payment)
-            .filter_by(policy_id=self.policy.id)
-            .filter(Payment.transaction_date <= date_cursor)
-            .all()
-        )
-        for payment in payments:
-            due_now -= payment.amount_paid
+        # One indexed lookup of the latest ledger entry at or before the
+        # date cursor, see accounting.ledger.
+        due_now = ledger_balance(self.policy.id, date_cursor)
 
-        return Decimal(due_now)
+        balance = from_cents(due_now)
+        balance_cache.set(self.policy.id, date_cursor, balance, generation)
+        return balance
 
     def make_payment(
         self,
@@ -127,24 +133,30 @@ class PolicyAccounting(object):
         :param date_cursor:
         :return:
         """
+        return self.find_cancellation_pending_invoice(date_cursor) is not None
+
+    def find_cancellation_pending_invoice(
+        self, date_cursor: Union[str, date, datetime] = None
+    ) -> Optional[Invoice]:
+        """
+        Returns the invoice that puts the policy in cancellation pending
+        due to non-pay, or None
+        :param date_cursor:
+        :return:
+        """
         if not date_cursor:
             date_cursor = datetime.now().date()
 
         invoices = (
             DBSession.query(Invoice)
             .filter_by(policy_id=self.policy.id)
+            .filter(Invoice.deleted == false())
             .filter(Invoice.due_date <= date_cursor)
             .filter(Invoice.cancel_date >= date_cursor)
-            .order_by(Invoice.bill_date)
+            .order_by(Invoice.bill_date, Invoice.id)
             .all()
         )
-
-        for invoice in invoices:
-            if not self.return_account_balance(invoice.due_date):
-                continue
-            else:
-                return True
-        return False
+        return self._first_unpaid(invoices, "due_date", date_cursor)
 
     def evaluate_cancel(self, date_cursor: Union[str, date, datetime] = None) -> bool:
         """
@@ -153,39 +165,75 @@ class PolicyAccounting(object):
         :param date_cursor:
         :return:
         """
+        return self.find_cancel_invoice(date_cursor) is not None
+
+    def find_cancel_invoice(
+        self, date_cursor: Union[str, date, datetime] = None
+    ) -> Optional[Invoice]:
+        """
+        Returns the first invoice that still had a balance on its
+        cancel date, or None
+        :param date_cursor:
+        :return:
+        """
         if not date_cursor:
             date_cursor = datetime.now().date()
 
         invoices = (
             DBSession.query(Invoice)
             .filter_by(policy_id=self.policy.id)
+            .filter(Invoice.deleted == false())
             .filter(Invoice.cancel_date <= date_cursor)
-            .order_by(Invoice.bill_date)
+            .order_by(Invoice.bill_date, Invoice.id)
             .all()
         )
+        return self._first_unpaid(invoices, "cancel_date", date_cursor)
 
+    def _first_unpaid(
+        self,
+        invoices: List[Invoice],
+        check_date: str,
+        date_cursor: Union[str, date, datetime],
+    ) -> Optional[Invoice]:
+        """
+        First of the invoices with a balance left on its `check_date`,
+        read from the policy ledger loaded once
+        :param invoices: sorted by bill_date
+        :param check_date: "due_date" or "cancel_date"
+        :param date_cursor:
+        :return:
+        """
+        if not invoices:
+            return None
+        ledger = load_ledger(self.policy.id, date_cursor)
         for invoice in invoices:
-            if not self.return_account_balance(invoice.cancel_date):
-                continue
-            else:
-                return True
-        else:
-            return False
+            if ledger.balance_on(getattr(invoice, check_date)):
+                return invoice
+        return None
 
-    def switch_billing_schedule(self, new_billing_schedule: str) -> None:
+    def switch_billing_schedule(
+        self,
+        new_billing_schedule: str,
+        incremental: bool = False,
+        date_cursor: Union[str, date, datetime] = None,
+    ) -> None:
         """
         Move a policy to a different billing schedule
         :param new_billing_schedule:
+        :param incremental: keep the invoices billed up to date_cursor and
+            only spread the premium left over the new schedule's remaining
+            bill dates, instead of rebuilding every invoice
+        :param date_cursor: when the switch happens (incremental only)
         :return:
         """
-        try:
-            BILLING_SCHEDULES[new_billing_schedule]
-        except KeyError:
-            raise KeyError("Invalid billing schedule")
+        billing_schedule(new_billing_schedule)
         if self.policy.billing_schedule == new_billing_schedule:
             raise UserWarning(
                 "This policy is already on {0}".format(new_billing_schedule)
             )
+        if incremental:
+            self._switch_unbilled_invoices(new_billing_schedule, date_cursor)
+            return
         for invoice in self.policy.invoices:
             invoice.deleted = 1
             DBSession.add(invoice)
@@ -194,78 +242,69 @@ class PolicyAccounting(object):
         DBSession.flush()
         self.make_invoices()
 
+    def _switch_unbilled_invoices(
+        self,
+        new_billing_schedule: str,
+        date_cursor: Union[str, date, datetime] = None,
+    ) -> None:
+        """
+        Replace the invoices billed after date_cursor with the rest of the
+        new schedule, written in one flush. If the new schedule has no bill
+        date left, the unbilled premium is billed on date_cursor.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        date_cursor = as_date(date_cursor)
+
+        billed = 0
+        for invoice in self.policy.invoices:
+            if invoice.bill_date <= date_cursor:
+                billed += invoice.amount_due
+            else:
+                # Never billed, so there is no history worth keeping.
+                DBSession.delete(invoice)
+        self.policy.billing_schedule = new_billing_schedule
+        DBSession.add(self.policy)
+
+        unbilled = self.policy.annual_premium - billed
+        if unbilled > 0:
+            dates = [
+                dates
+                for dates in invoice_dates(
+                    self.policy.effective_date, new_billing_schedule
+                )
+                if dates[0] > date_cursor
+            ]
+            if not dates:
+                due_date = date_cursor + relativedelta(months=1)
+                dates = [(date_cursor, due_date, due_date + relativedelta(days=14))]
+            amounts = installment_amounts(unbilled, len(dates))
+            for (bill_date, due_date, cancel_date), amount_due in zip(dates, amounts):
+                DBSession.add(
+                    Invoice(
+                        self.policy.id, bill_date, due_date, cancel_date, amount_due
+                    )
+                )
+        DBSession.commit()
+
     def make_invoices(self) -> None:
         """
         Create invoices for the policy according with its billing schedule
+        :raise KeyError: for a policy on an unknown billing schedule
         """
+        dates = invoice_dates(self.policy.effective_date, self.policy.billing_schedule)
+        amounts = billing_schedule(self.policy.billing_schedule).amounts(
+            self.policy.annual_premium
+        )
+
         for invoice in self.policy.invoices:
             DBSession.delete(invoice)
 
         invoices = []
-        first_invoice = Invoice(
-            self.policy.id,
-            self.policy.effective_date,  # bill_date
-            self.policy.effective_date + relativedelta(months=1),  # due
-            self.policy.effective_date + relativedelta(months=1, days=14),  # cancel
-            self.policy.annual_premium,
-        )
-        invoices.append(first_invoice)
-
-        if self.policy.billing_schedule == "Annual":
-            pass
-        elif self.policy.billing_schedule == "Two-Pay":
-            first_invoice.amount_due = first_invoice.amount_due / BILLING_SCHEDULES.get(
-                self.policy.billing_schedule
-            )
-            for i in range(1, BILLING_SCHEDULES.get(self.policy.billing_schedule)):
-                months_after_eff_date = i * 6
-                bill_date = self.policy.effective_date + relativedelta(
-                    months=months_after_eff_date
-                )
-                invoice = Invoice(
-                    self.policy.id,
-                    bill_date,
-                    bill_date + relativedelta(months=1),
-                    bill_date + relativedelta(months=1, days=14),
-                    self.policy.annual_premium
-                    / BILLING_SCHEDULES.get(self.policy.billing_schedule),
-                )
-                invoices.append(invoice)
-        elif self.policy.billing_schedule == "Quarterly":
-            first_invoice.amount_due = first_invoice.amount_due / BILLING_SCHEDULES.get(
-                self.policy.billing_schedule
+        for (bill_date, due_date, cancel_date), amount_due in zip(dates, amounts):
+            invoices.append(
+                Invoice(self.policy.id, bill_date, due_date, cancel_date, amount_due)
             )
-            for i in range(1, BILLING_SCHEDULES.get(self.policy.billing_schedule)):
-                months_after_eff_date = i * 3
-                bill_date = self.policy.effective_date + relativedelta(
-                    months=months_after_eff_date
-                )
-                invoice = Invoice(
-                    self.policy.id,
-                    bill_date,
-                    bill_date + relativedelta(months=1),
-                    bill_date + relativedelta(months=1, days=14),
-                    self.policy.annual_premium
-                    / BILLING_SCHEDULES.get(self.policy.billing_schedule),
-                )
-                invoices.append(invoice)
-        elif self.policy.billing_schedule == "Monthly":
-            first_invoice.amount_due = first_invoice.amount_due / BILLING_SCHEDULES.get(
-                self.policy.billing_schedule
-            )
-            for i in range(1, BILLING_SCHEDULES.get(self.policy.billing_schedule)):
-                bill_date = self.policy.effective_date + relativedelta(months=i)
-                invoice = Invoice(
-                    self.policy.id,
-                    bill_date,
-                    bill_date + relativedelta(months=1),
-                    bill_date + relativedelta(months=1, days=14),
-                    self.policy.annual_premium
-                    / BILLING_SCHEDULES.get(self.policy.billing_schedule),
-                )
-                invoices.append(invoice)
-        else:
-            print("You have chosen a bad billing schedule.")
 
         for invoice in invoices:
             DBSession.add(invoice)
@@ -290,13 +329,24 @@ class PolicyAccounting(object):
 # shouldn't need to be edited.
 ################################
 def build_or_refresh_db():
-    engine = create_engine(SQLALCHEMY_DATABASE_URI)
+    engine = get_engine()
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
     insert_data()
     print("DB Ready!")
 
 
+def run_aging_report(date_cursor=None, group_by=None):
+    """
+    Print the accounts receivable aging of the whole book, see
+    accounting.aging (python -m accounting.aging from a terminal)
+    :param date_cursor: report date (default today)
+    :param group_by: None, "agent" or "billing_schedule"
+    :return: the AgingRows
+    """
+    return print_aging_report(date_cursor, group_by)
+
+
 def insert_data():
     # Contacts
     contacts = []
@@ -0,0 +1,46 @@
+"""
+#######################################################
+Benchmarks for the accounting package.
+
+Importing this package points accounting at a scratch SQLite file
+(unless ACCOUNTING_DATABASE_URI is already set), so a benchmark run
+never touches accounting.sqlite. Run one with e.g.:
+
+    python -m benchmarks.balance
+#######################################################
+"""
+
+import os
+import tempfile
+import time
+
+SCRATCH_DB = os.path.join(tempfile.gettempdir(), "accounting_bench.sqlite")
+os.environ.setdefault("ACCOUNTING_DATABASE_URI", "sqlite:///" + SCRATCH_DB)
+
+
+def reset_db():
+    """
+    Drop and recreate every table in the benchmark database
+    """
+    from accounting.models import Base
+    from accounting.sql_base import DBSession, get_engine
+
+    DBSession.rollback()
+    DBSession.expunge_all()
+    engine = get_engine()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+
+def best_of(func, repeat=3):
+    """
+    Run func `repeat` times and return (best wall time in seconds, last result)
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
@@ -0,0 +1,81 @@
+"""
+AR aging over a synthetic book: accounting.aging.aging_report for each
+grouping, against walking the policies one at a time with their own
+queries (timed on a sample and scaled to the book).
+
+    python -m benchmarks.aging --policies 200000
+"""
+
+import argparse
+import random
+
+from benchmarks import best_of, reset_db
+from benchmarks.book import AS_OF, generate_book
+from accounting.aging import BUCKETS, GROUPS, aging_report
+from accounting.models import Invoice, Payment, Policy
+from accounting.money import to_cents
+from accounting.sql_base import DBSession
+
+
+def policy_aging(policy_id, date_cursor):
+    """
+    Open cents per bucket of one policy, the one policy at a time way
+    """
+    paid = sum(
+        to_cents(amount)
+        for (amount,) in DBSession.query(Payment.amount_paid)
+        .filter(Payment.policy_id == policy_id)
+        .filter(Payment.transaction_date <= date_cursor)
+    )
+    buckets = [0] * len(BUCKETS)
+    for due_date, amount in (
+        DBSession.query(Invoice.due_date, Invoice.amount_due)
+        .filter(Invoice.policy_id == policy_id)
+        .filter(Invoice.deleted.is_(False))
+        .filter(Invoice.bill_date <= date_cursor)
+        .order_by(Invoice.bill_date, Invoice.id)
+    ):
+        amount = to_cents(amount)
+        applied = min(paid, amount)
+        paid -= applied
+        days = (date_cursor - due_date).days
+        for index, (_, _, high) in enumerate(BUCKETS):
+            if high is None or days <= high:
+                buckets[index] += amount - applied
+                break
+    return buckets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=200000)
+    parser.add_argument(
+        "--sample", type=int, default=2000, help="policies walked one at a time"
+    )
+    args = parser.parse_args()
+
+    reset_db()
+    book = generate_book(args.policies)
+    print("{0.policies} policies, {0.invoices} invoices".format(book))
+
+    for group_by in [None] + sorted(GROUPS):
+        seconds, rows = best_of(lambda: aging_report(AS_OF, group_by), 3)
+        print(
+            "aging_report group_by={0:<17} {1:6.2f}s  {2} rows".format(
+                str(group_by), seconds, len(rows)
+            )
+        )
+
+    policy_ids = [policy_id for (policy_id,) in DBSession.query(Policy.id)]
+    sample = random.Random(0).sample(policy_ids, min(args.sample, len(policy_ids)))
+    seconds, _ = best_of(lambda: [policy_aging(p, AS_OF) for p in sample], 1)
+    print(
+        "one policy at a time      {0:6.2f}s for {1} policies, "
+        "about {2:.0f}s for the book".format(
+            seconds, len(sample), seconds * len(policy_ids) / len(sample)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Load test for /policy/api/invoices: serve the app from a threaded WSGI
+server and measure requests per second as the number of concurrent
+worker threads grows.
+
+    python -m benchmarks.api_load --threads 1 2 4 8 --seconds 5
+"""
+
+import argparse
+import http.client
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from benchmarks import reset_db
+from accounting import app
+from accounting.utils import insert_data
+
+URL = "/policy/api/invoices?policy_number=Policy+Two&date_cursor=2015-06-01"
+
+
+class QuietHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server handling each connection on a fixed pool of worker threads
+    """
+
+    def __init__(self, host, port, app, workers):
+        BaseWSGIServer.__init__(self, host, port, app, handler=QuietHandler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(
+            ThreadingMixIn.process_request_thread, self, request, client_address
+        )
+
+
+def hammer(port, clients, seconds):
+    """
+    Keep `clients` keep-alive connections busy for `seconds`
+    :return: (completed requests, failed requests)
+    """
+    deadline = time.perf_counter() + seconds
+    counts = [0, 0]
+    lock = threading.Lock()
+
+    def client():
+        ok = failed = 0
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        while time.perf_counter() < deadline:
+            connection.request("GET", URL)
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                ok += 1
+            else:
+                failed += 1
+        connection.close()
+        with lock:
+            counts[0] += ok
+            counts[1] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    reset_db()
+    insert_data()
+
+    print("{:>8} {:>10} {:>8}".format("threads", "req/s", "errors"))
+    for workers in args.threads:
+        server = PooledWSGIServer("127.0.0.1", 0, app, workers)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            ok, failed = hammer(server.server_port, workers, args.seconds)
+        finally:
+            server.shutdown()
+            server.executor.shutdown()
+            thread.join()
+        print("{:>8} {:>10.1f} {:>8}".format(workers, ok / args.seconds, failed))
+
+
+if __name__ == "__main__":
+    main()
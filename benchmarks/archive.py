@@ -0,0 +1,135 @@
+"""
+Live table size and query times before and after archiving the
+soft-deleted invoices (accounting.archive) and compacting the database.
+Every policy carries its live monthly schedule plus `--generations`
+soft-deleted copies of it, as left behind by repeated rebilling.
+
+    python -m benchmarks.archive --policies 2000 --generations 9
+"""
+
+import argparse
+import os
+import random
+import time
+from datetime import date
+
+from benchmarks import SCRATCH_DB, best_of, reset_db
+from accounting.archive import archive_deleted_invoices, compact
+from accounting.billing import invoice_dates
+from accounting.cache import balance_cache
+from accounting.ledger import check_ledger
+from accounting.models import Invoice, Policy
+from accounting.sql_base import DBSession, get_engine
+from accounting.sweep import sweep_policies
+from accounting.utils import PolicyAccounting
+
+
+def seed(policy_count, generations):
+    reset_db()
+    DBSession.execute(
+        Policy.__table__.insert(),
+        [
+            {
+                "policy_number": "Bench Policy {0}".format(i),
+                "effective_date": date(2015, 1, 1),
+                "status": "Active",
+                "billing_schedule": "Monthly",
+                "annual_premium": 1200,
+            }
+            for i in range(policy_count)
+        ],
+    )
+    dates = invoice_dates(date(2015, 1, 1), "Monthly")
+    policy_ids = [policy_id for policy_id, in DBSession.query(Policy.id)]
+    for generation in range(generations + 1):
+        DBSession.execute(
+            Invoice.__table__.insert(),
+            [
+                {
+                    "policy_id": policy_id,
+                    "bill_date": bill_date,
+                    "due_date": due_date,
+                    "cancel_date": cancel_date,
+                    "amount_due": 100,
+                    "deleted": generation < generations,
+                }
+                for policy_id in policy_ids
+                for bill_date, due_date, cancel_date in dates
+            ],
+        )
+    DBSession.commit()
+    return policy_ids
+
+
+def hot_queries(policy_ids):
+    """
+    Balance, invoice listing and both cancellation checks per policy
+    """
+    balance_cache.clear()
+    start = time.perf_counter()
+    for policy_id in policy_ids:
+        pa = PolicyAccounting(policy_id)
+        pa.return_account_balance(date(2015, 7, 1))
+        pa.find_cancellation_pending_invoice(date(2015, 7, 1))
+        pa.find_cancel_invoice(date(2015, 7, 1))
+        DBSession.expunge_all()
+    return time.perf_counter() - start
+
+
+def invoices_mib():
+    """
+    Pages used by the invoices table and its indexes (SQLite's dbstat)
+    """
+    names = [Invoice.__table__.name] + [
+        index.name for index in Invoice.__table__.indexes
+    ]
+    size = DBSession.execute(
+        "SELECT SUM(pgsize) FROM dbstat WHERE name IN ({0})".format(
+            ", ".join("'{0}'".format(name) for name in names)
+        )
+    ).scalar()
+    return size / 2**20
+
+
+def measure(policy_ids):
+    DBSession.remove()
+    get_engine().execute("ANALYZE")
+    return {
+        "invoice rows": DBSession.query(Invoice).count(),
+        "invoices MiB": invoices_mib(),
+        "db file MiB": os.path.getsize(SCRATCH_DB) / 2**20,
+        "queries (s)": hot_queries(policy_ids),
+        "sweep (s)": best_of(lambda: sweep_policies(date(2015, 7, 1), dry_run=True), 1)[
+            0
+        ],
+        "check (s)": best_of(check_ledger, 1)[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=2000)
+    parser.add_argument("--generations", type=int, default=9)
+    parser.add_argument("--sample", type=int, default=500)
+    args = parser.parse_args()
+
+    policy_ids = seed(args.policies, args.generations)
+    sample = random.Random(15).sample(policy_ids, min(args.sample, len(policy_ids)))
+    compact()
+    before = measure(sample)
+
+    start = time.perf_counter()
+    archived = archive_deleted_invoices()
+    DBSession.remove()
+    compact()
+    elapsed = time.perf_counter() - start
+    after = measure(sample)
+
+    print("{0} invoices archived and compacted in {1:.2f}s".format(archived, elapsed))
+    print("{:>14} {:>12} {:>12}".format("", "before", "after"))
+    for name in before:
+        print("{:>14} {:>12.2f} {:>12.2f}".format(name, before[name], after[name]))
+
+
+if __name__ == "__main__":
+    main()
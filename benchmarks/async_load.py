@@ -0,0 +1,114 @@
+"""
+Compare the threaded Flask server with the aiohttp server from
+accounting.aio on /policy/api/invoices: throughput and p99 latency at
+a growing number of concurrent keep-alive clients.
+
+    python -m benchmarks.async_load --clients 1 8 32 --seconds 5
+"""
+
+import argparse
+import asyncio
+import http.client
+import threading
+import time
+
+from aiohttp import web
+
+from benchmarks import reset_db
+from benchmarks.api_load import URL, PooledWSGIServer
+from accounting import app
+from accounting.aio import create_async_app
+from accounting.utils import insert_data
+
+
+def hammer(port, clients, seconds):
+    """
+    Keep `clients` keep-alive connections busy for `seconds`
+    :return: (sorted request latencies in seconds, failed requests)
+    """
+    deadline = time.perf_counter() + seconds
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def client():
+        timings, failed = [], 0
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            connection.request("GET", URL)
+            response = connection.getresponse()
+            response.read()
+            timings.append(time.perf_counter() - start)
+            if response.status != 200:
+                failed += 1
+        connection.close()
+        with lock:
+            latencies.extend(timings)
+            failures[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), failures[0]
+
+
+def run_sync(clients, seconds):
+    server = PooledWSGIServer("127.0.0.1", 0, app, clients)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        return hammer(server.server_port, clients, seconds)
+    finally:
+        server.shutdown()
+        server.executor.shutdown()
+        thread.join()
+
+
+def run_async(clients, seconds):
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_async_app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        return hammer(port, clients, seconds)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    reset_db()
+    insert_data()
+
+    print(
+        "{:>6} {:>8} {:>10} {:>10} {:>8}".format(
+            "server", "clients", "req/s", "p99 ms", "errors"
+        )
+    )
+    for clients in args.clients:
+        for name, run in (("sync", run_sync), ("async", run_async)):
+            latencies, failed = run(clients, args.seconds)
+            p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+            print(
+                "{:>6} {:>8} {:>10.1f} {:>10.2f} {:>8}".format(
+                    name, clients, len(latencies) / args.seconds, p99 * 1000, failed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
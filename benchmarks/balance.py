@@ -0,0 +1,128 @@
+"""
+Compare the old row-by-row PolicyAccounting.return_account_balance with the
+current implementation (cache bypassed), on one policy holding N invoices.
+
+    python -m benchmarks.balance --sizes 10000 100000 1000000
+"""
+
+import argparse
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from benchmarks import best_of, reset_db
+from accounting.cache import balance_cache
+from accounting.models import Contact, Invoice, Payment, Policy
+from accounting.sql_base import DBSession
+from accounting.utils import PolicyAccounting
+
+
+def legacy_balance(policy_id, date_cursor):
+    """
+    The pre-aggregate implementation: hydrate every row and add in Python
+    """
+    invoices = (
+        DBSession.query(Invoice)
+        .filter_by(policy_id=policy_id, deleted=False)
+        .filter(Invoice.bill_date <= date_cursor)
+        .order_by(Invoice.bill_date)
+        .all()
+    )
+    due_now = 0
+    for invoice in invoices:
+        due_now += invoice.amount_due
+
+    payments = (
+        DBSession.query(Payment)
+        .filter_by(policy_id=policy_id)
+        .filter(Payment.transaction_date <= date_cursor)
+        .all()
+    )
+    for payment in payments:
+        due_now -= payment.amount_paid
+
+    return Decimal(due_now)
+
+
+def seed(invoice_count):
+    """
+    One policy with `invoice_count` daily invoices (every 10th one deleted)
+    and a payment for every fourth invoice.
+    """
+    reset_db()
+    insured = Contact("Bench Insured", "Named Insured")
+    DBSession.add(insured)
+    DBSession.commit()
+    policy = Policy("Bench Policy", date(2015, 1, 1), 0)
+    policy.named_insured = insured.id
+    DBSession.add(policy)
+    DBSession.commit()
+
+    start = policy.effective_date
+    invoices, payments = defaultdict(list), defaultdict(list)
+    for i in range(invoice_count):
+        bill_date = start + timedelta(days=i % 3650)
+        invoices[bill_date].append(
+            {
+                "policy_id": policy.id,
+                "bill_date": bill_date,
+                "due_date": bill_date + timedelta(days=30),
+                "cancel_date": bill_date + timedelta(days=44),
+                "amount_due": 100,
+                "deleted": i % 10 == 0,
+            }
+        )
+        if i % 4 == 0:
+            payments[bill_date + timedelta(days=5)].append(
+                {
+                    "policy_id": policy.id,
+                    "contact_id": insured.id,
+                    "amount_paid": 100,
+                    "transaction_date": bill_date + timedelta(days=5),
+                }
+            )
+    # Insert in date order: the ledger triggers then only ever touch the
+    # latest entry of the policy.
+    for day in sorted(set(invoices) | set(payments)):
+        if day in invoices:
+            DBSession.execute(Invoice.__table__.insert(), invoices[day])
+        if day in payments:
+            DBSession.execute(Payment.__table__.insert(), payments[day])
+    DBSession.commit()
+    return policy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        "{:>10} {:>12} {:>12} {:>9}".format("invoices", "old (s)", "new (s)", "speedup")
+    )
+    for size in args.sizes:
+        policy = seed(size)
+        pa = PolicyAccounting(policy.id)
+        cursor = policy.effective_date + timedelta(days=1825)
+        repeat = 1 if size >= 1000000 else args.repeat
+
+        old_time, old_balance = best_of(
+            lambda: legacy_balance(policy.id, cursor), repeat
+        )
+        DBSession.expunge_all()
+        new_time, new_balance = best_of(
+            lambda: balance_cache.clear() or pa.return_account_balance(cursor), repeat
+        )
+        assert old_balance == new_balance, (old_balance, new_balance)
+        print(
+            "{:>10} {:>12.4f} {:>12.4f} {:>8.1f}x".format(
+                size, old_time, new_time, old_time / new_time
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Dashboard load: N sequential /policy/api/invoices calls against one
+/policy/api/invoices/batch call for the same policies.
+
+    python -m benchmarks.batch_api --policies 500
+"""
+
+import argparse
+from datetime import date, timedelta
+
+from benchmarks import best_of, reset_db
+from accounting import app
+from accounting.billing import make_invoices_bulk
+from accounting.models import Policy
+from accounting.sql_base import DBSession
+
+SCHEDULES = ["Annual", "Two-Pay", "Quarterly", "Monthly"]
+
+
+def seed(policy_count):
+    reset_db()
+    DBSession.execute(
+        Policy.__table__.insert(),
+        [
+            {
+                "policy_number": "Bench Policy {0}".format(i),
+                "effective_date": date(2015, 1, 1) + timedelta(days=i % 365),
+                "status": "Active",
+                "billing_schedule": SCHEDULES[i % len(SCHEDULES)],
+                "annual_premium": 1200,
+            }
+            for i in range(policy_count)
+        ],
+    )
+    DBSession.commit()
+    make_invoices_bulk(DBSession.query(Policy).all())
+    numbers = [number for number, in DBSession.query(Policy.policy_number)]
+    DBSession.remove()
+    return numbers
+
+
+def sequential(client, policy_numbers):
+    for policy_number in policy_numbers:
+        response = client.get(
+            "/policy/api/invoices",
+            query_string={"policy_number": policy_number, "date_cursor": "2015-09-01"},
+        )
+        assert response.status_code == 200
+
+
+def batched(client, policy_numbers):
+    response = client.post(
+        "/policy/api/invoices/batch",
+        json={"policy_numbers": policy_numbers, "date_cursor": "2015-09-01"},
+    )
+    assert len(response.get_json()["policies"]) == len(policy_numbers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    policy_numbers = seed(args.policies)
+    client = app.test_client()
+    sequential_time, _ = best_of(
+        lambda: sequential(client, policy_numbers), args.repeat
+    )
+    batch_time, _ = best_of(lambda: batched(client, policy_numbers), args.repeat)
+    print("{0} policies".format(args.policies))
+    print("sequential get_tasks  {0:8.3f}s".format(sequential_time))
+    print(
+        "batch endpoint        {0:8.3f}s  {1:.1f}x".format(
+            batch_time, sequential_time / batch_time
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Synthetic book of business for the benchmarks: policies on a realistic
+mix of billing schedules, their invoices, a payment history up to an
+"as of" date and the cancellations that history leads to. Everything
+goes in through Core executemany calls with the ledger triggers
+suspended, and the ledger is rebuilt once at the end.
+
+    python -m benchmarks.book --policies 100000
+"""
+
+import argparse
+import random
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+from sqlalchemy import func
+
+from benchmarks import reset_db
+from accounting.billing import CANCEL_GRACE_DAYS, invoice_rows
+from accounting.ledger import ledger_suspended
+from accounting.models import Contact, Invoice, Payment, Policy
+from accounting.money import CENT
+from accounting.sql_base import DBSession
+
+AS_OF = date(2016, 1, 1)
+
+# Share of the book on each billing schedule.
+SCHEDULE_MIX = (
+    ("Annual", 0.25),
+    ("Two-Pay", 0.10),
+    ("Semi-Annual", 0.10),
+    ("Quarterly", 0.25),
+    ("Monthly", 0.30),
+)
+
+# How the insured of a policy pays the invoices billed before AS_OF: by
+# the due date, late (by the agent, since the policy is past due by
+# then), or half by the due date and the rest late.
+ON_TIME, LATE, PARTIAL = "on time", "late", "partial"
+PAYMENT_MIX = ((ON_TIME, 0.93), (LATE, 0.05), (PARTIAL, 0.02))
+
+# Share of policies that stop paying at some invoice, and share of those
+# already canceled for it once that invoice is past its cancel date
+# (the others are left for the cancellation sweep).
+DELINQUENT_RATE = 0.06
+NON_PAY_CANCEL_RATE = 0.9
+
+# Share of policies canceled by underwriting at a random date.
+UNDERWRITING_CANCEL_RATE = 0.01
+
+AGENT_COUNT = 50
+
+BookStats = namedtuple(
+    "BookStats", "policies invoices payments canceled ledger_entries seconds"
+)
+
+_PolicyRow = namedtuple(
+    "_PolicyRow", "id effective_date billing_schedule annual_premium"
+)
+
+
+def _choice(rng, mix):
+    pick = rng.random()
+    for value, share in mix:
+        pick -= share
+        if pick < 0:
+            return value
+    return mix[-1][0]
+
+
+def _next_id(model):
+    return (DBSession.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def generate_book(policy_count, seed=0, as_of=AS_OF, chunk_size=10000):
+    """
+    Add `policy_count` policies with their history to the database
+    :param policy_count:
+    :param seed: same seed, same book
+    :param as_of: payments and cancellations stop the day before
+    :param chunk_size: policies per round of executemany calls
+    :return: BookStats
+    """
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    stats = dict.fromkeys(BookStats._fields[:-2], 0)
+
+    with ledger_suspended():
+        contact_id = _next_id(Contact)
+        agents = list(range(contact_id, contact_id + AGENT_COUNT))
+        DBSession.execute(
+            Contact.__table__.insert(),
+            [
+                {"id": agent, "name": "Agent {0}".format(agent), "role": "Agent"}
+                for agent in agents
+            ],
+        )
+        contact_id += AGENT_COUNT
+        policy_id = _next_id(Policy)
+        for offset in range(0, policy_count, chunk_size):
+            rows = _chunk(
+                rng,
+                min(chunk_size, policy_count - offset),
+                policy_id + offset,
+                contact_id + offset,
+                agents,
+                as_of,
+            )
+            for model, key in (
+                (Contact, "contacts"),
+                (Policy, "policies"),
+                (Invoice, "invoices"),
+                (Payment, "payments"),
+            ):
+                if rows[key]:
+                    DBSession.execute(model.__table__.insert(), rows[key])
+                if key in stats:
+                    stats[key] += len(rows[key])
+            stats["canceled"] += sum(
+                policy["status"] == "Canceled" for policy in rows["policies"]
+            )
+        DBSession.commit()
+    stats["ledger_entries"] = DBSession.execute(
+        "SELECT count(*) FROM ledger_entries"
+    ).scalar()
+    return BookStats(seconds=time.perf_counter() - start, **stats)
+
+
+def _chunk(rng, count, first_policy_id, first_contact_id, agents, as_of):
+    """
+    Rows of `count` policies, each with its own named insured
+    """
+    rows = {"contacts": [], "policies": [], "invoices": [], "payments": []}
+    for i in range(count):
+        policy_id = first_policy_id + i
+        insured = first_contact_id + i
+        agent = rng.choice(agents)
+        policy = _PolicyRow(
+            policy_id,
+            as_of - timedelta(days=rng.randint(1, 730)),
+            _choice(rng, SCHEDULE_MIX),
+            rng.randrange(400, 6000, 50),
+        )
+        rows["contacts"].append(
+            {
+                "id": insured,
+                "name": "Insured {0}".format(insured),
+                "role": "Named Insured",
+            }
+        )
+
+        invoices = list(invoice_rows([policy]))
+        behaviour = _choice(rng, PAYMENT_MIX)
+        stops_paying = None
+        if rng.random() < DELINQUENT_RATE:
+            stops_paying = rng.randrange(len(invoices))
+        payments = []
+        cancel_date = cancel_reason = None
+        for index, invoice in enumerate(invoices):
+            if invoice["bill_date"] >= as_of:
+                break
+            if stops_paying is None or index < stops_paying:
+                payments.extend(
+                    _payments(rng, invoice, behaviour, insured, agent, as_of)
+                )
+            elif invoice["cancel_date"] < as_of and rng.random() < NON_PAY_CANCEL_RATE:
+                cancel_date = invoice["cancel_date"]
+                cancel_reason = "Non-payment"
+                break
+        if cancel_date is None and rng.random() < UNDERWRITING_CANCEL_RATE:
+            cancel_date = policy.effective_date + timedelta(
+                days=rng.randrange(max(1, (as_of - policy.effective_date).days))
+            )
+            cancel_reason = "Underwriting"
+        if cancel_date is not None:
+            # Nothing is billed or paid after a cancellation.
+            invoices = [i for i in invoices if i["bill_date"] <= cancel_date]
+            payments = [p for p in payments if p["transaction_date"] <= cancel_date]
+        rows["invoices"].extend(invoices)
+        rows["payments"].extend(payments)
+
+        rows["policies"].append(
+            {
+                "id": policy_id,
+                "policy_number": "Book Policy {0}".format(policy_id),
+                "effective_date": policy.effective_date,
+                "status": "Canceled" if cancel_date else "Active",
+                "billing_schedule": policy.billing_schedule,
+                "annual_premium": policy.annual_premium,
+                "named_insured": insured,
+                "agent": agent,
+                "cancel_date": cancel_date,
+                "cancel_reason": cancel_reason,
+            }
+        )
+    return rows
+
+
+def _payments(rng, invoice, behaviour, insured, agent, as_of):
+    """
+    Payments made against one invoice before as_of
+    """
+    bill_date, due_date = invoice["bill_date"], invoice["due_date"]
+    amount = invoice["amount_due"]
+    # Within two weeks of the bill date: the balance on the cancel date of
+    # the previous invoice already includes this one on monthly policies.
+    on_time = bill_date + timedelta(days=rng.randrange(CANCEL_GRACE_DAYS))
+    late = due_date + timedelta(days=rng.randint(1, 14))
+    if behaviour == ON_TIME:
+        paid = [(on_time, insured, amount)]
+    elif behaviour == LATE:
+        paid = [(late, agent, amount)]
+    else:
+        half = (amount / 2).quantize(CENT)
+        paid = [(on_time, insured, half), (late, agent, amount - half)]
+    return [
+        {
+            "policy_id": invoice["policy_id"],
+            "contact_id": contact,
+            "amount_paid": amount_paid,
+            "transaction_date": paid_on,
+        }
+        for paid_on, contact, amount_paid in paid
+        if paid_on < as_of
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="add to the database instead of resetting it",
+    )
+    args = parser.parse_args()
+
+    if not args.keep:
+        reset_db()
+    stats = generate_book(args.policies, seed=args.seed, chunk_size=args.chunk_size)
+    print(
+        "{0.policies} policies, {0.invoices} invoices, {0.payments} payments, "
+        "{0.canceled} canceled, {0.ledger_entries} ledger entries "
+        "in {0.seconds:.1f}s".format(stats)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Bytes and CPU per request of the invoices endpoint on a synthetic book:
+full responses, revalidations sending the ETag back (a 304 when nothing
+changed), and a policy with a long invoice list with and without the
+fast JSON encoder. The same script runs on commits from before the
+ETags, where a revalidation is a full response.
+
+    python -m benchmarks.conditional_get --policies 20000 --large 2000
+"""
+
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+from benchmarks import reset_db
+from benchmarks.book import AS_OF, generate_book
+from accounting import app
+from accounting.models import Invoice, Policy
+from accounting.sql_base import DBSession
+
+LARGE_POLICY = "Large Policy"
+
+
+def add_large_policy(invoice_count):
+    """
+    An active policy billed every week since long ago
+    """
+    result = DBSession.execute(
+        Policy.__table__.insert(),
+        {
+            "policy_number": LARGE_POLICY,
+            "effective_date": date(1990, 1, 1),
+            "status": "Active",
+            "billing_schedule": "Monthly",
+            "annual_premium": invoice_count * 1000,
+        },
+    )
+    policy_id = result.inserted_primary_key[0]
+    DBSession.execute(
+        Invoice.__table__.insert(),
+        [
+            {
+                "policy_id": policy_id,
+                "bill_date": date(1990, 1, 1) + timedelta(weeks=week),
+                "due_date": date(1990, 2, 1) + timedelta(weeks=week),
+                "cancel_date": date(1990, 2, 15) + timedelta(weeks=week),
+                "amount_due": 1000 + week % 7,
+            }
+            for week in range(invoice_count)
+        ],
+    )
+    DBSession.commit()
+
+
+def response_bytes(response):
+    """
+    Status line aside, what goes over the wire: headers and body
+    """
+    headers = sum(len(name) + len(value) + 4 for name, value in response.headers)
+    return headers + len(response.get_data())
+
+
+def measure(client, requests):
+    """
+    Run (policy_number, date_cursor, headers) requests
+    :return: (CPU us per request, bytes per response, status codes seen)
+    """
+    sizes, statuses = 0, set()
+    start = time.process_time()
+    for policy_number, date_cursor, headers in requests:
+        response = client.get(
+            "/policy/api/invoices",
+            query_string={
+                "policy_number": policy_number,
+                "date_cursor": date_cursor.strftime("%Y-%m-%d"),
+            },
+            headers=headers,
+        )
+        sizes += response_bytes(response)
+        statuses.add(response.status_code)
+    cpu = time.process_time() - start
+    return cpu * 1e6 / len(requests), sizes / len(requests), sorted(statuses)
+
+
+def validators(client, requests):
+    """
+    The requests again, each with the validators of its current response
+    """
+    conditional = []
+    for policy_number, date_cursor, _ in requests:
+        response = client.get(
+            "/policy/api/invoices",
+            query_string={
+                "policy_number": policy_number,
+                "date_cursor": date_cursor.strftime("%Y-%m-%d"),
+            },
+        )
+        headers = {}
+        if "ETag" in response.headers:
+            headers["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            headers["If-Modified-Since"] = response.headers["Last-Modified"]
+        conditional.append((policy_number, date_cursor, headers))
+    return conditional
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=20000)
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument(
+        "--large", type=int, default=2000, help="invoices of the large policy"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    reset_db()
+    book = generate_book(args.policies, seed=args.seed)
+    add_large_policy(args.large)
+    print("{0.policies} policies, {0.invoices} invoices".format(book))
+
+    rng = random.Random(args.seed)
+    numbers = [
+        number
+        for (number,) in DBSession.query(Policy.policy_number).filter(
+            Policy.status == "Active"
+        )
+    ]
+    DBSession.remove()
+    sample = [
+        (number, AS_OF - timedelta(days=rng.randrange(365)), {})
+        for number in rng.sample(numbers, min(args.samples, len(numbers)))
+    ]
+    large = [(LARGE_POLICY, AS_OF, {})] * max(1, args.samples // 20)
+
+    client = app.test_client()
+    runs = [
+        ("full", sample),
+        ("revalidate", validators(client, sample)),
+        ("large full", large),
+        ("large revalidate", validators(client, large)),
+    ]
+    print(
+        "{0:<30} {1:>12} {2:>14}  {3}".format(
+            "", "CPU us/req", "bytes/response", "status"
+        )
+    )
+    for fast_json in (True, False):
+        app.config["FAST_JSON"] = fast_json
+        for name, requests in runs:
+            if not fast_json and not name.startswith("large full"):
+                continue
+            cpu, size, statuses = measure(client, requests)
+            label = name + ("" if fast_json else ", json module")
+            print(
+                "{0:<30} {1:>12.0f} {2:>14.0f}  {3}".format(label, cpu, size, statuses)
+            )
+    app.config["FAST_JSON"] = True
+
+
+if __name__ == "__main__":
+    main()
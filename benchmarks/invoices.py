@@ -0,0 +1,68 @@
+"""
+Onboarding cost: PolicyAccounting.make_invoices one policy at a time
+against accounting.billing.make_invoices_bulk.
+
+    python -m benchmarks.invoices --policies 5000
+"""
+
+import argparse
+from datetime import date, timedelta
+
+from benchmarks import best_of, reset_db
+from accounting.billing import make_invoices_bulk
+from accounting.models import Policy
+from accounting.sql_base import DBSession
+from accounting.utils import PolicyAccounting
+
+SCHEDULES = ["Annual", "Two-Pay", "Quarterly", "Monthly"]
+
+
+def seed(policy_count):
+    reset_db()
+    DBSession.execute(
+        Policy.__table__.insert(),
+        [
+            {
+                "policy_number": "Bench Policy {0}".format(i),
+                "effective_date": date(2015, 1, 1) + timedelta(days=i % 365),
+                "status": "Active",
+                "billing_schedule": SCHEDULES[i % len(SCHEDULES)],
+                "annual_premium": 1200 + i % 500,
+            }
+            for i in range(policy_count)
+        ],
+    )
+    DBSession.commit()
+    return [policy_id for policy_id, in DBSession.query(Policy.id)]
+
+
+def one_at_a_time(policy_ids):
+    for policy_id in policy_ids:
+        PolicyAccounting(policy_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=5000)
+    args = parser.parse_args()
+
+    policy_ids = seed(args.policies)
+    loop_time, _ = best_of(lambda: one_at_a_time(policy_ids), 1)
+
+    seed(args.policies)
+    policies = DBSession.query(
+        Policy.id, Policy.effective_date, Policy.billing_schedule, Policy.annual_premium
+    ).all()
+    bulk_time, created = best_of(lambda: make_invoices_bulk(policies), 1)
+
+    print("{0} policies, {1} invoices".format(args.policies, created))
+    print("make_invoices loop  {0:8.2f}s".format(loop_time))
+    print(
+        "make_invoices_bulk  {0:8.2f}s  {1:.1f}x".format(
+            bulk_time, loop_time / bulk_time
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Lockbox throughput: PolicyAccounting.make_payment once per row against
+accounting.lockbox.ingest_payments on the same file. The loop only gets
+the last rows of the file (it is that slow), posted once the rest of it
+is in, so it runs against the same table size the bulk load ends with;
+both are reported in rows per second.
+
+    python -m benchmarks.lockbox --policies 10000 --rows 50000
+"""
+
+import argparse
+import csv
+import io
+import random
+from datetime import date, timedelta
+
+from benchmarks import best_of, reset_db
+from accounting.billing import make_invoices_bulk
+from accounting.lockbox import ingest_payments
+from accounting.models import Contact, Payment, Policy
+from accounting.sql_base import DBSession
+from accounting.utils import PolicyAccounting
+
+
+def seed(policy_count):
+    reset_db()
+    insured = Contact("Bench Insured", "Named Insured")
+    agent = Contact("Bench Agent", "Agent")
+    DBSession.add_all([insured, agent])
+    DBSession.commit()
+    DBSession.execute(
+        Policy.__table__.insert(),
+        [
+            {
+                "policy_number": "Bench Policy {0}".format(i),
+                "effective_date": date(2015, 1, 1),
+                "status": "Active",
+                "billing_schedule": "Monthly",
+                "annual_premium": 1200,
+                "named_insured": insured.id,
+                "agent": agent.id,
+            }
+            for i in range(policy_count)
+        ],
+    )
+    DBSession.commit()
+    make_invoices_bulk(
+        DBSession.query(
+            Policy.id,
+            Policy.effective_date,
+            Policy.billing_schedule,
+            Policy.annual_premium,
+        ).all()
+    )
+    return insured.id, agent.id
+
+
+def lockbox_rows(policy_count, row_count, contact_ids):
+    rng = random.Random(1)
+    return [
+        (
+            "Bench Policy {0}".format(rng.randrange(policy_count)),
+            rng.choice([50, 100, 300]),
+            date(2015, 1, 1) + timedelta(days=rng.randrange(365)),
+            rng.choice(("",) + contact_ids),
+        )
+        for _ in range(row_count)
+    ]
+
+
+def make_payment_loop(rows):
+    accepted = 0
+    for policy_number, amount, transaction_date, contact_id in rows:
+        policy_id = (
+            DBSession.query(Policy.id).filter_by(policy_number=policy_number).one().id
+        )
+        try:
+            PolicyAccounting(policy_id).make_payment(
+                contact_id or 0, transaction_date, amount
+            )
+        except UserWarning:
+            continue
+        accepted += 1
+    return accepted
+
+
+def lockbox_file(rows):
+    lines = io.StringIO()
+    writer = csv.writer(lines)
+    writer.writerow(["policy_number", "amount", "transaction_date", "contact_id"])
+    writer.writerows(rows)
+    lines.seek(0)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=10000)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument(
+        "--loop-rows", type=int, default=1000, help="rows given to the loop"
+    )
+    args = parser.parse_args()
+
+    contact_ids = seed(args.policies)
+    rows = lockbox_rows(args.policies, args.rows, contact_ids)
+    head, sample = rows[: -args.loop_rows], rows[-args.loop_rows :]
+    ingest_payments(lockbox_file(head))
+    loop_time, loop_accepted = best_of(lambda: make_payment_loop(sample), 1)
+
+    DBSession.query(Payment).delete()
+    DBSession.commit()
+    lines = lockbox_file(rows)
+    bulk_time, report = best_of(lambda: ingest_payments(lines), 1)
+    # Same decisions as the loop on the rows it got, lines start at 2.
+    first_line = len(head) + 2
+    rejected = sum(1 for rejection in report.rejected if rejection.line >= first_line)
+    assert len(sample) - rejected == loop_accepted, (rejected, loop_accepted)
+
+    loop_rate = len(sample) / loop_time
+    bulk_rate = len(rows) / bulk_time
+    print("{0} policies".format(args.policies))
+    print(
+        "make_payment loop  {0:>6} rows {1:8.2f}s {2:>9.0f} rows/s".format(
+            len(sample), loop_time, loop_rate
+        )
+    )
+    print(
+        "ingest_payments    {0:>6} rows {1:8.2f}s {2:>9.0f} rows/s  {3:.0f}x".format(
+            len(rows), bulk_time, bulk_rate, bulk_rate / loop_rate
+        )
+    )
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    main()
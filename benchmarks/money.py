@@ -0,0 +1,98 @@
+"""
+Microbenchmark of the balance loop with the three money representations
+the code base has used: float dollars wrapped in a Decimal at the end,
+Decimal dollars (what the Money column type loads) and integer cents
+(what the hot paths read through accounting.money.cents). The last
+columns time the same loop fed from the database.
+
+    python -m benchmarks.money --sizes 10000 100000 1000000
+"""
+
+import argparse
+from datetime import date, timedelta
+from decimal import Decimal
+
+from benchmarks import best_of, reset_db
+from accounting.models import Invoice, Policy
+from accounting.money import cents, from_cents, split_cents
+from accounting.sql_base import DBSession
+
+
+def balance_loop(amounts):
+    balance = 0
+    for amount in amounts:
+        balance += amount
+    return balance
+
+
+def seed(size):
+    reset_db()
+    policy = Policy("Bench Money Policy", date(2015, 1, 1), 1600)
+    DBSession.add(policy)
+    DBSession.commit()
+    amounts = split_cents(160000, 12)
+    DBSession.execute(
+        Invoice.__table__.insert(),
+        [
+            {
+                "policy_id": policy.id,
+                "bill_date": date(2015, 1, 1) + timedelta(days=i // 100),
+                "due_date": date(2015, 2, 1),
+                "cancel_date": date(2015, 2, 15),
+                "amount_due": from_cents(amounts[i % 12]),
+            }
+            for i in range(size)
+        ],
+    )
+    DBSession.commit()
+    return policy.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        "{:>9} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+            "amounts", "float", "Decimal", "cents", "db Decimal", "db cents"
+        )
+    )
+    for size in args.sizes:
+        floats = [1600 / 12] * size
+        decimals = [from_cents(c) for c in split_cents(160000, 12)] * (size // 12)
+        ints = split_cents(160000, 12) * (size // 12)
+        float_time, _ = best_of(lambda: Decimal(balance_loop(floats)), args.repeat)
+        decimal_time, _ = best_of(lambda: balance_loop(decimals), args.repeat)
+        cents_time, _ = best_of(lambda: from_cents(balance_loop(ints)), args.repeat)
+
+        policy_id = seed(size)
+        query = DBSession.query(Invoice.amount_due).filter(
+            Invoice.policy_id == policy_id
+        )
+        cents_query = DBSession.query(cents(Invoice.amount_due)).filter(
+            Invoice.policy_id == policy_id
+        )
+        db_decimal_time, by_decimal = best_of(
+            lambda: balance_loop(amount for amount, in query), args.repeat
+        )
+        db_cents_time, by_cents = best_of(
+            lambda: from_cents(balance_loop(amount for amount, in cents_query)),
+            args.repeat,
+        )
+        assert by_decimal == by_cents, (by_decimal, by_cents)
+        print(
+            "{:>9} {:>10.4f} {:>10.4f} {:>10.4f} {:>12.4f} {:>12.4f}".format(
+                size,
+                float_time,
+                decimal_time,
+                cents_time,
+                db_decimal_time,
+                db_cents_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Payment throughput on a synthetic book: T threads each posting payments
+one after the other, with PolicyAccounting.make_payment (a commit per
+payment) against a shared accounting.payment_writer.PaymentWriter (a
+commit per group). Both sides pay active policies as their named
+insured, from disjoint samples of the same book, so a past due policy
+is refused the same way by either.
+
+    python -m benchmarks.payment_writer --threads 1 4 16 --payments 2000
+"""
+
+import argparse
+import random
+import threading
+import time
+from decimal import Decimal
+
+from sqlalchemy.orm.exc import NoResultFound
+
+from benchmarks import reset_db
+from benchmarks.book import AS_OF, generate_book
+from accounting.models import Policy
+from accounting.payment_writer import PaymentWriter
+from accounting.sql_base import DBSession
+from accounting.utils import PolicyAccounting
+
+AMOUNT = Decimal("10")
+
+
+def per_call(policy_ids, counts, lock):
+    for policy_id in policy_ids:
+        try:
+            PolicyAccounting(policy_id).make_payment(0, AS_OF, AMOUNT)
+            outcome = "posted"
+        except (NoResultFound, UserWarning):
+            DBSession.rollback()
+            outcome = "refused"
+        except Exception:
+            DBSession.rollback()
+            outcome = "errors"
+        with lock:
+            counts[outcome] += 1
+    DBSession.remove()
+
+
+def through_writer(writer):
+    def post(policy_ids, counts, lock):
+        for policy_id in policy_ids:
+            try:
+                writer.make_payment(policy_id, 0, AS_OF, AMOUNT)
+                outcome = "posted"
+            except (NoResultFound, UserWarning):
+                outcome = "refused"
+            except Exception:
+                outcome = "errors"
+            with lock:
+                counts[outcome] += 1
+
+    return post
+
+
+def run(post, policy_ids, threads):
+    """
+    Split the payments between `threads` threads running `post`
+    :return: (payments per second, outcome counts)
+    """
+    counts = {"posted": 0, "refused": 0, "errors": 0}
+    lock = threading.Lock()
+    workers = [
+        threading.Thread(target=post, args=(policy_ids[i::threads], counts, lock))
+        for i in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(policy_ids) / (time.perf_counter() - start), counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=20000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument(
+        "--payments", type=int, default=2000, help="payments per run and side"
+    )
+    parser.add_argument("--max-batch", type=int)
+    parser.add_argument("--max-delay", type=float, help="seconds")
+    args = parser.parse_args()
+
+    reset_db()
+    book = generate_book(args.policies)
+    print("{0.policies} policies, {0.invoices} invoices".format(book))
+    policy_ids = [
+        policy_id
+        for (policy_id,) in DBSession.query(Policy.id).filter(Policy.status == "Active")
+    ]
+    DBSession.remove()
+    random.Random(0).shuffle(policy_ids)
+
+    print(
+        "{0:>7}  {1:<12} {2:>10} {3:>8} {4:>8} {5:>7} {6:>12}".format(
+            "threads", "", "payments/s", "posted", "refused", "errors", "posted/group"
+        )
+    )
+    for threads in args.threads:
+        sample = policy_ids[: 2 * args.payments]
+        policy_ids = policy_ids[2 * args.payments :] + sample
+        writer = PaymentWriter(args.max_batch, args.max_delay).start()
+        for name, post, ids in (
+            ("per call", per_call, sample[::2]),
+            ("writer", through_writer(writer), sample[1::2]),
+        ):
+            rate, counts = run(post, ids, threads)
+            group = ""
+            if name == "writer":
+                writer.stop()
+                group = "{0:.1f}".format(writer.written / max(writer.groups, 1))
+            print(
+                "{0:>7}  {1:<12} {2:>10.0f} {3[posted]:>8} {3[refused]:>8} "
+                "{3[errors]:>7} {4:>12}".format(threads, name, rate, counts, group)
+            )
+
+
+if __name__ == "__main__":
+    main()
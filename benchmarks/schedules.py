@@ -0,0 +1,88 @@
+"""
+Invoice layout cost per policy: the relativedelta arithmetic
+make_invoices used to do for every policy against
+accounting.billing.invoice_dates, cold (memo cleared before each run)
+and warm. No database involved, the policies spread over a year of
+effective dates like a real book.
+
+    python -m benchmarks.schedules --policies 100000
+"""
+
+import argparse
+from datetime import date, timedelta
+
+from dateutil.relativedelta import relativedelta
+
+from benchmarks import best_of
+from accounting.billing import BILLING_SCHEDULES, billing_schedule, invoice_dates
+from accounting.money import installment_amounts
+
+SCHEDULES = ["Annual", "Two-Pay", "Semi-Annual", "Quarterly", "Monthly"]
+INSTALLMENT_MONTHS = {
+    "Annual": 12,
+    "Two-Pay": 6,
+    "Semi-Annual": 6,
+    "Quarterly": 3,
+    "Monthly": 1,
+}
+
+
+def relativedelta_layout(policies):
+    invoices = 0
+    for effective_date, schedule, premium in policies:
+        months = INSTALLMENT_MONTHS[schedule]
+        installments = 12 // months
+        for i in range(installments):
+            bill_date = effective_date + relativedelta(months=i * months)
+            bill_date + relativedelta(months=1)
+            bill_date + relativedelta(months=1, days=14)
+            invoices += 1
+        installment_amounts(premium, installments)
+    return invoices
+
+
+def schedule_layout(policies):
+    invoices = 0
+    for effective_date, schedule, premium in policies:
+        dates = invoice_dates(effective_date, schedule)
+        billing_schedule(schedule).amounts(premium)
+        invoices += len(dates)
+    return invoices
+
+
+def cold_schedule_layout(policies):
+    invoice_dates.cache_clear()
+    return schedule_layout(policies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    assert set(SCHEDULES) <= set(BILLING_SCHEDULES)
+    policies = [
+        (
+            date(2015, 1, 1) + timedelta(days=i % 365),
+            SCHEDULES[i % len(SCHEDULES)],
+            1200 + i % 500,
+        )
+        for i in range(args.policies)
+    ]
+    old_time, old_count = best_of(lambda: relativedelta_layout(policies), args.repeat)
+    cold_time, cold_count = best_of(lambda: cold_schedule_layout(policies), args.repeat)
+    warm_time, warm_count = best_of(lambda: schedule_layout(policies), args.repeat)
+    assert old_count == cold_count == warm_count
+
+    print("{0} policies, {1} invoices".format(args.policies, old_count))
+    print("relativedelta         {0:8.3f}s".format(old_time))
+    for label, elapsed in (
+        ("invoice_dates cold", cold_time),
+        ("invoice_dates warm", warm_time),
+    ):
+        print("{0:<20}  {1:8.3f}s  {2:.1f}x".format(label, elapsed, old_time / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Columnar snapshot against the SQL path on a synthetic book: load and
+refresh time, memory per million invoices, and balance / invoices
+endpoint lookups per second. Every sampled answer is checked against the
+SQL path first.
+
+    python -m benchmarks.snapshot --policies 200000
+"""
+
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from benchmarks import reset_db
+from benchmarks.book import AS_OF, generate_book
+from accounting import app
+from accounting.cache import balance_cache
+from accounting.ledger import ledger_balance
+from accounting.models import Invoice, Policy
+from accounting.snapshot import BalanceSnapshot, current_snapshot
+from accounting.sql_base import DBSession
+from accounting.utils import PolicyAccounting
+
+
+def timed(operations):
+    start = time.perf_counter()
+    for operation in operations:
+        operation()
+    return len(operations) / (time.perf_counter() - start)
+
+
+def check(snapshot, sample, dates):
+    for (policy_id, _), day in zip(sample, dates):
+        assert snapshot.balance_cents(policy_id, day) == ledger_balance(
+            policy_id, day
+        ), (policy_id, day)
+        live = (
+            DBSession.query(Invoice)
+            .filter_by(policy_id=policy_id, deleted=False)
+            .order_by(Invoice.bill_date, Invoice.id)
+        )
+        assert [i.serialize() for i in snapshot.invoices(policy_id)] == [
+            i.serialize() for i in live
+        ], policy_id
+    DBSession.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=50000)
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    reset_db()
+    book = generate_book(args.policies, seed=args.seed)
+    print(
+        "{0.policies} policies, {0.invoices} invoices, {0.payments} payments".format(
+            book
+        )
+    )
+
+    snapshot = BalanceSnapshot()
+    start = time.perf_counter()
+    snapshot.reload()
+    print("reload                {0:8.2f}s".format(time.perf_counter() - start))
+
+    rng = random.Random(args.seed)
+    # PolicyAccounting refuses canceled policies.
+    policies = (
+        DBSession.query(Policy.id, Policy.policy_number)
+        .filter(Policy.status == "Active")
+        .all()
+    )
+    sample = rng.sample(policies, min(args.samples, len(policies)))
+    dates = [AS_OF - timedelta(days=rng.randrange(730)) for _ in sample]
+
+    # A day of payments, then an incremental refresh.
+    DBSession.execute(
+        "INSERT INTO payments (policy_id, contact_id, amount_paid, transaction_date) "
+        "SELECT id, named_insured, 1000, :day FROM policies WHERE id % 50 = 0",
+        {"day": AS_OF},
+    )
+    DBSession.commit()
+    start = time.perf_counter()
+    snapshot.refresh()
+    print("refresh, verified     {0:8.2f}s".format(time.perf_counter() - start))
+    check(snapshot, sample, dates)
+
+    footprint = snapshot.footprint()
+    total = footprint["columns"] + footprint["policy_index"] + footprint["overlay"]
+    per_million = 1e6 / footprint["invoices"] / 2**20
+    print(
+        "memory                {0:8.1f} MB per million invoices "
+        "({1:.1f} MB columns, {2:.1f} MB policy numbers)".format(
+            total * per_million,
+            footprint["columns"] * per_million,
+            footprint["policy_index"] * per_million,
+        )
+    )
+
+    accountings = [PolicyAccounting(policy_id) for policy_id, _ in sample]
+
+    def uncached(pa, day):
+        balance_cache.clear()
+        return pa.return_account_balance(day)
+
+    sql = timed(
+        [
+            lambda pa=pa, day=day: uncached(pa, day)
+            for pa, day in zip(accountings, dates)
+        ]
+    )
+    columnar = timed(
+        [
+            lambda policy_id=policy_id, day=day: snapshot.return_account_balance(
+                policy_id, day
+            )
+            for (policy_id, _), day in zip(sample, dates)
+        ]
+    )
+    print(
+        "balance    SQL {0:>10.0f}/s  snapshot {1:>10.0f}/s  {2:.0f}x".format(
+            sql, columnar, columnar / sql
+        )
+    )
+
+    client = app.test_client()
+
+    def get(policy_number, day):
+        response = client.get(
+            "/policy/api/invoices",
+            query_string={
+                "policy_number": policy_number,
+                "date_cursor": day.strftime("%Y-%m-%d"),
+            },
+        )
+        assert response.status_code == 200
+        return response.get_json()
+
+    requests = [
+        lambda number=number, day=day: get(number, day)
+        for (_, number), day in zip(sample, dates)
+    ]
+    sql = timed(requests)
+    app.config["SNAPSHOT_ENABLED"] = True
+    try:
+        current_snapshot()
+        columnar = timed(requests)
+    finally:
+        app.config["SNAPSHOT_ENABLED"] = False
+    print(
+        "endpoint   SQL {0:>10.0f}/s  snapshot {1:>10.0f}/s  {2:.1f}x".format(
+            sql, columnar, columnar / sql
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Import time and cold worker boot, each measured in a fresh interpreter
+(the wall time of the whole process, interpreter start included), best
+of --repeat runs. One -X importtime run of the worker boot breaks its
+import time down by top level package, and importing the models with
+the database file missing shows whether it touches the database.
+
+    python -m benchmarks.startup --repeat 10
+
+Exits with status 1 when a stage misses its target in TARGETS_MS.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmarks import reset_db
+from benchmarks.book import generate_book
+from accounting.models import Policy
+from accounting.sql_base import DBSession
+
+# Best wall times to stay under, interpreter start included. A command
+# line tool (models, ledger) never loads Flask. A web worker is booted
+# once it served its first request, about 270 ms of which is importing
+# SQLAlchemy and Flask.
+TARGETS_MS = {
+    "import accounting.models": 300,
+    "import accounting.ledger": 300,
+    "app + first request": 600,
+}
+
+FIRST_REQUEST = (
+    "from accounting import app; "
+    "response = app.test_client().get('/policy/api/invoices', query_string="
+    "{{'policy_number': {0!r}, 'date_cursor': '2015-06-01'}}); "
+    "assert response.status_code == 200, response.status_code"
+)
+
+
+def stages(policy_number):
+    return (
+        ("python -c pass", "pass"),
+        ("import accounting.models", "import accounting.models"),
+        ("import accounting.ledger", "import accounting.ledger"),
+        ("app", "from accounting import app"),
+        ("app + first request", FIRST_REQUEST.format(policy_number)),
+    )
+
+
+def _run(code, env=None, args=()):
+    return subprocess.run(
+        [sys.executable] + list(args) + ["-c", code],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def wall_ms(code, repeat):
+    """
+    Best wall time of a fresh interpreter running `code`, in ms
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _run(code)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def import_times(code):
+    """
+    Self import time of every top level package `code` imports, in ms
+    :return: (total ms, {package: ms})
+    """
+    stderr = _run(code, args=("-X", "importtime")).stderr
+    packages = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us) / 1000
+    return sum(packages.values()), packages
+
+
+def touches_database():
+    """
+    Whether importing the models creates a missing database file
+    """
+    path = os.path.join(tempfile.mkdtemp(), "untouched.sqlite")
+    env = dict(os.environ, ACCOUNTING_DATABASE_URI="sqlite:///" + path)
+    _run("import accounting.models", env=env)
+    return os.path.exists(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    # A small book for the first request, made to an active policy.
+    reset_db()
+    generate_book(100)
+    (policy_number,) = (
+        DBSession.query(Policy.policy_number)
+        .filter(Policy.status == "Active")
+        .order_by(Policy.id)
+        .first()
+    )
+    DBSession.remove()
+
+    missed = []
+    for name, code in stages(policy_number):
+        ms = wall_ms(code, args.repeat)
+        target = TARGETS_MS.get(name)
+        if target and ms > target:
+            missed.append(name)
+        print(
+            "{0:<28} {1:7.1f} ms{2}".format(
+                name,
+                ms,
+                (
+                    "  target {0} ms{1}".format(
+                        target, ", MISSED" if ms > target else ""
+                    )
+                    if target
+                    else ""
+                ),
+            )
+        )
+
+    total, packages = import_times(FIRST_REQUEST.format(policy_number))
+    print("\nimport time of the worker boot: {0:.1f} ms".format(total))
+    for package, ms in sorted(packages.items(), key=lambda item: -item[1])[:8]:
+        print("  {0:<24} {1:7.1f} ms".format(package, ms))
+    flask = "flask" in _run(
+        "import sys, accounting.ledger; print(sorted(sys.modules))"
+    ).stdout.split("'")
+    print("\naccounting.ledger imports flask: {0}".format(flask))
+    print("importing the models creates the database: {0}".format(touches_database()))
+    if missed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Benchmark suite over a synthetic book (see benchmarks.book). Times the
+PolicyAccounting hot paths and the invoices endpoint on a seeded sample
+of policies and saves the results as JSON, so two commits can be
+compared on the same book:
+
+    python -m benchmarks.suite --policies 10000 --output before.json
+    (check out the other commit)
+    python -m benchmarks.suite --policies 10000 --output after.json \\
+        --compare before.json
+
+With --compare, the exit status is 1 when a benchmark got slower than
+--threshold (a fraction, 0.25 = 25% slower per operation).
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+
+from benchmarks import reset_db
+from benchmarks.book import AS_OF, generate_book
+from accounting import app
+from accounting.billing import BILLING_SCHEDULES
+from accounting.cache import balance_cache
+from accounting.models import Policy
+from accounting.sql_base import DBSession
+from accounting.utils import PolicyAccounting
+
+# Schedules a policy can be stored on (the policies table rejects the rest).
+SCHEDULES = list(Policy.__table__.c.billing_schedule.type.enums)
+
+
+def _sample(rng, size):
+    """
+    Ids, numbers and schedules of `size` active policies
+    """
+    policies = (
+        DBSession.query(Policy.id, Policy.policy_number, Policy.billing_schedule)
+        .filter(Policy.status == "Active")
+        .order_by(Policy.id)
+        .all()
+    )
+    DBSession.rollback()
+    return rng.sample(policies, min(size, len(policies)))
+
+
+def _timed(operations):
+    """
+    Run the callables one after the other
+    :return: (ops, seconds)
+    """
+    start = time.perf_counter()
+    for operation in operations:
+        operation()
+    return len(operations), time.perf_counter() - start
+
+
+def _date_cursors(rng, count):
+    return [AS_OF - timedelta(days=rng.randrange(365)) for _ in range(count)]
+
+
+def bench_return_account_balance(rng, sample):
+    """
+    Balance on a random date, cache cleared first so every call misses
+    """
+    accountings = [PolicyAccounting(policy.id) for policy in sample]
+    dates = _date_cursors(rng, len(sample))
+    balance_cache.clear()
+    return _timed(
+        [
+            lambda pa=pa, day=day: pa.return_account_balance(day)
+            for pa, day in zip(accountings, dates)
+        ]
+    )
+
+
+def bench_evaluate_cancellation_pending(rng, sample):
+    accountings = [PolicyAccounting(policy.id) for policy in sample]
+    dates = _date_cursors(rng, len(sample))
+    return _timed(
+        [
+            lambda pa=pa, day=day: pa.evaluate_cancellation_pending_due_to_non_pay(day)
+            for pa, day in zip(accountings, dates)
+        ]
+    )
+
+
+def bench_evaluate_cancel(rng, sample):
+    accountings = [PolicyAccounting(policy.id) for policy in sample]
+    dates = _date_cursors(rng, len(sample))
+    return _timed(
+        [
+            lambda pa=pa, day=day: pa.evaluate_cancel(day)
+            for pa, day in zip(accountings, dates)
+        ]
+    )
+
+
+def bench_invoices_endpoint(rng, sample):
+    client = app.test_client()
+    dates = _date_cursors(rng, len(sample))
+
+    def get(policy_number, day):
+        response = client.get(
+            "/policy/api/invoices",
+            query_string={
+                "policy_number": policy_number,
+                "date_cursor": day.strftime("%Y-%m-%d"),
+            },
+        )
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    return _timed(
+        [
+            lambda number=policy.policy_number, day=day: get(number, day)
+            for policy, day in zip(sample, dates)
+        ]
+    )
+
+
+def bench_make_invoices(rng, sample):
+    """
+    Rebill the policies (they keep their schedule)
+    """
+    accountings = [PolicyAccounting(policy.id) for policy in sample]
+    return _timed([pa.make_invoices for pa in accountings])
+
+
+def _switch(rng, sample, incremental):
+    accountings = [PolicyAccounting(policy.id) for policy in sample]
+    targets = [
+        rng.choice([name for name in SCHEDULES if name != policy.billing_schedule])
+        for policy in sample
+    ]
+    dates = _date_cursors(rng, len(sample))
+    return _timed(
+        [
+            lambda pa=pa, target=target, day=day: pa.switch_billing_schedule(
+                target, incremental=incremental, date_cursor=day
+            )
+            for pa, target, day in zip(accountings, targets, dates)
+        ]
+    )
+
+
+def bench_switch_billing_schedule(rng, sample):
+    return _switch(rng, sample, incremental=False)
+
+
+def bench_switch_billing_schedule_incremental(rng, sample):
+    return _switch(rng, sample, incremental=True)
+
+
+# Read only benchmarks first, the others change the book. Each one draws
+# its sample when its turn comes, from the book as the previous left it.
+BENCHMARKS = (
+    ("return_account_balance", bench_return_account_balance),
+    ("evaluate_cancellation_pending", bench_evaluate_cancellation_pending),
+    ("evaluate_cancel", bench_evaluate_cancel),
+    ("invoices_endpoint", bench_invoices_endpoint),
+    ("make_invoices", bench_make_invoices),
+    ("switch_billing_schedule", bench_switch_billing_schedule),
+    ("switch_billing_schedule_incremental", bench_switch_billing_schedule_incremental),
+)
+
+
+def run_suite(policy_count, samples, seed=0, only=None):
+    """
+    Build a fresh book and run the benchmarks on it
+    :param policy_count: size of the book
+    :param samples: policies per benchmark
+    :param seed: seeds the book and the samples
+    :param only: names of the benchmarks to run, all by default
+    :return: results, ready for json.dump
+    """
+    assert set(SCHEDULES) <= set(BILLING_SCHEDULES)
+    reset_db()
+    book = generate_book(policy_count, seed=seed)
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if only and name not in only:
+            continue
+        # One generator per benchmark, so --only does not move the
+        # samples of the others.
+        rng = random.Random("{0}:{1}".format(seed, name))
+        ops, seconds = benchmark(rng, _sample(rng, samples))
+        DBSession.remove()
+        results[name] = {
+            "ops": ops,
+            "seconds": round(seconds, 6),
+            "ms_per_op": round(seconds * 1000 / ops, 4) if ops else None,
+            "ops_per_second": round(ops / seconds, 1) if seconds else None,
+        }
+    return {
+        "commit": _commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "seed": seed,
+        "samples": samples,
+        "book": dict(book._asdict(), seconds=round(book.seconds, 2)),
+        "results": results,
+    }
+
+
+def _commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, threshold):
+    """
+    Print ms per operation side by side
+    :return: names of the benchmarks slower than baseline by more than
+        `threshold`
+    """
+    regressions = []
+    print(
+        "{:<36} {:>12} {:>12} {:>8}".format(
+            "benchmark",
+            "{0} ms".format(baseline.get("commit") or "baseline"),
+            "{0} ms".format(current.get("commit") or "current"),
+            "change",
+        )
+    )
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name, {}).get("ms_per_op")
+        after = result["ms_per_op"]
+        if not before or after is None:
+            print("{:<36} {:>12} {:>12.4f}".format(name, "-", after or 0))
+            continue
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            "{:<36} {:>12.4f} {:>12.4f} {:>+7.1%}{}".format(
+                name, before, after, change, flag
+            )
+        )
+    if baseline.get("book", {}).get("policies") != current["book"]["policies"]:
+        print("warning: the two runs used books of different sizes")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--policies", type=int, default=10000)
+    parser.add_argument(
+        "--samples", type=int, default=500, help="policies per benchmark"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", choices=[name for name, _ in BENCHMARKS])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline results JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    args = parser.parse_args()
+
+    current = run_suite(args.policies, args.samples, seed=args.seed, only=args.only)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(current, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), current, args.threshold)
+        if regressions:
+            sys.exit(1)
+    else:
+        json.dump(current, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Time the cancellation sweep serially and with a process pool.
+
+    python -m benchmarks.sweep --policies 20000 --workers 2 4
+"""
+
+import argparse
+import random
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+from benchmarks import best_of, reset_db
+from accounting.models import Contact, Invoice, Payment, Policy
+from accounting.sql_base import DBSession
+from accounting.sweep import sweep_policies
+
+
+def seed(policy_count, seed=0):
+    """
+    `policy_count` monthly policies; most are paid up, some stopped paying
+    """
+    reset_db()
+    rng = random.Random(seed)
+    insured = Contact("Bench Insured", "Named Insured")
+    DBSession.add(insured)
+    DBSession.commit()
+
+    DBSession.execute(
+        Policy.__table__.insert(),
+        [
+            {
+                "policy_number": "Bench Policy {0}".format(i),
+                "effective_date": date(2015, 1, 1) + relativedelta(days=i % 365),
+                "status": "Active",
+                "billing_schedule": "Monthly",
+                "annual_premium": 1200,
+                "named_insured": insured.id,
+            }
+            for i in range(policy_count)
+        ],
+    )
+    invoices, payments = [], []
+    for policy_id, effective_date in DBSession.query(Policy.id, Policy.effective_date):
+        paid_months = 12 if rng.random() < 0.8 else rng.randint(0, 11)
+        for month in range(12):
+            bill_date = effective_date + relativedelta(months=month)
+            invoices.append(
+                {
+                    "policy_id": policy_id,
+                    "bill_date": bill_date,
+                    "due_date": bill_date + relativedelta(months=1),
+                    "cancel_date": bill_date + relativedelta(months=1, days=14),
+                    "amount_due": 100,
+                }
+            )
+            if month < paid_months:
+                payments.append(
+                    {
+                        "policy_id": policy_id,
+                        "contact_id": insured.id,
+                        "amount_paid": 100,
+                        "transaction_date": bill_date,
+                    }
+                )
+    DBSession.execute(Invoice.__table__.insert(), invoices)
+    DBSession.execute(Payment.__table__.insert(), payments)
+    DBSession.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=20000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--chunk-size", type=int, default=500)
+    args = parser.parse_args()
+
+    seed(args.policies)
+    date_cursor = date(2015, 12, 31)
+    serial_time, serial = best_of(
+        lambda: sweep_policies(date_cursor, args.chunk_size, dry_run=True), 1
+    )
+    print("serial     {0:8.2f}s  {1}".format(serial_time, serial.summary()))
+    for workers in args.workers:
+        elapsed, report = best_of(
+            lambda: sweep_policies(
+                date_cursor, args.chunk_size, dry_run=True, workers=workers
+            ),
+            1,
+        )
+        assert report.canceled == serial.canceled
+        assert report.pending == serial.pending
+        print(
+            "workers={0}  {1:8.2f}s  {2:.1f}x".format(
+                workers, elapsed, serial_time / elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
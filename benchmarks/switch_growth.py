@@ -0,0 +1,106 @@
+"""
+Table growth across repeated billing schedule switches: every policy
+switches schedule once a month, with the full rebuild and with the
+incremental mode of PolicyAccounting.switch_billing_schedule.
+
+    python -m benchmarks.switch_growth --policies 200 --rounds 6
+"""
+
+import argparse
+import time
+from datetime import date
+
+from sqlalchemy import event
+
+from benchmarks import reset_db
+from benchmarks.invoices import SCHEDULES, seed
+from accounting.billing import add_months, make_invoices_bulk
+from accounting.models import Invoice, LedgerEntry, Policy
+from accounting.sql_base import DBSession
+from accounting.utils import PolicyAccounting
+
+
+class RowCounter(object):
+    """
+    Invoice rows the ORM inserts and deletes while switching
+    """
+
+    def __init__(self):
+        self.inserted = self.deleted = 0
+        event.listen(Invoice, "after_insert", self.on_insert)
+        event.listen(Invoice, "after_delete", self.on_delete)
+
+    def on_insert(self, mapper, connection, target):
+        self.inserted += 1
+
+    def on_delete(self, mapper, connection, target):
+        self.deleted += 1
+
+    def close(self):
+        event.remove(Invoice, "after_insert", self.on_insert)
+        event.remove(Invoice, "after_delete", self.on_delete)
+
+
+def run(policy_count, rounds, incremental):
+    seed(policy_count)
+    make_invoices_bulk(
+        DBSession.query(
+            Policy.id,
+            Policy.effective_date,
+            Policy.billing_schedule,
+            Policy.annual_premium,
+        ).all()
+    )
+    policy_ids = [policy_id for policy_id, in DBSession.query(Policy.id)]
+    elapsed = 0
+    counter = RowCounter()
+    for round_number in range(1, rounds + 1):
+        date_cursor = add_months(date(2015, 6, 1), round_number)
+        start = time.perf_counter()
+        for policy_id in policy_ids:
+            pa = PolicyAccounting(policy_id)
+            current = SCHEDULES.index(pa.policy.billing_schedule)
+            pa.switch_billing_schedule(
+                SCHEDULES[(current + 1) % len(SCHEDULES)],
+                incremental=incremental,
+                date_cursor=date_cursor,
+            )
+        elapsed += time.perf_counter() - start
+        DBSession.expunge_all()
+    counter.close()
+    return (
+        elapsed,
+        {
+            "inserted": counter.inserted,
+            "deleted": counter.deleted,
+            "invoice rows": DBSession.query(Invoice).count(),
+            "ledger rows": DBSession.query(LedgerEntry).count(),
+        },
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--policies", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=6)
+    args = parser.parse_args()
+
+    results = [
+        ("full", run(args.policies, args.rounds, False)),
+        ("incremental", run(args.policies, args.rounds, True)),
+    ]
+    reset_db()
+    columns = list(results[0][1][1])
+    print(
+        "{:>12} {:>9}".format("mode", "time (s)")
+        + "".join(" {:>16}".format(column) for column in columns)
+    )
+    for mode, (elapsed, stats) in results:
+        print(
+            "{:>12} {:>9.2f}".format(mode, elapsed)
+            + "".join(" {:>16}".format(stats[column]) for column in columns)
+        )
+
+
+if __name__ == "__main__":
+    main()
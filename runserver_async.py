@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+from aiohttp import web
+
+from accounting.aio import create_async_app
+
+if __name__ == "__main__":
+    web.run_app(create_async_app(), host="0.0.0.0", port=5000)